@@ -0,0 +1,580 @@
+"""Local benchmarks against a stand-in Aparat API/CDN server
+
+Usage:
+  python bench.py [--record bench_history.jsonl] startup [--runs 5]
+  python bench.py shards [--workers 4] [--videos 24] [--mode hash|claim]
+  python bench.py scale [--max-processes 4] [--videos 32]
+  python bench.py schedule [--distribution tail|pareto] [--videos 12]
+  python bench.py s3 [--size-mb 20]   # needs boto3 and moto
+  python bench.py refresh [--videos 4]
+  python bench.py shard-reports [--splits 3 2]
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Video bytes repeat a 251-byte pattern, so the byte at every offset is
+# known and a resumed upload can be compared with the whole file
+PATTERN = bytes(range(251))
+CHUNK = PATTERN * 263
+
+
+def video_bytes(size):
+    """The bytes of a stand-in video of `size` bytes"""
+    return (PATTERN * (size // len(PATTERN) + 1))[:size]
+
+
+class StandInServer:
+    """Serves the playlist/video API endpoints and video files from memory
+
+    `sizes` maps video index to the size in bytes of its 720p file; the 360p
+    variant is half that. `rate` throttles each transfer in bytes per second.
+    `playlists` maps playlist IDs to the video indices they hold; together
+    they make up the channel listed for any username, two per page. IDs not
+    in it serve every video. With `honor_range` off, Range headers are
+    ignored and whole files are sent, as some CDNs do.
+    """
+
+    def __init__(self, sizes, rate=None, latency=0.0, playlist_title="Bench Playlist", playlists=None,
+                 honor_range=True):
+        self.sizes = list(sizes)
+        self.honor_range = honor_range
+        self.playlists = playlists or {}
+        self.rate = rate
+        self.latency = latency
+        self.playlist_title = playlist_title
+        self.requests = 0
+        self._server = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+
+    @property
+    def api_base(self):
+        return f"{self.base_url}/api/fa/v1"
+
+    def file_size(self, index, profile):
+        size = self.sizes[index]
+        return size if profile == "720p" else size // 2
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def send_json(self, payload, headers=None):
+                body = json.dumps(payload).encode()
+                self.send_response(200)
+                for name, value in (headers or {}).items():
+                    self.send_header(name, value)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_HEAD(self):
+                self.do_GET(head=True)
+
+            def do_GET(self, head=False):
+                server.requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+
+                match = re.search(r"/video/playlist/one/playlist_id/(\w+)", self.path)
+                if match:
+                    playlist_id = match.group(1)
+                    indices = server.playlists.get(playlist_id, range(len(server.sizes)))
+                    title = f"{server.playlist_title} {playlist_id}" if playlist_id in server.playlists else server.playlist_title
+                    etag = '"%s"' % hashlib.md5(repr((title, list(indices))).encode()).hexdigest()
+                    if self.headers.get("If-None-Match") == etag:
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+                    return self.send_json({
+                        "data": {"attributes": {"title": title}},
+                        "included": [
+                            {"type": "Video", "attributes": {"uid": f"v{i}", "title": f"Video {i}"}}
+                            for i in indices
+                        ],
+                    }, {"ETag": etag})
+
+                match = re.search(r"/video/playlist/list/username/(\w+)(?:\?page=(\d+))?", self.path)
+                if match:
+                    page = int(match.group(2) or 0)
+                    ids = list(server.playlists)
+                    more = len(ids) > 2 * (page + 1)
+                    return self.send_json({
+                        "data": [
+                            {"type": "Playlist", "id": playlist_id, "attributes": {"title": f"{server.playlist_title} {playlist_id}"}}
+                            for playlist_id in ids[2 * page:2 * page + 2]
+                        ],
+                        "links": {"next": f"{server.api_base}/video/playlist/list/username/{match.group(1)}?page={page + 1}" if more else None},
+                    })
+
+                match = re.search(r"/video/video/list/username/(\w+)", self.path)
+                if match:
+                    return self.send_json({"data": [
+                        {"type": "Video", "attributes": {"uid": f"v{i}", "title": f"Video {i}"}}
+                        for i in range(len(server.sizes))
+                    ], "links": {"next": None}})
+
+                match = re.search(r"/video/video/show/videohash/v(\d+)", self.path)
+                if match:
+                    index = int(match.group(1))
+                    return self.send_json({"data": {"attributes": {"file_link_all": [
+                        {"profile": profile, "urls": [f"{server.base_url}/files/v{index}-{profile}.mp4"]}
+                        for profile in ("360p", "720p")
+                    ]}}})
+
+                match = re.match(r"/files/v(\d+)-(\w+)\.mp4", self.path)
+                if match:
+                    return self.send_file(server.file_size(int(match.group(1)), match.group(2)), head)
+
+                self.send_error(404)
+
+            def send_file(self, size, head):
+                start, end = 0, size
+                range_header = self.headers.get("Range") if server.honor_range else None
+                if range_header:
+                    first, last = range_header.split("=")[1].split("-")
+                    start = int(first)
+                    if last:
+                        end = min(int(last) + 1, size)
+                self.send_response(206 if range_header else 200)
+                self.send_header("Content-Type", "video/mp4")
+                self.send_header("Content-Length", str(end - start))
+                self.end_headers()
+                if head:
+                    return
+
+                remaining = end - start
+                began = time.perf_counter()
+                sent = 0
+                while remaining > 0:
+                    phase = (start + sent) % len(PATTERN)
+                    piece = CHUNK[phase:phase + min(remaining, 65536)]
+                    self.wfile.write(piece)
+                    remaining -= len(piece)
+                    sent += len(piece)
+                    if server.rate:
+                        ahead = sent / server.rate - (time.perf_counter() - began)
+                        if ahead > 0:
+                            time.sleep(ahead)
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+def _serve_stand_in(sizes, rate, connection):
+    server = StandInServer(sizes, rate=rate).start()
+    connection.send(server.api_base)
+    threading.Event().wait()
+
+
+class StandInProcess:
+    """StandInServer in a separate process, so it does not compete for the benchmark's GIL"""
+
+    def __init__(self, sizes, rate=None):
+        import multiprocessing
+
+        context = multiprocessing.get_context("spawn")
+        parent, child = context.Pipe()
+        self._process = context.Process(target=_serve_stand_in, args=(sizes, rate, child), daemon=True)
+        self._process.start()
+        self.api_base = parent.recv()
+
+    def stop(self):
+        self._process.terminate()
+        self._process.join()
+
+
+def bench_startup(args):
+    """Time `cli.py --preview` startup and total import time (-X importtime)"""
+    server = StandInServer([1024] * 20).start()
+    env = dict(os.environ, APARAT_API_BASE=server.api_base)
+    wall_times, import_times = [], []
+    with tempfile.TemporaryDirectory() as destination:
+        command = [
+            sys.executable, "-X", "importtime", os.path.join(HERE, "cli.py"),
+            "-p", "1", "--preview", "--no-log-file", "-o", destination,
+        ]
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            # Answer "n" to the proceed prompt so only the preview is measured
+            result = subprocess.run(command, env=env, input="n\n", capture_output=True, text=True, check=True)
+            wall_times.append(time.perf_counter() - start)
+            # Top-level imports have exactly one space of indentation in the tree
+            import_times.append(sum(
+                int(line.split("|")[1])
+                for line in result.stderr.splitlines()
+                if line.startswith("import time:") and line.split("|")[1].strip().isdigit()
+                and re.match(r"^ \S", line.split("|")[2])
+            ) / 1e6)
+    server.stop()
+
+    summary = {
+        "benchmark": "startup",
+        "timestamp": time.time(),
+        "runs": args.runs,
+        "wall_seconds_median": statistics.median(wall_times),
+        "import_seconds_median": statistics.median(import_times),
+    }
+    print(f"cli.py --preview: wall {summary['wall_seconds_median'] * 1000:.1f} ms, "
+          f"imports {summary['import_seconds_median'] * 1000:.1f} ms (median of {args.runs})")
+    return summary
+
+
+def run_workers(server, destination, worker_args):
+    """Run one cli.py process per argument list in parallel and return the wall time"""
+    env = dict(os.environ, APARAT_API_BASE=server.api_base)
+    start = time.perf_counter()
+    processes = [
+        subprocess.Popen(
+            [sys.executable, os.path.join(HERE, "cli.py"), "-p", "1", "-o", destination, "--no-log-file", *extra],
+            env=env, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        )
+        for extra in worker_args
+    ]
+    codes = [process.wait() for process in processes]
+    if any(codes):
+        raise RuntimeError(f"worker exit codes: {codes}")
+    return time.perf_counter() - start
+
+
+def bench_shards(args):
+    """Download one playlist with N cooperating processes sharing a destination tree"""
+    sys.path.insert(0, HERE)
+    from core import aggregate_shard_reports
+
+    size = args.size_mb * 1024 * 1024
+    server = StandInServer([size] * args.videos, rate=args.rate_mb * 1024 * 1024).start()
+    with tempfile.TemporaryDirectory() as destination:
+        if args.mode == "hash":
+            worker_args = [["--shard", f"{i}/{args.workers}", "-c", "2"] for i in range(args.workers)]
+        else:
+            # Every worker walks the whole playlist and claims files through lock files
+            worker_args = [["--claim", "-c", "2"] for _ in range(args.workers)]
+        since = time.time()
+        wall = run_workers(server, destination, worker_args)
+
+        playlist_dir = os.path.join(destination, server.playlist_title)
+        files = [name for name in os.listdir(playlist_dir) if name.endswith(".mp4")]
+        complete = sum(1 for name in files if os.path.getsize(os.path.join(playlist_dir, name)) == size)
+        report = aggregate_shard_reports(playlist_dir, args.workers, since) if args.mode == "hash" else None
+    server.stop()
+
+    summary = {
+        "benchmark": "shards",
+        "timestamp": time.time(),
+        "mode": args.mode,
+        "workers": args.workers,
+        "videos": args.videos,
+        "complete_files": complete,
+        "wall_seconds": wall,
+        "aggregate_bytes_per_second": report["bytes_per_second"] if report else args.videos * size / wall,
+    }
+    print(f"{args.workers} workers ({args.mode}): {complete}/{args.videos} files complete in {wall:.2f}s, "
+          f"aggregate {summary['aggregate_bytes_per_second'] / 1024 / 1024:.1f} MB/s")
+    return summary
+
+
+def bench_shard_reports(args):
+    """A run split another way on the same destination aggregates only its own shard reports"""
+    sys.path.insert(0, HERE)
+    from core import aggregate_shard_reports
+
+    server = StandInServer([args.size_kb * 1024] * args.videos).start()
+    reports = {}
+    with tempfile.TemporaryDirectory() as destination:
+        playlist_dir = os.path.join(destination, server.playlist_title)
+        for workers in args.splits:
+            since = time.time()
+            run_workers(server, destination, [["--shard", f"{i}/{workers}"] for i in range(workers)])
+            reports[workers] = aggregate_shard_reports(playlist_dir, workers, since)
+            report = reports[workers] or {}
+            print(f"{workers} shards: {report.get('shards')}/{report.get('shard_count')} reported, "
+                  f"videos {report.get('successful')}/{report.get('videos')}")
+    server.stop()
+
+    failed = [
+        workers for workers, report in reports.items()
+        if not report or report["shards"] != workers or report["videos"] != args.videos
+    ]
+    if failed:
+        raise RuntimeError(f"Shard report check failed for splits: {failed}")
+    return {"benchmark": "shard-reports", "timestamp": time.time(), "splits": args.splits, "reports": reports}
+
+
+def bench_scale(args):
+    """Wall time of one playlist download with 1..N engine worker processes"""
+    import asyncio
+    import logging
+
+    sys.path.insert(0, HERE)
+    from core import AparatClient, AparatDownloader, configure_logging
+
+    configure_logging(logging.WARNING)
+    size = args.size_mb * 1024 * 1024
+    server = StandInProcess([size] * args.videos)
+    client = AparatClient(api_base=server.api_base)
+    results = {}
+    for processes in range(1, args.max_processes + 1):
+        with tempfile.TemporaryDirectory() as destination:
+            downloader = AparatDownloader(
+                playlist_id="1", quality="720", destination_path=destination,
+                max_concurrent_downloads=args.concurrent, processes=processes, client=client,
+            )
+            tasks = downloader.resolve_tasks(downloader.get_playlist_info())
+            start = time.perf_counter()
+            outcome = asyncio.run(downloader.execute_tasks_async(tasks))
+            elapsed = time.perf_counter() - start
+        if not all(outcome):
+            raise RuntimeError(f"{outcome.count(False)} transfers failed with {processes} processes")
+        results[processes] = elapsed
+        rate = args.videos * size / elapsed / 1024 / 1024
+        print(f"{processes} process(es): {elapsed:.2f}s, {rate:.0f} MB/s, "
+              f"speedup {results[1] / elapsed:.2f}x")
+    server.stop()
+
+    return {
+        "benchmark": "scale",
+        "timestamp": time.time(),
+        "videos": args.videos,
+        "size_mb": args.size_mb,
+        "concurrent": args.concurrent,
+        "wall_seconds": results,
+    }
+
+
+def skewed_sizes(distribution, videos, size_mb, seed=1):
+    """Video sizes in bytes: "tail" is uniform with one file 12x larger last, "pareto" is heavy-tailed"""
+    size = size_mb * 1024 * 1024
+    if distribution == "tail":
+        return [size] * (videos - 1) + [size * 12]
+    rng = random.Random(seed)
+    return [int(size * min(rng.paretovariate(1.2), 20)) for _ in range(videos)]
+
+
+def bench_schedule(args):
+    """Wall time and time to half the files done for each scheduling policy on skewed sizes"""
+    import asyncio
+    import logging
+
+    sys.path.insert(0, HERE)
+    from core import SCHEDULE_POLICIES, AparatClient, AparatDownloader, configure_logging
+
+    configure_logging(logging.WARNING)
+    sizes = skewed_sizes(args.distribution, args.videos, args.size_mb)
+    server = StandInProcess(sizes, rate=args.rate_mb * 1024 * 1024)
+    client = AparatClient(api_base=server.api_base)
+    results = {}
+    for policy in SCHEDULE_POLICIES:
+        finished = {}
+
+        def progress_callback(title, progress, downloaded, total):
+            if downloaded >= total:
+                finished.setdefault(title, time.perf_counter())
+
+        with tempfile.TemporaryDirectory() as destination:
+            downloader = AparatDownloader(
+                playlist_id="1", quality="720", destination_path=destination, progress_callback=progress_callback,
+                max_concurrent_downloads=args.concurrent, schedule=policy, client=client, space_margin=0,
+            )
+            tasks = downloader.resolve_tasks(downloader.get_playlist_info(), probe_size=True)
+            start = time.perf_counter()
+            outcome = asyncio.run(downloader.execute_tasks_async(tasks))
+            elapsed = time.perf_counter() - start
+        if not all(outcome):
+            raise RuntimeError(f"{outcome.count(False)} transfers failed with {policy}")
+        done = sorted(when - start for when in finished.values())
+        results[policy] = {"wall_seconds": elapsed, "half_done_seconds": done[(len(done) - 1) // 2]}
+        print(f"{policy:>15}: wall {elapsed:.2f}s, half the files done after {results[policy]['half_done_seconds']:.2f}s")
+    server.stop()
+
+    return {
+        "benchmark": "schedule",
+        "timestamp": time.time(),
+        "distribution": args.distribution,
+        "videos": args.videos,
+        "total_mb": sum(sizes) / 1024 / 1024,
+        "concurrent": args.concurrent,
+        "policies": results,
+    }
+
+
+def bench_s3(args):
+    """S3 sink against a moto server: cancel and resume, a server ignoring ranges, and the uploaded bytes"""
+    import logging
+
+    try:
+        import boto3
+        from moto.server import ThreadedMotoServer
+    except ImportError:
+        raise SystemExit("The s3 check needs boto3 and moto (pip install boto3 'moto[server]')")
+
+    sys.path.insert(0, HERE)
+    from core import AparatClient, AparatDownloader, configure_logging
+
+    configure_logging(logging.WARNING)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    moto = ThreadedMotoServer(port=args.port, verbose=False)
+    moto.start()
+    os.environ.update(AWS_ACCESS_KEY_ID="bench", AWS_SECRET_ACCESS_KEY="bench", AWS_DEFAULT_REGION="us-east-1",
+                      AWS_ENDPOINT_URL=f"http://127.0.0.1:{args.port}")
+    s3 = boto3.client("s3")
+    s3.create_bucket(Bucket="bench")
+    size = args.size_mb * 1024 * 1024
+    rate = args.rate_mb * 1024 * 1024
+    checks = {}
+    try:
+        for name, honor_range in (("resume", True), ("range-ignored", False)):
+            server = StandInServer([size], rate=rate, honor_range=honor_range).start()
+            with tempfile.TemporaryDirectory() as destination:
+                def downloader():
+                    return AparatDownloader(playlist_id="1", quality="720", destination_path=destination,
+                                            sink=f"s3://bench/{name}", client=AparatClient(api_base=server.api_base))
+
+                # Cancel halfway through the second 8 MB part, so one full part is uploaded
+                first = downloader()
+                threading.Timer(1.5 * (8 << 20) / rate, first.cancel).start()
+                first.download_playlist()
+                path = os.path.join(destination, server.playlist_title, "Video 0-720p.mp4")
+                resumed_at = downloader().sink.resume_offset(path, size)
+                completed = downloader().download_playlist()
+            server.stop()
+
+            key = f"{name}/{server.playlist_title}/Video 0-720p.mp4"
+            body = s3.get_object(Bucket="bench", Key=key)["Body"].read() if completed else b""
+            orphans = s3.list_multipart_uploads(Bucket="bench", Prefix=f"{name}/").get("Uploads", [])
+            checks[name] = {
+                "resumed_at": resumed_at,
+                "completed": bool(completed),
+                "intact": body == video_bytes(size),
+                "orphaned_uploads": len(orphans),
+            }
+            print(f"{name:>14}: resumed at {resumed_at} bytes, completed {completed}, "
+                  f"bytes intact {checks[name]['intact']}, orphaned uploads {len(orphans)}")
+    finally:
+        moto.stop()
+
+    failed = [
+        name for name, check in checks.items()
+        if not (check["completed"] and check["intact"] and check["resumed_at"] and not check["orphaned_uploads"])
+    ]
+    if failed:
+        raise RuntimeError(f"S3 sink check failed: {', '.join(failed)}")
+    return {"benchmark": "s3", "timestamp": time.time(), "size_mb": args.size_mb, "checks": checks}
+
+
+def bench_refresh(args):
+    """Videos whose link cannot be re-resolved fail alone while the rest of the playlist finishes"""
+    import asyncio
+    import logging
+
+    sys.path.insert(0, HERE)
+    from core import AparatClient, AparatDownloader, configure_logging
+
+    configure_logging(logging.CRITICAL)
+    server = StandInServer([args.size_kb * 1024] * args.videos).start()
+    with tempfile.TemporaryDirectory() as destination:
+        downloader = AparatDownloader(playlist_id="1", quality="720", destination_path=destination,
+                                      client=AparatClient(api_base=server.api_base))
+        tasks = downloader.resolve_tasks(downloader.get_playlist_info())
+        # A dead CDN link whose video is gone from the API (the lookup answers 404 HTML, not JSON),
+        # once on the retry path and once as an already expired link
+        broken = {0: {}, 1: {"expires_at": time.time() - 1}}
+        for index, fields in broken.items():
+            tasks[index].update(fields, uid=f"gone{index}", url=f"{server.base_url}/files/gone.mp4")
+        start = time.perf_counter()
+        results = asyncio.run(downloader.execute_tasks_async(tasks))
+        elapsed = time.perf_counter() - start
+    server.stop()
+
+    expected = [index not in broken for index in range(args.videos)]
+    print(f"{args.videos} videos, {len(broken)} with unresolvable links: results {results} in {elapsed:.2f}s")
+    if results != expected:
+        raise RuntimeError(f"Refresh failure check failed: expected {expected}")
+    return {"benchmark": "refresh", "timestamp": time.time(), "videos": args.videos, "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Aparat downloader benchmarks")
+    parser.add_argument("--record", help="Append results as JSON lines to this file")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    startup = subparsers.add_parser("startup", help="CLI preview startup and import time")
+    startup.add_argument("--runs", type=int, default=5)
+    startup.set_defaults(func=bench_startup)
+
+    shards = subparsers.add_parser("shards", help="Cooperating worker processes on one playlist")
+    shards.add_argument("--workers", type=int, default=4)
+    shards.add_argument("--videos", type=int, default=24)
+    shards.add_argument("--size-mb", type=int, default=4)
+    shards.add_argument("--rate-mb", type=float, default=8, help="Per-transfer server bandwidth in MB/s")
+    shards.add_argument("--mode", choices=("hash", "claim"), default="hash")
+    shards.set_defaults(func=bench_shards)
+
+    shard_reports = subparsers.add_parser("shard-reports", help="Shard reports of successive runs split different ways")
+    shard_reports.add_argument("--splits", type=int, nargs="+", default=[3, 2])
+    shard_reports.add_argument("--videos", type=int, default=6)
+    shard_reports.add_argument("--size-kb", type=int, default=256)
+    shard_reports.set_defaults(func=bench_shard_reports)
+
+    scale = subparsers.add_parser("scale", help="Engine worker processes from 1 to N on one playlist")
+    scale.add_argument("--max-processes", type=int, default=min(4, os.cpu_count() or 1))
+    scale.add_argument("--videos", type=int, default=32)
+    scale.add_argument("--size-mb", type=int, default=16)
+    scale.add_argument("--concurrent", type=int, default=4, help="Transfers per process")
+    scale.set_defaults(func=bench_scale)
+
+    schedule = subparsers.add_parser("schedule", help="Scheduling policies on skewed file sizes")
+    schedule.add_argument("--distribution", choices=("tail", "pareto"), default="tail")
+    schedule.add_argument("--videos", type=int, default=12)
+    schedule.add_argument("--size-mb", type=int, default=2, help="Typical file size")
+    schedule.add_argument("--rate-mb", type=float, default=8, help="Per-transfer server bandwidth in MB/s")
+    schedule.add_argument("--concurrent", type=int, default=3)
+    schedule.set_defaults(func=bench_schedule)
+
+    s3 = subparsers.add_parser("s3", help="S3 sink resume and upload integrity against a moto server")
+    s3.add_argument("--size-mb", type=int, default=20)
+    s3.add_argument("--rate-mb", type=float, default=10, help="Per-transfer server bandwidth in MB/s")
+    s3.add_argument("--port", type=int, default=5123, help="Port of the moto server")
+    s3.set_defaults(func=bench_s3)
+
+    refresh = subparsers.add_parser("refresh", help="Failed link re-resolution fails one video, not the playlist")
+    refresh.add_argument("--videos", type=int, default=4)
+    refresh.add_argument("--size-kb", type=int, default=256)
+    refresh.set_defaults(func=bench_refresh)
+
+    args = parser.parse_args()
+    summary = args.func(args)
+    if args.record:
+        with open(args.record, "a", encoding="utf-8") as f:
+            f.write(json.dumps(summary) + "\n")
+
+
+if __name__ == "__main__":
+    main()
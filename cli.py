@@ -1,8 +1,24 @@
 
 import argparse
+import os
 import sys
 import asyncio
-from core import AparatDownloader
+import threading
+import time
+from core import (
+    AparatClient,
+    AparatDownloader,
+    DownloadEngine,
+    Metrics,
+    PlaylistWatcher,
+    RunProfiler,
+    Tracer,
+    aggregate_shard_reports,
+    configure_logging,
+    format_duration,
+    format_size,
+    start_metrics_server,
+)
 
 
 def create_parser():
@@ -15,6 +31,17 @@ Examples:
   python cli.py -p 822374 -q 720 -o ./Downloads
   python cli.py --playlist-id 822374 --quality auto --destination ./MyVideos --links-only
   python cli.py -p 822374 -q 480 --concurrent 5 --preview
+  python cli.py -p 822374 -q auto --budget 20G --min-quality 360
+  python cli.py -p 822374 -q 720,360   # archive and mobile copies in one pass
+  python cli.py -p 822374 -q 720 --plan plan.json
+  python cli.py --execute plan.json -o /mnt/archive
+  python cli.py -p 822374 --shard 0/4   # run 0/4 .. 3/4 side by side
+  python cli.py -p 822374 --claim   # or any number of these, taking files as they go
+  python cli.py --channel someuser --channel-videos -q 720   # every playlist of a channel
+  python cli.py -p 822374 --sink s3://archive/aparat   # stream straight into a bucket
+  python cli.py -p 822374 --sink - | ffmpeg -i - ...
+  python cli.py --serve --port 8765 -o ./Downloads
+  python cli.py --watch -p @playlists.txt -q 720   # keep polling for new videos
         """
     )
     
@@ -24,11 +51,51 @@ Examples:
         help='Aparat playlist ID or full URL'
     )
     
+    parser.add_argument(
+        '--channel',
+        type=str,
+        metavar='USERNAME',
+        help='Download every playlist of a channel (username or channel URL) in one run'
+    )
+    
+    parser.add_argument(
+        '--channel-videos',
+        action='store_true',
+        help='With --channel, also download videos that are in none of its playlists'
+    )
+    
     parser.add_argument(
         '-q', '--quality',
         type=str,
         default='720',
-        help='Video quality (144, 240, 360, 480, 720, 1080) or "auto" for best available'
+        help='Video quality (144, 240, 360, 480, 720, 1080) or "auto" for best available; '
+             'a list such as 720,360 downloads every variant in one pass'
+    )
+    
+    parser.add_argument(
+        '--prefer',
+        type=str,
+        metavar='Q1,Q2,...',
+        help='Qualities to try in order before falling back to the best available, e.g. 720,480'
+    )
+    
+    parser.add_argument(
+        '--min-quality',
+        type=int,
+        help='Never download below this quality'
+    )
+    
+    parser.add_argument(
+        '--max-quality',
+        type=int,
+        help='Never download above this quality'
+    )
+    
+    parser.add_argument(
+        '--budget',
+        type=str,
+        metavar='SIZE',
+        help='Fit the whole playlist in this size (e.g. 20G, 500M), choosing the highest qualities that fit'
     )
     
     parser.add_argument(
@@ -51,10 +118,75 @@ Examples:
         help='Number of concurrent downloads (default: 3, max: 10)'
     )
     
+    parser.add_argument(
+        '--schedule',
+        choices=['playlist', 'largest-first', 'smallest-first'],
+        default='playlist',
+        help='Order in which downloads start: playlist order, largest files first (shortest total time) '
+             'or smallest first (most files finished early) (default: playlist)'
+    )
+    
+    parser.add_argument(
+        '--processes',
+        type=int,
+        default=1,
+        help='Spread transfers over this many worker processes, each running --concurrent downloads (default: 1)'
+    )
+    
+    parser.add_argument(
+        '--sink',
+        type=str,
+        metavar='SPEC',
+        help='Where video files go: "local" (default) under --destination, "-" to stream every video to stdout, '
+             '"pipe:COMMAND" to stream each video into COMMAND ({path} and {name} are substituted), '
+             'or "s3://bucket/prefix" for an S3-compatible bucket (needs boto3; AWS_ENDPOINT_URL selects '
+             'MinIO or another server). Resume and history stay under --destination'
+    )
+    
+    parser.add_argument(
+        '--fsync',
+        choices=['none', 'close', 'interval'],
+        default='close',
+        help='When to fsync downloaded files, and so how far a resume can trust them after a power loss: '
+             'never, once on close, or every 64 MB and on close (default: close)'
+    )
+    
+    parser.add_argument(
+        '--write-buffer',
+        type=int,
+        default=1024,
+        metavar='KB',
+        help='Size of each of the 4 write buffers handed to the disk writer thread (default: 1024)'
+    )
+    
+    parser.add_argument(
+        '--min-free',
+        type=int,
+        default=256,
+        metavar='MB',
+        help='Free space to always leave on the destination filesystem (default: 256)'
+    )
+    
+    parser.add_argument(
+        '--on-low-space',
+        choices=['skip', 'wait'],
+        default='skip',
+        help='What to do with videos that do not fit in free space; videos bigger than the whole volume '
+             'are skipped either way (default: skip)'
+    )
+    
     parser.add_argument(
         '--preview',
         action='store_true',
-        help='Show playlist information without downloading'
+        help='Show playlist information, sizes and an estimated duration before downloading'
+    )
+    
+    parser.add_argument(
+        '--sample-size',
+        type=float,
+        default=1,
+        metavar='MB',
+        help='Data read per connection to measure throughput for the preview ETA; 0 skips it (default: 1)'
     )
     
     parser.add_argument(
@@ -70,21 +202,171 @@ Examples:
         help='Disable logging to file'
     )
     
+    parser.add_argument(
+        '--log-json',
+        action='store_true',
+        help='Write logs as JSON lines with structured fields (uid, playlist_id, bytes, duration)'
+    )
+    
     parser.add_argument(
         '--resume',
         action='store_true',
         help='Resume interrupted downloads (enabled by default)'
     )
     
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help='Expose OpenMetrics on http://127.0.0.1:PORT/metrics while running'
+    )
+    
+    parser.add_argument(
+        '--metrics-json',
+        type=str,
+        help='Write a JSON dump of run metrics to this file when the run finishes'
+    )
+    
+    parser.add_argument(
+        '--plan',
+        type=str,
+        metavar='FILE',
+        help='Resolve links, sizes and target paths into a JSON plan file without downloading'
+    )
+    
+    parser.add_argument(
+        '--execute',
+        type=str,
+        metavar='FILE',
+        help='Download the videos listed in a plan file created with --plan'
+    )
+    
+    parser.add_argument(
+        '--shard',
+        type=str,
+        metavar='I/N',
+        help='Only download shard I of N (0-based) so N workers can share one playlist'
+    )
+    
+    parser.add_argument(
+        '--claim',
+        action='store_true',
+        help='Lock each file while downloading it so workers can share one playlist without sharding'
+    )
+    
+    parser.add_argument(
+        '--serve',
+        action='store_true',
+        help='Run as a long-lived service with a local HTTP/JSON job API'
+    )
+    
+    parser.add_argument(
+        '--watch',
+        action='store_true',
+        help='Keep running and download new videos as they appear; -p then takes a comma separated '
+             'list of IDs or @FILE with one ID or URL per line'
+    )
+    
+    parser.add_argument(
+        '--watch-interval',
+        type=float,
+        default=120,
+        metavar='SECONDS',
+        help='Shortest time between polls of one playlist (default: 120)'
+    )
+    
+    parser.add_argument(
+        '--watch-max-interval',
+        type=float,
+        default=3600,
+        metavar='SECONDS',
+        help='Longest time a quiet playlist is left unpolled (default: 3600)'
+    )
+    
+    parser.add_argument(
+        '--host',
+        type=str,
+        default='127.0.0.1',
+        help='Address the service listens on (default: 127.0.0.1)'
+    )
+    
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='Port the service listens on (default: 8765)'
+    )
+    
+    parser.add_argument(
+        '--queue-db',
+        type=str,
+        help='SQLite job queue used by --serve (default: DESTINATION/.jobs.sqlite)'
+    )
+    
+    parser.add_argument(
+        '--profile',
+        type=str,
+        metavar='DIR',
+        help='Profile the run (cProfile, tracemalloc) and write a Chrome trace to DIR'
+    )
+    
     return parser
 
 
+def parse_size(text):
+    """Parse sizes like 500M, 20G or 1.5T into bytes"""
+    units = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+    text = text.strip().upper().rstrip('B')
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def parse_playlist_ids(text, errors):
+    """IDs from a comma separated list of IDs/URLs, or from @FILE with one per line"""
+    if text.startswith('@'):
+        try:
+            with open(text[1:], 'r', encoding='utf-8') as f:
+                entries = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+        except OSError as e:
+            errors.append(f"Cannot read playlist list: {e}")
+            return []
+    else:
+        entries = [entry.strip() for entry in text.split(',') if entry.strip()]
+    ids = [entry.rstrip('/').split('/')[-1] for entry in entries]
+    bad = [playlist_id for playlist_id in ids if not playlist_id.isdigit()]
+    if bad:
+        errors.append(f"Playlist IDs must be numeric: {', '.join(bad[:5])}")
+    return list(dict.fromkeys(ids))
+
+
 def validate_args(args):
     """Validate command line arguments"""
     errors = []
     
     # Validate playlist ID
-    if not args.playlist_id:
+    if args.execute:
+        if args.plan:
+            errors.append("--plan and --execute cannot be combined")
+        if args.channel or args.watch:
+            errors.append("--channel and --watch cannot be combined with --execute")
+    elif args.watch:
+        if args.plan or args.preview or args.channel:
+            errors.append("--watch cannot be combined with --plan, --preview or --channel")
+        if args.budget:
+            # Each poll downloads only the new videos, so there is no whole playlist to spread a budget over
+            errors.append("--budget cannot be combined with --watch")
+        args.playlist_ids = parse_playlist_ids(args.playlist_id or '', errors)
+        if not args.playlist_ids:
+            errors.append("--watch needs at least one playlist ID")
+        if args.watch_interval <= 0 or args.watch_max_interval < args.watch_interval:
+            errors.append("Watch intervals must be positive, the maximum no shorter than the minimum")
+    elif args.channel:
+        if args.playlist_id:
+            errors.append("--playlist-id and --channel cannot be combined")
+        args.channel = args.channel.rstrip('/').split('/')[-1]
+        if not args.channel:
+            errors.append("Channel username is required")
+    elif not args.playlist_id:
         errors.append("Playlist ID is required")
     else:
         # Extract ID from URL if necessary
@@ -98,21 +380,298 @@ def validate_args(args):
             errors.append("Playlist ID must be numeric")
     
     # Validate quality
-    if args.quality != 'auto' and not args.quality.isdigit():
-        errors.append("Quality must be a number or 'auto'")
+    args.qualities = [quality.strip().rstrip('p') for quality in args.quality.split(',') if quality.strip()]
+    if not args.qualities or not all(quality == 'auto' or quality.isdigit() for quality in args.qualities):
+        errors.append("Quality must be a number or 'auto', or a comma separated list of them")
+    
+    if args.prefer:
+        args.prefer = [quality.strip().rstrip('p') for quality in args.prefer.split(',') if quality.strip()]
+        if not all(quality.isdigit() for quality in args.prefer):
+            errors.append("Preferred qualities must be numbers, e.g. 720,480")
+    
+    if args.min_quality and args.max_quality and args.min_quality > args.max_quality:
+        errors.append("Minimum quality cannot be above maximum quality")
+    
+    if args.budget:
+        try:
+            args.budget = parse_size(args.budget)
+        except ValueError:
+            errors.append("Budget must be a size such as 20G or 500M")
+    
+    if args.channel_videos and not args.channel:
+        errors.append("--channel-videos requires --channel")
+    
+    if args.processes < 1:
+        errors.append("Processes must be at least 1")
+    
+    if args.min_free < 0:
+        errors.append("Minimum free space cannot be negative")
+    
+    if args.write_buffer < 4:
+        errors.append("Write buffer must be at least 4 KB")
+    
+    # Validate shard
+    if args.shard:
+        try:
+            index, count = (int(part) for part in args.shard.split('/'))
+            if count < 1 or not 0 <= index < count:
+                raise ValueError
+            args.shard = (index, count)
+        except ValueError:
+            errors.append("Shard must look like I/N with 0 <= I < N")
     
     # Validate concurrent downloads
     if args.concurrent < 1 or args.concurrent > 10:
         errors.append("Concurrent downloads must be between 1 and 10")
     
+    if args.sink and not (args.sink in ('local', '-', 'stdout') or args.sink.startswith(('pipe:', 's3://'))):
+        errors.append("Sink must be local, -, pipe:COMMAND or s3://bucket/prefix")
+    elif args.sink in ('-', 'stdout'):
+        if args.processes > 1:
+            errors.append("Streaming to stdout cannot be combined with --processes")
+        # Videos go to stdout one after another, so there is nothing to gain from parallel transfers
+        args.concurrent = 1
+    
     return errors
 
 
-def progress_callback(title, progress, downloaded, total):
-    """Progress callback for CLI"""
-    downloaded_mb = downloaded / (1024 * 1024)
-    total_mb = total / (1024 * 1024)
-    print(f"\r{title}: {progress:.1f}% ({downloaded_mb:.1f}/{total_mb:.1f} MB)", end='', flush=True)
+class ProgressRenderer:
+    """Multi-line progress display: one line per active transfer and a total line
+
+    The block is redrawn in place under the log output. It doubles as the
+    console stream for logging, so log lines are written above it instead
+    of through it. When the output is not a terminal only the total line
+    is printed, every `plain_interval` seconds.
+    """
+
+    def __init__(self, stream=None, interval=0.5, max_lines=8, plain_interval=10):
+        self.stream = stream or sys.stdout
+        self.interval = interval
+        self.max_lines = max_lines
+        self.plain_interval = plain_interval
+        self.tracker = None
+        self.interactive = self.stream.isatty()
+        self._lock = threading.Lock()
+        self._drawn = 0
+        self._partial = ""
+
+    def write(self, text):
+        with self._lock:
+            # Hold back an unfinished line so the block is never drawn in the middle of it
+            text, _, self._partial = (self._partial + text).rpartition("\n")
+            if text:
+                self._clear()
+                self.stream.write(text + "\n")
+                self._draw()
+
+    def flush(self):
+        self.stream.flush()
+
+    def _clear(self):
+        if self._drawn:
+            # Back to the first line of the block, then erase to the end of the screen
+            self.stream.write(f"\x1b[{self._drawn}F\x1b[J")
+            self._drawn = 0
+
+    def _draw(self):
+        if not self.interactive or self.tracker is None:
+            return
+        lines = self.render(self.tracker.snapshot(active_only=True))
+        self.stream.write("".join(line + "\n" for line in lines))
+        self.stream.flush()
+        self._drawn = len(lines)
+
+    def render(self, snapshot):
+        """Lines for a ProgressTracker snapshot, cut to the terminal width"""
+        import shutil
+
+        width = shutil.get_terminal_size().columns - 1
+        lines = []
+        transfers = snapshot['transfers']
+        for transfer in transfers[:self.max_lines]:
+            line = f"{self.describe(transfer)}  {transfer['title']}"
+            lines.append(line[:width])
+        if len(transfers) > self.max_lines:
+            lines.append(f"   ... and {len(transfers) - self.max_lines} more active")
+        lines.append(self.total_line(snapshot)[:width])
+        return lines
+
+    @staticmethod
+    def describe(transfer):
+        if transfer['state'] == 'paused':
+            status = "paused"
+        elif transfer['rate']:
+            eta = format_duration(transfer['eta']) if transfer['eta'] is not None else "?"
+            status = f"{format_size(transfer['rate'])}/s ETA {eta}"
+        else:
+            status = "starting"
+        percent = transfer['downloaded'] * 100 / transfer['total'] if transfer['total'] else 0
+        size = f"{format_size(transfer['downloaded'])}/{format_size(transfer['total'])}"
+        return f"   {percent:5.1f}% {size:>21}  {status:<24}"
+
+    @staticmethod
+    def total_line(snapshot):
+        states = snapshot['states']
+        finished = sum(states.get(state, 0) for state in ('completed', 'failed', 'cancelled', 'skipped'))
+        count = sum(states.values())
+        percent = snapshot['downloaded'] * 100 / snapshot['total'] if snapshot['total'] else 0
+        line = (f"📊 {finished}/{count} videos, {format_size(snapshot['downloaded'])} of "
+                f"{format_size(snapshot['total'])} ({percent:.1f}%), {format_size(snapshot['rate'])}/s")
+        if snapshot['eta'] is not None:
+            line += f", ETA {format_duration(snapshot['eta'])}"
+        if states.get('failed'):
+            line += f", {states['failed']} failed"
+        return line
+
+    async def run(self, tracker):
+        """Redraw until cancelled, then leave the final total line in place"""
+        self.tracker = tracker
+        interval = self.interval if self.interactive else self.plain_interval
+        try:
+            while True:
+                await asyncio.sleep(interval)
+                with self._lock:
+                    self._clear()
+                    if self.interactive:
+                        self._draw()
+                    else:
+                        self.stream.write(self.total_line(tracker.snapshot(active_only=True)) + "\n")
+                        self.stream.flush()
+        finally:
+            with self._lock:
+                self._clear()
+                self.tracker = None
+                if tracker.transfers:
+                    self.stream.write(self.total_line(tracker.snapshot(active_only=True)) + "\n")
+                self.stream.flush()
+
+
+def print_estimate(estimate, limit=10):
+    """Print per-quality totals, the first `limit` videos with sizes, and the ETA"""
+    for quality, variant in estimate['qualities'].items():
+        label = 'best available' if quality == 'auto' else f"{quality}p"
+        line = f"\n📦 {label}: {format_size(variant['total_size'])}"
+        if variant['unknown']:
+            line += f" (+{variant['unknown']} of unknown size)"
+        if variant['missing']:
+            line += f", {variant['missing']} not available"
+        print(line)
+        for index, video in enumerate(variant['videos'][:limit], 1):
+            size = format_size(video['size']) if video['size'] is not None else '?'
+            profile = video['profile'] or '-'
+            print(f"   {index}. {video['title']} [{profile}, {size}]")
+        if len(variant['videos']) > limit:
+            print(f"   ... and {len(variant['videos']) - limit} more videos")
+    
+    if len(estimate['qualities']) > 1:
+        print(f"\n📦 Total: {format_size(estimate['total_size'])}")
+    if estimate['eta_seconds'] is not None:
+        print(f"⏱️  Estimated time: {format_duration(estimate['eta_seconds'])} "
+              f"at {format_size(estimate['throughput'])}/s measured")
+
+
+def install_control_signals(downloader, output=None):
+    """Ctrl+C/SIGTERM cancel cleanly (a second Ctrl+C aborts), SIGUSR1 pauses and SIGUSR2 resumes"""
+    import signal
+
+    loop = asyncio.get_running_loop()
+
+    def cancel():
+        print("\n⏹️  Stopping, partial downloads are kept for resume (Ctrl+C again to abort)...", file=output)
+        downloader.cancel()
+        # Let a second Ctrl+C raise KeyboardInterrupt as usual
+        loop.remove_signal_handler(signal.SIGINT)
+
+    def pause():
+        print("⏸️  Paused (send SIGUSR2 to resume)", file=output)
+        downloader.pause()
+
+    def resume():
+        print("▶️  Resumed", file=output)
+        downloader.resume()
+
+    handlers = [(signal.SIGINT, cancel), (getattr(signal, 'SIGTERM', None), cancel),
+                (getattr(signal, 'SIGUSR1', None), pause), (getattr(signal, 'SIGUSR2', None), resume)]
+    for signum, handler in handlers:
+        if signum is None:
+            continue
+        try:
+            loop.add_signal_handler(signum, handler)
+        except (NotImplementedError, RuntimeError):
+            # Windows event loops: Ctrl+C keeps raising KeyboardInterrupt
+            return
+
+
+async def run_service(args):
+    """Serve the job API, sharing one download engine between all jobs"""
+    import logging
+    from server import serve
+    
+    configure_logging(
+        log_level=getattr(logging, args.log_level),
+        log_file=None if args.no_log_file else os.path.join(args.destination, "downloader.log"),
+        json_lines=args.log_json,
+    )
+    print(f"🛰️  Serving job API on http://{args.host}:{args.port} (destination: {args.destination})")
+    await serve(
+        host=args.host,
+        port=args.port,
+        destination_path=args.destination,
+        workers=args.concurrent,
+        queue_path=args.queue_db,
+    )
+
+
+async def run_watch(args, qualities):
+    """Poll the playlists until interrupted, downloading new videos on one shared engine"""
+    import concurrent.futures
+    import logging
+    
+    configure_logging(
+        log_level=getattr(logging, args.log_level),
+        log_file=None if args.no_log_file else os.path.join(args.destination, "downloader.log"),
+        json_lines=args.log_json,
+    )
+    auto_quality = qualities[0] == 'auto'
+    engine = DownloadEngine(max_jobs=1)
+    if args.metrics_port:
+        start_metrics_server(engine.metrics, args.metrics_port)
+    watcher = PlaylistWatcher(
+        engine,
+        args.playlist_ids,
+        min_interval=args.watch_interval,
+        max_interval=args.watch_max_interval,
+        quality='720' if auto_quality else qualities[0],
+        auto_quality=auto_quality,
+        qualities=qualities,
+        for_download_manager=args.links_only,
+        destination_path=args.destination,
+        max_concurrent_downloads=args.concurrent,
+        processes=args.processes,
+        schedule=args.schedule,
+        quality_preference=args.prefer,
+        min_quality=args.min_quality,
+        max_quality=args.max_quality,
+        write_buffer_size=args.write_buffer * 1024,
+        fsync_policy=args.fsync,
+        space_margin=args.min_free * 1024 * 1024,
+        on_low_space=args.on_low_space,
+        sink=args.sink,
+    )
+    print(f"👀 Watching {len(args.playlist_ids)} playlists every {args.watch_interval:g}-{args.watch_max_interval:g}s "
+          f"(destination: {args.destination}); Ctrl+C to stop")
+    running = watcher.start()
+    loop = asyncio.get_running_loop()
+    try:
+        # Shielded so Ctrl+C stops the watcher below instead of killing it mid-poll
+        await asyncio.shield(asyncio.wrap_future(running))
+    finally:
+        watcher.stop()
+        # The watcher cancels its polls and saves its state on the engine loop before that stops
+        await loop.run_in_executor(None, concurrent.futures.wait, [running], 10)
+        await loop.run_in_executor(None, engine.shutdown)
+        if args.metrics_json:
+            engine.metrics.dump_json(args.metrics_json)
 
 
 async def main():
@@ -120,8 +679,16 @@ async def main():
     parser = create_parser()
     args = parser.parse_args()
     
+    if args.sink in ('-', 'stdout'):
+        # stdout carries the videos; every message goes to stderr instead
+        sys.stdout = sys.stderr
+    
+    if args.serve:
+        await run_service(args)
+        return
+    
     # Interactive mode if no playlist ID provided
-    if not args.playlist_id:
+    if not args.playlist_id and not args.execute and not args.channel and not args.watch:
         print("🎬 Aparat Playlist Downloader")
         print("=" * 40)
         
@@ -160,51 +727,92 @@ async def main():
             print(f"   - {error}")
         sys.exit(1)
     
-    # Set up logging level
+    if args.watch:
+        await run_watch(args, args.qualities)
+        return
+    
+    # Configure logging once, before any downloader is created; on a
+    # terminal, log lines go through the progress display to stay above it
     import logging
     log_level = getattr(logging, args.log_level)
+    renderer = ProgressRenderer()
+    configure_logging(
+        log_level=log_level,
+        log_file=None if args.no_log_file else os.path.join(args.destination, "downloader.log"),
+        json_lines=args.log_json,
+        console=renderer if renderer.interactive else None,
+    )
     
     # Create downloader instance
-    auto_quality = args.quality == 'auto'
-    quality = '720' if auto_quality else args.quality
+    auto_quality = args.qualities[0] == 'auto'
+    quality = '720' if auto_quality else args.qualities[0]
     
-    downloader = AparatDownloader(
-        playlist_id=args.playlist_id,
-        quality=quality,
-        for_download_manager=args.links_only,
-        destination_path=args.destination,
-        progress_callback=progress_callback,
-        max_concurrent_downloads=args.concurrent,
-        auto_quality=auto_quality,
-    )
+    metrics = Metrics()
+    if args.metrics_port:
+        start_metrics_server(metrics, args.metrics_port)
     
-    # Configure logging
-    downloader.logger = downloader.setup_logger(
-        log_level=log_level,
-        log_to_file=not args.no_log_file
-    )
+    tracer = Tracer(enabled=bool(args.profile))
+    profiler = RunProfiler(args.profile) if args.profile else None
+    client = AparatClient(metrics=metrics, tracer=tracer)
+    
+    try:
+        downloader = AparatDownloader(
+            playlist_id=args.playlist_id,
+            quality=quality,
+            for_download_manager=args.links_only,
+            destination_path=args.destination,
+            max_concurrent_downloads=args.concurrent,
+            auto_quality=auto_quality,
+            qualities=args.qualities,
+            schedule=args.schedule,
+            metrics=metrics,
+            metrics_file=args.metrics_json,
+            tracer=tracer,
+            profiler=profiler,
+            client=client,
+            shard=args.shard,
+            claim_files=args.claim,
+            processes=args.processes,
+            write_buffer_size=args.write_buffer * 1024,
+            fsync_policy=args.fsync,
+            space_margin=args.min_free * 1024 * 1024,
+            on_low_space=args.on_low_space,
+            quality_preference=args.prefer,
+            min_quality=args.min_quality,
+            max_quality=args.max_quality,
+            size_budget=args.budget,
+            sink=args.sink,
+            channel=args.channel,
+            channel_videos=args.channel_videos,
+        )
+    except RuntimeError as e:
+        # e.g. an S3 sink without boto3 installed
+        print(f"❌ {e}")
+        sys.exit(1)
     
     try:
         # Preview mode
         if args.preview:
             print("\n🔍 Getting playlist information...")
-            info = downloader.get_playlist_info()
+            info = await asyncio.get_running_loop().run_in_executor(None, downloader.get_playlist_info)
             
             if info:
-                print(f"\n📋 Playlist: {info['title']}")
+                if args.channel:
+                    print(f"\n📺 Channel: {info['title']}")
+                    print(f"📋 Playlists: {len(info['playlists'])}")
+                    if info['duplicates']:
+                        print(f"🔁 Shared between playlists: {info['duplicates']} (downloaded once)")
+                else:
+                    print(f"\n📋 Playlist: {info['title']}")
                 print(f"📊 Videos: {info['video_count']}")
-                print(f"🆔 ID: {args.playlist_id}")
+                print(f"🆔 ID: {downloader.playlist_id}")
                 
                 if info['video_count'] > 0:
-                    print(f"\n📹 Video list (showing first 10):")
-                    video_count = 0
-                    for video in info['videos']:
-                        if video['type'] == 'Video' and video_count < 10:
-                            print(f"   {video_count + 1}. {video['attributes']['title']}")
-                            video_count += 1
-                    
-                    if info['video_count'] > 10:
-                        print(f"   ... and {info['video_count'] - 10} more videos")
+                    print(f"\n📏 Resolving links and sizes...")
+                    estimate = await asyncio.get_running_loop().run_in_executor(
+                        None, downloader.estimate, info, int(args.sample_size * 1024 * 1024)
+                    )
+                    print_estimate(estimate)
                 
                 if not args.links_only:
                     proceed = input(f"\n⚡ Proceed with download? (Y/n): ").strip().lower()
@@ -215,17 +823,72 @@ async def main():
                 print("❌ Could not get playlist information")
                 return
         
+        # Plan mode: resolve everything, download nothing
+        if args.plan:
+            print(f"\n🗺️  Resolving download plan...")
+            plan = await asyncio.get_running_loop().run_in_executor(None, downloader.create_plan)
+            if not plan:
+                print("❌ Could not get playlist information")
+                sys.exit(1)
+            AparatDownloader.write_plan(plan, args.plan)
+            total_mb = plan['total_size'] / (1024 * 1024)
+            print(f"\n✅ Plan for '{plan['title']}' written to {args.plan}")
+            print(f"   Videos: {len(plan['tasks'])}, expected size: {total_mb:.1f} MB")
+            return
+        
         # Start download
-        if args.links_only:
+        if args.execute:
+            plan = AparatDownloader.load_plan(args.execute)
+            print(f"\n⬇️  Executing plan: {plan['title']} ({len(plan['tasks'])} videos)")
+            print(f"   Concurrent: {args.concurrent}")
+            print(f"   Destination: {args.destination}")
+        elif args.links_only:
             print(f"\n📄 Creating links file...")
         else:
             print(f"\n⬇️  Starting download...")
             print(f"   Quality: {args.quality}")
+            if args.budget:
+                print(f"   Budget: {format_size(args.budget)}")
             print(f"   Concurrent: {args.concurrent}")
             print(f"   Destination: {args.destination}")
+        if args.processes > 1:
+            print(f"   Processes: {args.processes}")
         
         # Execute download
-        result = await downloader.download_playlist_async()
+        install_control_signals(downloader, renderer)
+        display = None if args.links_only else asyncio.create_task(renderer.run(downloader.progress))
+        if profiler:
+            profiler.start()
+        started = time.time()
+        try:
+            if args.execute:
+                result = await downloader.execute_plan_async(plan)
+            else:
+                result = await downloader.download_playlist_async()
+        finally:
+            if display:
+                display.cancel()
+                await asyncio.gather(display, return_exceptions=True)
+            if profiler:
+                profiler.stop()
+                tracer.dump(os.path.join(args.profile, "trace.json"))
+                print(f"\n📈 Profile written to {args.profile}")
+        
+        if args.shard and not args.links_only:
+            title = downloader.playlist_title
+            # Reports of earlier runs, or of runs split another way, are left out
+            report = aggregate_shard_reports(
+                os.path.join(args.destination, title), args.shard[1], since=started
+            ) if title else None
+            if report:
+                rate_mb = report['bytes_per_second'] / (1024 * 1024)
+                print(f"\n📊 Shards reported: {report['shards']}/{report['shard_count']}, "
+                      f"videos: {report['successful']}/{report['videos']}, "
+                      f"aggregate throughput: {rate_mb:.1f} MB/s")
+        
+        if downloader.control.cancelled:
+            print(f"\n⏹️  Download cancelled; run the same command again to resume")
+            sys.exit(0)
         
         if result:
             if args.links_only:
@@ -1,16 +1,2007 @@
 
-import requests
+# Heavy modules (requests, asyncio, http.server, cProfile, ...) are imported
+# where they are used so that `import core` stays cheap for previews.
 import os
+import sys
 import logging
-import asyncio
-import aiohttp
+import logging.handlers
+import queue
+import atexit
 import json
 import hashlib
-from typing import Optional, Callable, Dict, List
-from concurrent.futures import ThreadPoolExecutor
+import math
+import threading
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from dataclasses import dataclass
+from typing import Optional, Callable, Dict, List, Tuple
 import time
 
 
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+THROUGHPUT_BUCKETS = tuple(2 ** n * 1024 for n in range(4, 18, 2))  # 16 KiB/s .. 128 MiB/s
+
+
+LOG_FORMAT = "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
+LOG_FIELDS = ("uid", "playlist_id", "title", "path", "bytes", "duration")
+
+_log_listener: Optional[logging.handlers.QueueListener] = None
+_log_config = None
+_log_lock = threading.Lock()
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """Format records as one JSON object per line, including structured extras"""
+
+    def format(self, record):
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for field in LOG_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+def configure_logging(log_level=logging.INFO, log_file=None, json_lines=False, console=None) -> logging.Logger:
+    """Route the AparatDownloader logger through a QueueHandler drained by a background listener
+
+    Handlers are only rebuilt when the configuration changes, so calling this
+    repeatedly (e.g. once per downloader) is cheap. `console` replaces
+    stderr as the console stream, e.g. to keep a progress display intact.
+    """
+    global _log_listener, _log_config
+    logger = logging.getLogger("AparatDownloader")
+    logger.setLevel(log_level)
+    config = (os.path.abspath(log_file) if log_file else None, json_lines, console)
+
+    with _log_lock:
+        if _log_config == config:
+            return logger
+
+        formatter = JsonLinesFormatter() if json_lines else logging.Formatter(LOG_FORMAT)
+        handlers = [logging.StreamHandler(console)]
+        if log_file:
+            os.makedirs(os.path.dirname(os.path.abspath(log_file)), exist_ok=True)
+            handlers.append(logging.FileHandler(log_file, encoding='utf-8', delay=True))
+        for handler in handlers:
+            handler.setFormatter(formatter)
+
+        if _log_listener:
+            _log_listener.stop()
+        for handler in logger.handlers[:]:
+            logger.removeHandler(handler)
+
+        log_queue = queue.SimpleQueue()
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        _log_listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _log_listener.start()
+        _log_config = config
+    return logger
+
+
+def logging_configured() -> bool:
+    return _log_config is not None
+
+
+@atexit.register
+def _stop_log_listener():
+    # Flush queued records before the interpreter exits
+    global _log_listener
+    if _log_listener:
+        _log_listener.stop()
+        _log_listener = None
+
+
+class Metrics:
+    """Thread-safe registry of counters, gauges and histograms"""
+
+    def __init__(self, prefix="aparat"):
+        self.prefix = prefix
+        self._lock = threading.Lock()
+        self._families = {}
+
+    def _register(self, name, kind, help_text, buckets=None):
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = {"type": kind, "help": help_text}
+                if kind == "histogram":
+                    family["buckets"] = tuple(buckets or LATENCY_BUCKETS)
+                    family["counts"] = [0] * len(family["buckets"])
+                    family["sum"] = 0.0
+                    family["count"] = 0
+                else:
+                    family["value"] = 0
+                self._families[name] = family
+            elif family["type"] != kind:
+                raise ValueError(f"Metric {name} already registered as {family['type']}")
+        return family
+
+    def counter(self, name, help_text=""):
+        self._register(name, "counter", help_text)
+
+    def gauge(self, name, help_text=""):
+        self._register(name, "gauge", help_text)
+
+    def histogram(self, name, help_text="", buckets=None):
+        self._register(name, "histogram", help_text, buckets)
+
+    def inc(self, name, value=1):
+        """Increment a counter or gauge"""
+        family = self._families.get(name) or self._register(name, "counter", "")
+        with self._lock:
+            family["value"] += value
+
+    def dec(self, name, value=1):
+        self.inc(name, -value)
+
+    def set(self, name, value):
+        """Set a gauge to an absolute value"""
+        family = self._families.get(name) or self._register(name, "gauge", "")
+        with self._lock:
+            family["value"] = value
+
+    def observe(self, name, value):
+        """Record a histogram sample"""
+        family = self._families.get(name) or self._register(name, "histogram", "")
+        with self._lock:
+            family["sum"] += value
+            family["count"] += 1
+            for i, bound in enumerate(family["buckets"]):
+                if value <= bound:
+                    family["counts"][i] += 1
+                    break
+
+    @contextmanager
+    def timer(self, name):
+        """Observe the wall time of the wrapped block in seconds"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def to_dict(self) -> Dict:
+        """Snapshot all metrics as plain JSON-serializable data"""
+        snapshot = {}
+        with self._lock:
+            for name, family in self._families.items():
+                if family["type"] == "histogram":
+                    snapshot[name] = {
+                        "type": "histogram",
+                        "count": family["count"],
+                        "sum": family["sum"],
+                        "buckets": dict(zip(map(str, family["buckets"]), family["counts"])),
+                    }
+                else:
+                    snapshot[name] = {"type": family["type"], "value": family["value"]}
+        return snapshot
+
+    def to_openmetrics(self) -> str:
+        """Render all metrics in the OpenMetrics text exposition format"""
+        lines = []
+        with self._lock:
+            for name, family in sorted(self._families.items()):
+                full_name = f"{self.prefix}_{name}"
+                lines.append(f"# TYPE {full_name} {family['type']}")
+                if family["help"]:
+                    lines.append(f"# HELP {full_name} {family['help']}")
+                if family["type"] == "counter":
+                    lines.append(f"{full_name}_total {family['value']}")
+                elif family["type"] == "gauge":
+                    lines.append(f"{full_name} {family['value']}")
+                else:
+                    cumulative = 0
+                    for bound, count in zip(family["buckets"], family["counts"]):
+                        cumulative += count
+                        lines.append(f'{full_name}_bucket{{le="{bound}"}} {cumulative}')
+                    lines.append(f'{full_name}_bucket{{le="+Inf"}} {family["count"]}')
+                    lines.append(f"{full_name}_sum {family['sum']}")
+                    lines.append(f"{full_name}_count {family['count']}")
+        lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, indent=2)
+
+
+def register_downloader_metrics(metrics: Metrics):
+    """Declare the metric families reported by AparatDownloader"""
+    metrics.histogram("playlist_fetch_seconds", "Latency of playlist metadata requests")
+    metrics.histogram("video_resolve_seconds", "Latency of per-video download link resolution")
+    metrics.histogram("head_seconds", "Latency of HEAD requests against the CDN")
+    metrics.histogram("ttfb_seconds", "Time to first body byte of a transfer")
+    metrics.histogram("transfer_seconds", "Wall time of completed transfers")
+    metrics.histogram("transfer_throughput_bytes_per_second", "Average throughput of completed transfers",
+                      buckets=THROUGHPUT_BUCKETS)
+    metrics.counter("bytes_written", "Bytes written to disk")
+    metrics.counter("writer_stall_seconds", "Time network readers waited for a free write buffer")
+    metrics.counter("resumes", "Transfers resumed from a partial file")
+    metrics.counter("retries", "Failed transfers retried with a freshly resolved link")
+    metrics.counter("downloads_completed", "Transfers finished successfully")
+    metrics.counter("downloads_failed", "Downloads that still failed after their retry")
+    metrics.counter("downloads_cancelled", "Transfers cancelled before finishing")
+    metrics.gauge("queue_depth", "Download tasks waiting for a concurrency slot")
+    metrics.gauge("active_downloads", "Transfers currently in progress")
+    metrics.gauge("disk_reserved_bytes", "Free space reserved for admitted downloads")
+    metrics.counter("downloads_skipped_no_space", "Downloads skipped because they did not fit in free space")
+    metrics.counter("downloads_skipped_budget", "Videos left out because they did not fit the size budget")
+    metrics.counter("downloads_skipped_claimed", "Downloads left to another worker that had claimed the file")
+    metrics.counter("metadata_requests", "Playlist and video metadata requests sent to the API")
+    metrics.counter("metadata_memo_hits", "Metadata calls answered from a recent identical request")
+    metrics.counter("metadata_coalesced", "Metadata calls that waited for an identical request in flight")
+
+
+def start_metrics_server(metrics: Metrics, port: int, host: str = "127.0.0.1"):
+    """Serve /metrics (OpenMetrics text) and /metrics.json from a daemon thread"""
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path == "/metrics":
+                body = metrics.to_openmetrics().encode()
+                content_type = "application/openmetrics-text; version=1.0.0; charset=utf-8"
+            elif self.path == "/metrics.json":
+                body = json.dumps(metrics.to_dict()).encode()
+                content_type = "application/json"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True)
+    thread.start()
+    return server
+
+
+class _NullSpan:
+    def __enter__(self):
+        return {}
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer:
+    """Collects Chrome trace-event spans; a disabled tracer records nothing"""
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._events = []
+        self._thread_names = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def span(self, name, **args):
+        """Context manager timing the block; yields a dict for extra span args"""
+        if not self.enabled:
+            return _NULL_SPAN
+        return self._span(name, args)
+
+    @contextmanager
+    def _span(self, name, args):
+        start = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.complete(name, start, time.perf_counter(), **args)
+
+    def complete(self, name, start, end, **args):
+        """Record a span from perf_counter timestamps on the calling thread"""
+        if not self.enabled:
+            return
+        thread = threading.current_thread()
+        event = {
+            "name": name,
+            "ph": "X",
+            "pid": self._pid,
+            "tid": thread.ident,
+            "ts": (start - self._origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "args": args,
+        }
+        with self._lock:
+            self._events.append(event)
+            self._thread_names.setdefault(thread.ident, thread.name)
+
+    def to_chrome_trace(self) -> Dict:
+        with self._lock:
+            metadata = [
+                {"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid, "args": {"name": name}}
+                for tid, name in self._thread_names.items()
+            ]
+            return {"traceEvents": metadata + list(self._events), "displayTimeUnit": "ms"}
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_chrome_trace(), f, ensure_ascii=False)
+
+
+class RunProfiler:
+    """Wraps a run in cProfile and tracemalloc, covering executor threads too
+
+    Before Python 3.12 a profile only sees the thread that enabled it, so
+    wrap() gives each executor call a profile of its own. From 3.12
+    cProfile hooks sys.monitoring, which is process-wide: the main profile
+    already sees every thread and a second one cannot be enabled, so wrap()
+    leaves calls alone. Profiling problems are logged and never fail the
+    profiled work.
+    """
+
+    THREADS_SEPARATE = sys.version_info < (3, 12)
+
+    def __init__(self, output_dir):
+        import cProfile
+
+        self.output_dir = output_dir
+        self._main_profile = cProfile.Profile()
+        self._main_enabled = False
+        self._thread_profiles = []
+        self._lock = threading.Lock()
+        self.logger = logging.getLogger("AparatDownloader")
+
+    def start(self):
+        import tracemalloc
+
+        tracemalloc.start()
+        try:
+            self._main_profile.enable()
+            self._main_enabled = True
+        except ValueError as e:
+            # e.g. a debugger or coverage tool already holds the profiling hook
+            self.logger.warning(f"CPU profiling unavailable: {e}")
+
+    def wrap(self, func):
+        """Return func profiled on the calling thread, where a separate profile per thread is needed"""
+        if not self.THREADS_SEPARATE:
+            return func
+
+        def profiled(*args, **kwargs):
+            import cProfile
+
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except ValueError:
+                return func(*args, **kwargs)
+            try:
+                return func(*args, **kwargs)
+            finally:
+                profile.disable()
+                with self._lock:
+                    self._thread_profiles.append(profile)
+        return profiled
+
+    def stop(self):
+        """Stop profiling and write profile.pstats, profile.txt and memory.txt"""
+        import pstats
+        import tracemalloc
+
+        if self._main_enabled:
+            self._main_profile.disable()
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stats = pstats.Stats()
+        with self._lock:
+            for profile in [self._main_profile] + self._thread_profiles:
+                try:
+                    stats.add(profile)
+                except TypeError:
+                    # A profile that never collected anything
+                    pass
+        stats.dump_stats(os.path.join(self.output_dir, "profile.pstats"))
+        with open(os.path.join(self.output_dir, "profile.txt"), 'w', encoding='utf-8') as f:
+            stats.stream = f
+            stats.sort_stats("cumulative").print_stats(40)
+
+        with open(os.path.join(self.output_dir, "memory.txt"), 'w', encoding='utf-8') as f:
+            f.write(f"current: {current} bytes\npeak: {peak} bytes\n\n")
+            for stat in snapshot.statistics("lineno")[:25]:
+                f.write(f"{stat}\n")
+
+
+FSYNC_POLICIES = ("none", "close", "interval")
+SCHEDULE_POLICIES = ("playlist", "largest-first", "smallest-first")
+
+
+def schedule_order(tasks: List[Dict], policy: str = "playlist") -> List[int]:
+    """Indices of `tasks` in the order they should start
+
+    "largest-first" keeps one big file from running alone at the end (a
+    shorter makespan), "smallest-first" finishes the most files early.
+    Tasks of unknown size start last under both.
+    """
+    if policy not in SCHEDULE_POLICIES:
+        raise ValueError(f"schedule policy must be one of {SCHEDULE_POLICIES}")
+    indices = list(range(len(tasks)))
+    if policy == "playlist":
+        return indices
+    largest = policy == "largest-first"
+    return sorted(indices, key=lambda i: (
+        not tasks[i].get('size'),
+        -(tasks[i].get('size') or 0) if largest else (tasks[i].get('size') or 0),
+    ))
+
+
+def _preallocate(file, size: int):
+    """Reserve `size` bytes for a new file so it is laid out contiguously where the OS allows"""
+    if not hasattr(os, "posix_fallocate"):
+        return
+    try:
+        os.posix_fallocate(file.fileno(), 0, size)
+    except OSError:
+        # Not supported by this filesystem; the file simply grows as it is written
+        pass
+
+
+def _fsync_directory(path: str):
+    """Make a rename inside `path` durable (no-op where directories cannot be opened)"""
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class FileWriter:
+    """Writes a file on a dedicated thread so disk stalls never block network reads
+
+    Readers copy chunks into buffers taken from a bounded pool of
+    `buffer_count` x `buffer_size` bytes; full buffers are flushed by the
+    writer thread. When the disk falls behind the pool runs dry and write()
+    blocks until a buffer is returned, which throttles the socket instead of
+    growing memory.
+
+    Writing starts at `offset` of an existing file when given, otherwise the
+    file is created and, if `preallocate` is set, reserved at that size up
+    front. `checkpoint(position)` is called from the writer thread to record
+    that everything up to `position` is in the file. What that promises
+    depends on `fsync_policy`:
+
+    - "none": never fsync. Checkpoints follow every `checkpoint_interval`
+      bytes once the data has reached the OS, so they survive the process
+      dying but not a power loss or OS crash.
+    - "close": fsync once before closing and checkpoint only then, so every
+      checkpoint is durable. A process killed mid-transfer resumes from the
+      last clean close (a pause, cancel or error), not from where it died.
+    - "interval": fsync every `fsync_interval` bytes and on close, with a
+      durable checkpoint after each fsync.
+
+    A close whose flush or fsync fails leaves the previous checkpoint.
+    """
+
+    def __init__(self, path: str, mode: str = 'wb', buffer_size: int = 1 << 20, buffer_count: int = 4,
+                 fsync_policy: str = "close", fsync_interval: int = 64 << 20,
+                 metrics: Optional[Metrics] = None, tracer: Optional[Tracer] = None,
+                 offset: int = 0, preallocate: Optional[int] = None,
+                 checkpoint: Optional[Callable[[int], None]] = None, checkpoint_interval: int = 8 << 20):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"fsync_policy must be one of {FSYNC_POLICIES}")
+        self.path = path
+        self.buffer_size = buffer_size
+        self.fsync_policy = fsync_policy
+        self.fsync_interval = fsync_interval
+        self.metrics = metrics
+        self.tracer = tracer or Tracer(enabled=False)
+        self.checkpoint = checkpoint
+        self.checkpoint_interval = checkpoint_interval
+        self.bytes_committed = offset  # file position up to which data has been handed to the OS
+        self._checkpointed = offset
+        if offset:
+            self._file = open(path, 'r+b')
+            self._file.seek(offset)
+        else:
+            self._file = open(path, mode)
+            if preallocate:
+                _preallocate(self._file, preallocate)
+        self._free = queue.Queue()
+        for _ in range(max(2, buffer_count)):
+            self._free.put(bytearray())
+        self._filled = queue.Queue()
+        self._current = self._free.get()
+        self._error = None
+        self._since_fsync = 0
+        self._thread = threading.Thread(target=self._run, name="writer", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._filled.get()
+            if item is None:
+                return
+            buffer, done = item
+            try:
+                if buffer and self._error is None:
+                    with self.tracer.span("write", bytes=len(buffer)):
+                        self._file.write(buffer)
+                        self._since_fsync += len(buffer)
+                        self.bytes_committed += len(buffer)
+                        # A checkpoint never points past bytes the policy has not made durable
+                        if self.fsync_policy == "interval":
+                            if self._since_fsync >= self.fsync_interval:
+                                self._fsync()
+                                self._checkpoint()
+                        elif self.fsync_policy == "none":
+                            if self.bytes_committed - self._checkpointed >= self.checkpoint_interval:
+                                self._file.flush()
+                                self._checkpoint()
+                    if self.metrics:
+                        self.metrics.inc("bytes_written", len(buffer))
+                if done is not None:
+                    self._file.flush()
+            except Exception as e:
+                self._error = e
+            finally:
+                buffer.clear()
+                self._free.put(buffer)
+                if done is not None:
+                    done.set()
+
+    def _fsync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._since_fsync = 0
+
+    def _checkpoint(self):
+        if self.checkpoint:
+            self.checkpoint(self.bytes_committed)
+            self._checkpointed = self.bytes_committed
+
+    def _check(self):
+        if self._error is not None:
+            raise self._error
+
+    def _hand_off(self, done=None):
+        self._filled.put((self._current, done))
+        start = time.perf_counter()
+        self._current = self._free.get()
+        if self.metrics:
+            self.metrics.inc("writer_stall_seconds", time.perf_counter() - start)
+
+    def write(self, chunk: bytes):
+        self._check()
+        self._current += chunk
+        if len(self._current) >= self.buffer_size:
+            self._hand_off()
+
+    def flush(self):
+        """Block until everything written so far has reached the OS"""
+        done = threading.Event()
+        self._hand_off(done)
+        done.wait()
+        self._check()
+
+    def close(self):
+        if self._thread.is_alive():
+            synced = False
+            try:
+                self.flush()
+                if self.fsync_policy != "none":
+                    self._fsync()
+                synced = True
+            finally:
+                self._filled.put(None)
+                self._thread.join()
+                self._file.close()
+                if synced:
+                    self._checkpoint()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+class LocalSink:
+    """Videos as files at their task paths (the default storage)
+
+    Bytes go to `<path>.part` through a FileWriter, with a `<path>.part.json`
+    sidecar recording how much of it holds real data, and the file is
+    renamed into place once complete.
+    """
+
+    local = True
+    resumable = True
+
+    def __init__(self, write_buffer_size: int = 1 << 20, write_buffers: int = 4, fsync_policy: str = "close",
+                 metrics: Optional[Metrics] = None, tracer: Optional[Tracer] = None):
+        self.write_buffer_size = write_buffer_size
+        self.write_buffers = write_buffers
+        self.fsync_policy = fsync_policy
+        self.metrics = metrics
+        self.tracer = tracer
+
+    @staticmethod
+    def load_resume_state(part_path: str) -> Optional[Dict]:
+        """Read the sidecar of a .part file, or None if missing or unreadable"""
+        try:
+            with open(part_path + ".json", 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def save_resume_state(part_path: str, state: Dict, durable: bool = False):
+        """Replace the sidecar atomically; `durable` also fsyncs it and its directory"""
+        temp_path = part_path + ".json.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(temp_path, part_path + ".json")
+        if durable:
+            _fsync_directory(os.path.dirname(os.path.abspath(part_path)))
+
+    def exists(self, path: str) -> bool:
+        # Only finished transfers are renamed into place
+        return os.path.exists(path)
+
+    def resume_offset(self, path: str, total_size: int) -> int:
+        # The .part file is preallocated, so only the sidecar knows how much is real data
+        part_path = path + ".part"
+        state = self.load_resume_state(part_path)
+        if state and os.path.exists(part_path) and state.get("size") == total_size:
+            return min(state.get("committed", 0), total_size)
+        return 0
+
+    def open(self, path: str, total_size: int, offset: int = 0) -> FileWriter:
+        part_path = path + ".part"
+
+        def checkpoint(position):
+            self.save_resume_state(part_path, {"size": total_size, "committed": position},
+                                   durable=self.fsync_policy != "none")
+
+        return FileWriter(
+            part_path, 'wb',
+            buffer_size=self.write_buffer_size,
+            buffer_count=self.write_buffers,
+            fsync_policy=self.fsync_policy,
+            metrics=self.metrics,
+            tracer=self.tracer,
+            offset=offset,
+            preallocate=total_size,
+            checkpoint=checkpoint,
+        )
+
+    def commit(self, path: str):
+        os.replace(path + ".part", path)
+        os.remove(path + ".part.json")
+        if self.fsync_policy != "none":
+            _fsync_directory(os.path.dirname(os.path.abspath(path)))
+
+    def close(self):
+        pass
+
+
+class _StreamWriter:
+    def __init__(self, sink, stream, process=None):
+        self.sink = sink
+        self.stream = stream
+        self.process = process
+
+    def write(self, chunk: bytes):
+        self.stream.write(chunk)
+        if self.sink.metrics:
+            self.sink.metrics.inc("bytes_written", len(chunk))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.process is None:
+            self.stream.flush()
+            self.sink.lock.release()
+            return False
+        if exc_type is not None:
+            self.process.kill()
+        try:
+            self.stream.close()
+        except BrokenPipeError:
+            pass
+        returncode = self.process.wait()
+        if exc_type is None and returncode:
+            raise IOError(f"sink command exited with status {returncode}")
+        return False
+
+
+class StreamSink:
+    """Every video streamed into one binary stream (stdout by default), one after another
+
+    A transfer holds the stream from open to close so videos never
+    interleave. Bytes cannot be taken back once written, so there is no
+    resume and a failed video is not retried.
+    """
+
+    local = False
+    resumable = False
+
+    def __init__(self, stream=None, metrics: Optional[Metrics] = None):
+        import sys
+
+        # The process's real stdout, even if sys.stdout was redirected for messages
+        self.stream = stream or sys.__stdout__.buffer
+        self.metrics = metrics
+        self.lock = threading.Lock()
+
+    def exists(self, path: str) -> bool:
+        return False
+
+    def resume_offset(self, path: str, total_size: int) -> int:
+        return 0
+
+    def open(self, path: str, total_size: int, offset: int = 0) -> _StreamWriter:
+        self.lock.acquire()
+        return _StreamWriter(self, self.stream)
+
+    def commit(self, path: str):
+        pass
+
+    def close(self):
+        # The stream belongs to the process, not to the sink
+        pass
+
+
+class PipeSink(StreamSink):
+    """Each video streamed into the stdin of its own run of a shell command
+
+    `{path}` and `{name}` in the command are replaced with the quoted task
+    path and file name, e.g. "ffmpeg -i - -c copy {path}.mkv".
+    """
+
+    def __init__(self, command: str, metrics: Optional[Metrics] = None):
+        super().__init__(metrics=metrics)
+        self.command = command
+
+    def open(self, path: str, total_size: int, offset: int = 0) -> _StreamWriter:
+        import shlex
+        import subprocess
+
+        command = self.command.format(path=shlex.quote(path), name=shlex.quote(os.path.basename(path)))
+        process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE)
+        return _StreamWriter(self, process.stdin, process)
+
+
+class _MultipartWriter:
+    def __init__(self, sink, path: str, total_size: int, offset: int):
+        self.sink = sink
+        self.key = sink.key(path)
+        self.state_path = path + ".part"
+        state = LocalSink.load_resume_state(self.state_path)
+        if state and offset:
+            self.upload_id = state["upload_id"]
+            self.part_number = offset // sink.part_size + 1
+        else:
+            if state and state.get("upload_id"):
+                # Starting over (e.g. the server ignored the range); drop the old upload's parts
+                sink.abort(path, state["upload_id"])
+            self.upload_id = sink.client.create_multipart_upload(Bucket=sink.bucket, Key=self.key)["UploadId"]
+            self.part_number = 1
+            LocalSink.save_resume_state(self.state_path, {"size": total_size, "upload_id": self.upload_id})
+        self._buffer = bytearray()
+
+    def _upload(self, body: bytes):
+        with self.sink.tracer.span("upload part", bytes=len(body)):
+            self.sink.client.upload_part(Bucket=self.sink.bucket, Key=self.key, UploadId=self.upload_id,
+                                         PartNumber=self.part_number, Body=body)
+        if self.sink.metrics:
+            self.sink.metrics.inc("bytes_written", len(body))
+        self.part_number += 1
+
+    def write(self, chunk: bytes):
+        self._buffer += chunk
+        if len(self._buffer) >= self.sink.part_size:
+            self._upload(bytes(self._buffer[:self.sink.part_size]))
+            del self._buffer[:self.sink.part_size]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # An interrupted transfer keeps only its full parts; resume continues after them
+        if exc_type is None and (self._buffer or self.part_number == 1):
+            self._upload(bytes(self._buffer))
+        self._buffer = bytearray()
+        return False
+
+
+class S3Sink:
+    """Videos uploaded to an S3-compatible bucket as multipart uploads, streamed as they download
+
+    Memory per transfer is bounded by `part_size` (at least 5 MB, the S3
+    minimum). The upload id is kept in a `<path>.part.json` sidecar under
+    the local destination, so an interrupted transfer resumes after its
+    last full part. Needs boto3; credentials and region come from the
+    usual AWS environment, and `endpoint_url` (or AWS_ENDPOINT_URL)
+    points it at MinIO or another S3-compatible server.
+    """
+
+    local = False
+    resumable = True
+
+    def __init__(self, bucket: str, prefix: str = "", root: str = ".", endpoint_url: Optional[str] = None,
+                 part_size: int = 8 << 20, metrics: Optional[Metrics] = None, tracer: Optional[Tracer] = None):
+        try:
+            import boto3
+        except ImportError:
+            raise RuntimeError("S3 storage needs boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix.strip("/")
+        self.root = root
+        self.part_size = max(part_size, 5 << 20)
+        self.metrics = metrics
+        self.tracer = tracer or Tracer(enabled=False)
+        self.client = boto3.client("s3", endpoint_url=endpoint_url or os.environ.get("AWS_ENDPOINT_URL"))
+
+    def key(self, path: str) -> str:
+        relative = os.path.relpath(path, self.root).replace(os.sep, "/")
+        return f"{self.prefix}/{relative}" if self.prefix else relative
+
+    def exists(self, path: str) -> bool:
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+            return True
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return False
+            raise
+
+    def _uploaded_parts(self, path: str, upload_id: str) -> List[Dict]:
+        parts = []
+        marker = 0
+        while True:
+            response = self.client.list_parts(Bucket=self.bucket, Key=self.key(path), UploadId=upload_id,
+                                              PartNumberMarker=marker)
+            parts.extend(response.get("Parts", []))
+            if not response.get("IsTruncated"):
+                return parts
+            marker = response["NextPartNumberMarker"]
+
+    def resume_offset(self, path: str, total_size: int) -> int:
+        from botocore.exceptions import ClientError
+
+        state = LocalSink.load_resume_state(path + ".part")
+        if not state or state.get("size") != total_size:
+            return 0
+        try:
+            parts = self._uploaded_parts(path, state["upload_id"])
+        except ClientError:
+            return 0  # the upload expired or was aborted
+        # Count the leading run of full parts; anything after it is uploaded again
+        numbers = {part["PartNumber"] for part in parts if part["Size"] == self.part_size}
+        count = 0
+        while count + 1 in numbers:
+            count += 1
+        return min(count * self.part_size, total_size)
+
+    def open(self, path: str, total_size: int, offset: int = 0) -> _MultipartWriter:
+        return _MultipartWriter(self, path, total_size, offset)
+
+    def abort(self, path: str, upload_id: str):
+        """Abort an unfinished multipart upload so its parts stop taking up storage"""
+        from botocore.exceptions import ClientError
+
+        try:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key(path), UploadId=upload_id)
+        except ClientError as e:
+            # Already completed, aborted or expired
+            logging.getLogger("AparatDownloader").debug(f"Could not abort upload {upload_id}: {e}")
+
+    def commit(self, path: str):
+        state = LocalSink.load_resume_state(path + ".part")
+        parts = self._uploaded_parts(path, state["upload_id"])
+        self.client.complete_multipart_upload(
+            Bucket=self.bucket, Key=self.key(path), UploadId=state["upload_id"],
+            MultipartUpload={"Parts": [{"PartNumber": part["PartNumber"], "ETag": part["ETag"]} for part in parts]},
+        )
+        os.remove(path + ".part.json")
+
+    def close(self):
+        self.client.close()
+
+
+def open_sink(spec: Optional[str], root: str = ".", **options):
+    """Storage for downloaded videos from a spec string
+
+    None or "local" writes files under the destination, "-" or "stdout"
+    streams to stdout, "pipe:COMMAND" streams each video into COMMAND and
+    "s3://bucket/prefix" uploads to S3. `options` are LocalSink settings;
+    metrics and tracer are passed to every sink.
+    """
+    metrics, tracer = options.get("metrics"), options.get("tracer")
+    if not spec or spec == "local":
+        return LocalSink(**options)
+    if spec in ("-", "stdout"):
+        return StreamSink(metrics=metrics)
+    if spec.startswith("pipe:"):
+        return PipeSink(spec[len("pipe:"):], metrics=metrics)
+    if spec.startswith("s3://"):
+        bucket, _, prefix = spec[len("s3://"):].partition("/")
+        return S3Sink(bucket, prefix, root=root, metrics=metrics, tracer=tracer)
+    raise ValueError(f"Unknown storage sink: {spec}")
+
+
+def format_size(num_bytes: float) -> str:
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(num_bytes) < 1024:
+            return f"{num_bytes:.1f} {unit}"
+        num_bytes /= 1024
+    return f"{num_bytes:.1f} TB"
+
+
+def format_duration(seconds: float) -> str:
+    seconds = int(round(seconds))
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{hours}:{minutes:02d}:{seconds:02d}" if hours else f"{minutes}:{seconds:02d}"
+
+
+def _allocated_bytes(path: str) -> int:
+    """Disk space actually taken by `path` (0 if missing)"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return 0
+    blocks = getattr(stat, "st_blocks", None)
+    return blocks * 512 if blocks is not None else stat.st_size
+
+
+class DiskSpaceGate:
+    """Admits downloads only while their expected size fits in free space
+
+    Each admitted task holds a reservation for the part of its size not yet
+    allocated on disk, so preallocated and partially written .part files are
+    never counted twice. `margin` bytes are always left free. A task that
+    does not fit is either skipped or, with `on_shortfall="wait"`, admitted
+    once enough space has been freed (checked every `poll_interval` seconds).
+    A task bigger than the whole volume, less the margin and the other
+    reservations, could never be admitted and is skipped even when waiting.
+    Tasks without a known size are admitted without a reservation.
+    """
+
+    def __init__(self, path: str, margin: int = 256 << 20, on_shortfall: str = "skip",
+                 poll_interval: float = 5.0, metrics: Optional[Metrics] = None):
+        if on_shortfall not in ("skip", "wait"):
+            raise ValueError("on_shortfall must be 'skip' or 'wait'")
+        self.path = path
+        self.margin = margin
+        self.on_shortfall = on_shortfall
+        self.poll_interval = poll_interval
+        self.metrics = metrics
+        self.skipped = 0
+        self._active: List[Dict] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def needed(task: Dict) -> int:
+        """Bytes the task still has to allocate before it is complete"""
+        if not task.get('size') or os.path.exists(task['path']):
+            return 0
+        return max(0, task['size'] - _allocated_bytes(task['path'] + ".part"))
+
+    def free_space(self) -> int:
+        import shutil
+
+        return shutil.disk_usage(self.path).free
+
+    def could_fit(self, task: Dict) -> bool:
+        """Whether the task fits once every byte not reserved by others is free"""
+        import shutil
+
+        with self._lock:
+            reserved = sum(self.needed(other) for other in self._active if other is not task)
+        return self.needed(task) <= shutil.disk_usage(self.path).total - self.margin - reserved
+
+    def _available(self) -> int:
+        reserved = sum(self.needed(task) for task in self._active)
+        if self.metrics:
+            self.metrics.set("disk_reserved_bytes", reserved)
+        return self.free_space() - self.margin - reserved
+
+    def available(self) -> int:
+        """Free space left after the margin and outstanding reservations"""
+        with self._lock:
+            return self._available()
+
+    def skip(self, task: Dict):
+        self.skipped += 1
+        if self.metrics:
+            self.metrics.inc("downloads_skipped_no_space")
+
+    def shortfall(self, tasks: List[Dict]) -> int:
+        """Bytes missing to fit all `tasks` at once (0 if they fit)"""
+        with self._lock:
+            return max(0, sum(self.needed(task) for task in tasks) - self._available())
+
+    def try_admit(self, task: Dict) -> bool:
+        needed = self.needed(task)
+        with self._lock:
+            if needed and needed > self._available():
+                return False
+            self._active.append(task)
+            return True
+
+    async def admit(self, task: Dict, cancelled: Optional[Callable[[], bool]] = None) -> bool:
+        """Reserve space for the task, returning False if it was skipped
+
+        While waiting for space, `cancelled()` is checked every 0.2 seconds;
+        once it returns True the task gives up its place and False is returned.
+        """
+        import asyncio
+
+        if self.try_admit(task):
+            return True
+        if self.on_shortfall == "skip" or not self.could_fit(task):
+            self.skip(task)
+            return False
+        while not self.try_admit(task):
+            if not self.could_fit(task):
+                self.skip(task)
+                return False
+            waited = 0.0
+            while waited < self.poll_interval:
+                if cancelled and cancelled():
+                    return False
+                await asyncio.sleep(0.2)
+                waited += 0.2
+        return True
+
+    def release(self, task: Dict):
+        with self._lock:
+            if task in self._active:
+                self._active.remove(task)
+
+
+class TransferInterrupted(Exception):
+    """Raised inside a transfer when it has to stop early"""
+
+
+class TransferPaused(TransferInterrupted):
+    pass
+
+
+class TransferCancelled(TransferInterrupted):
+    pass
+
+
+class TransferControl:
+    """Pause, resume and cancel flags for a whole run and for single videos (by uid)
+
+    Safe to call from any thread. Transfers poll check() between chunks, so
+    they stop within one chunk of a request.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.paused = False
+        self.cancelled = False
+        self._paused_uids = set()
+        self._cancelled_uids = set()
+
+    def pause(self, uid: Optional[str] = None):
+        with self._lock:
+            if uid is None:
+                self.paused = True
+            else:
+                self._paused_uids.add(uid)
+
+    def resume(self, uid: Optional[str] = None):
+        with self._lock:
+            if uid is None:
+                self.paused = False
+                self._paused_uids.clear()
+            else:
+                self._paused_uids.discard(uid)
+
+    def cancel(self, uid: Optional[str] = None):
+        with self._lock:
+            if uid is None:
+                self.cancelled = True
+            else:
+                self._cancelled_uids.add(uid)
+
+    def reset(self):
+        with self._lock:
+            self.paused = self.cancelled = False
+            self._paused_uids.clear()
+            self._cancelled_uids.clear()
+
+    def uid_state(self) -> Dict[str, List[str]]:
+        """Paused and cancelled uids, for mirroring into another process"""
+        with self._lock:
+            return {"paused": sorted(self._paused_uids), "cancelled": sorted(self._cancelled_uids)}
+
+    def set_uid_state(self, state: Dict[str, List[str]]):
+        with self._lock:
+            self._paused_uids = set(state.get("paused", ()))
+            self._cancelled_uids = set(state.get("cancelled", ()))
+
+    def is_paused(self, uid: Optional[str] = None) -> bool:
+        return self.paused or uid in self._paused_uids
+
+    def is_cancelled(self, uid: Optional[str] = None) -> bool:
+        return self.cancelled or uid in self._cancelled_uids
+
+    def check(self, uid: Optional[str] = None):
+        if self.is_cancelled(uid):
+            raise TransferCancelled(uid)
+        if self.is_paused(uid):
+            raise TransferPaused(uid)
+
+
+class ProgressTracker:
+    """Per-transfer and aggregate progress with throughput as an exponentially weighted moving average
+
+    Fed with status updates (the status_callback signature) from any
+    thread. Rates are sampled at most every `sample_interval` seconds and
+    smoothed with a time constant of `smoothing` seconds, so they follow
+    real changes within a few seconds without jumping on every chunk.
+    snapshot() returns plain dicts that are safe to hand to other threads.
+    """
+
+    ACTIVE_STATES = ("downloading", "paused")
+
+    def __init__(self, smoothing: float = 3.0, sample_interval: float = 0.5):
+        self.smoothing = smoothing
+        self.sample_interval = sample_interval
+        self.started = time.monotonic()
+        self.transfers: Dict[Tuple, Dict] = {}  # (uid, quality) -> transfer
+        self._lock = threading.Lock()
+        self._received = 0  # bytes transferred by this run, across transfers
+        self._aggregate = self._meter(0, self.started)
+
+    @staticmethod
+    def _meter(position: int, now: float) -> Dict:
+        return {"rate": None, "sampled_at": now, "sampled_bytes": position}
+
+    def _smooth(self, meter: Dict, position: int, now: float):
+        """Fold the bytes since the meter's last sample into its moving average"""
+        elapsed = now - meter["sampled_at"]
+        if elapsed < self.sample_interval:
+            return
+        rate = (position - meter["sampled_bytes"]) / elapsed
+        weight = 1 - math.exp(-elapsed / self.smoothing)
+        meter["rate"] = rate if meter["rate"] is None else meter["rate"] + weight * (rate - meter["rate"])
+        meter["sampled_at"], meter["sampled_bytes"] = now, position
+
+    def _transfer(self, uid: Optional[str], quality: Optional[str], title: Optional[str] = None) -> Dict:
+        transfer = self.transfers.get((uid, quality))
+        if transfer is None:
+            transfer = self.transfers[(uid, quality)] = dict(
+                self._meter(0, time.monotonic()),
+                uid=uid, quality=quality, title=title or uid, state="queued", downloaded=0, total=0,
+            )
+        return transfer
+
+    def title(self, uid: Optional[str], quality: Optional[str]) -> Optional[str]:
+        with self._lock:
+            transfer = self.transfers.get((uid, quality))
+        return transfer["title"] if transfer else uid
+
+    def add_tasks(self, tasks: List[Dict]):
+        """Register resolved tasks as queued so totals cover transfers that have not started"""
+        with self._lock:
+            for task in tasks:
+                transfer = self._transfer(task.get('uid'), task.get('quality'), task['title'])
+                transfer["total"] = transfer["total"] or task.get('size') or 0
+
+    def update(self, uid: Optional[str], quality: Optional[str], state: str, downloaded: int = 0, total: int = 0):
+        now = time.monotonic()
+        with self._lock:
+            transfer = self._transfer(uid, quality)
+            if total:
+                transfer["total"] = total
+            if state == "downloading":
+                if transfer["state"] != "downloading" or downloaded < transfer["downloaded"]:
+                    # Started, resumed or restarted: measure from here, not from byte 0
+                    transfer.update(self._meter(downloaded, now))
+                else:
+                    self._received += downloaded - transfer["downloaded"]
+                transfer["downloaded"] = downloaded
+                self._smooth(transfer, downloaded, now)
+            elif state == "completed" and transfer["total"]:
+                transfer["downloaded"] = transfer["total"]
+            transfer["state"] = state
+            self._smooth(self._aggregate, self._received, now)
+
+    def _rate(self, meter: Dict, now: float) -> float:
+        # A meter that stopped receiving decays toward zero instead of freezing
+        idle = max(0.0, now - meter["sampled_at"] - self.sample_interval)
+        return (meter["rate"] or 0.0) * math.exp(-idle / self.smoothing)
+
+    def _describe(self, transfer: Dict, now: float) -> Dict:
+        rate = self._rate(transfer, now) if transfer["state"] == "downloading" else 0.0
+        remaining = transfer["total"] - transfer["downloaded"]
+        description = {key: transfer[key] for key in ("uid", "quality", "title", "state", "downloaded", "total")}
+        description["rate"] = rate
+        description["eta"] = remaining / rate if rate > 0 and transfer["total"] else None
+        return description
+
+    def transfer(self, uid: Optional[str], quality: Optional[str]) -> Optional[Dict]:
+        """Snapshot of a single transfer, or None if it is unknown"""
+        with self._lock:
+            transfer = self.transfers.get((uid, quality))
+            return self._describe(transfer, time.monotonic()) if transfer else None
+
+    def snapshot(self, active_only: bool = False) -> Dict:
+        """Progress of every transfer (uid, quality, title, state, downloaded, total, rate, eta) and of the run"""
+        now = time.monotonic()
+        with self._lock:
+            self._smooth(self._aggregate, self._received, now)
+            transfers, states = [], {}
+            downloaded = total = 0
+            for transfer in self.transfers.values():
+                states[transfer["state"]] = states.get(transfer["state"], 0) + 1
+                downloaded += transfer["downloaded"]
+                total += transfer["total"]
+                if active_only and transfer["state"] not in self.ACTIVE_STATES:
+                    continue
+                transfers.append(self._describe(transfer, now))
+            rate = self._rate(self._aggregate, now)
+        return {
+            "elapsed": now - self.started,
+            "transfers": transfers,
+            "states": states,
+            "downloaded": downloaded,
+            "total": total,
+            "rate": rate,
+            "eta": (total - downloaded) / rate if rate > 0 and total else None,
+        }
+
+
+@dataclass(frozen=True)
+class DownloadEvent:
+    """Base class of the events yielded by AparatDownloader.run()"""
+
+
+@dataclass(frozen=True)
+class PlaylistResolved(DownloadEvent):
+    playlist_id: str
+    title: str
+    video_count: int
+
+
+@dataclass(frozen=True)
+class VideoResolved(DownloadEvent):
+    uid: str
+    quality: str
+    title: str
+    profile: str
+    size: Optional[int]
+    path: str
+
+
+@dataclass(frozen=True)
+class TransferStarted(DownloadEvent):
+    uid: str
+    quality: str
+    title: str
+    offset: int  # bytes already on disk when resuming
+    total: int
+
+
+@dataclass(frozen=True)
+class TransferProgress(DownloadEvent):
+    uid: str
+    quality: str
+    downloaded: int
+    total: int
+    rate: float
+    eta: Optional[float]
+
+
+@dataclass(frozen=True)
+class TransferCompleted(DownloadEvent):
+    uid: str
+    quality: str
+    title: str
+    size: int
+
+
+@dataclass(frozen=True)
+class TransferFailed(DownloadEvent):
+    uid: str
+    quality: str
+    title: str
+    reason: str  # "failed", "cancelled" or "skipped"
+
+
+@dataclass(frozen=True)
+class RunSummary(DownloadEvent):
+    result: bool
+    completed: int
+    failed: int
+    cancelled: int
+    skipped: int
+    downloaded: int
+    elapsed: float
+
+
+class EventStream:
+    """Bounded handoff of events from worker threads to one consumer on an event loop
+
+    Lifecycle events queue up to `maxsize`; a worker thread emitting into a
+    full stream waits for the consumer, so a slow consumer slows the run
+    down instead of growing memory. Progress never waits: only the latest
+    TransferProgress per transfer is kept until the consumer takes it.
+    Events emitted on the loop thread itself cannot wait (the consumer
+    runs there) and are queued regardless; they are bounded by the task list.
+    """
+
+    def __init__(self, loop, maxsize: int = 256):
+        import asyncio
+
+        self.maxsize = maxsize
+        self.closed = False
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._events = deque()
+        self._progress: Dict[Tuple, TransferProgress] = {}
+        self._condition = threading.Condition()
+        self._ready = asyncio.Event()
+        self._signalled = False
+
+    def emit(self, event: DownloadEvent):
+        """Queue an event; callable from any thread"""
+        with self._condition:
+            if self.closed:
+                return
+            if isinstance(event, TransferProgress):
+                self._progress[(event.uid, event.quality)] = event
+            else:
+                if threading.get_ident() != self._loop_thread:
+                    while len(self._events) >= self.maxsize and not self.closed:
+                        self._condition.wait()
+                    if self.closed:
+                        return
+                if isinstance(event, (TransferCompleted, TransferFailed)):
+                    # Never deliver a transfer's progress after its outcome
+                    self._progress.pop((event.uid, event.quality), None)
+                self._events.append(event)
+            if self._signalled:
+                return
+            self._signalled = True
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    async def get(self) -> Optional[DownloadEvent]:
+        """Next event, or None once the stream is closed and drained"""
+        while True:
+            with self._condition:
+                if self._events:
+                    self._condition.notify()
+                    return self._events.popleft()
+                if self._progress:
+                    return self._progress.pop(next(iter(self._progress)))
+                if self.closed:
+                    return None
+                self._signalled = False
+                self._ready.clear()
+            await self._ready.wait()
+
+    def close(self):
+        """Stop accepting events and release any waiting producer"""
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+
+def shard_of(uid: str, shard_count: int) -> int:
+    """Deterministic shard index of a video, stable across processes and machines"""
+    return int(hashlib.md5(uid.encode()).hexdigest(), 16) % shard_count
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except (PermissionError, OSError):
+        pass
+    return True
+
+
+class FileClaim:
+    """Exclusive claim on a path via an O_EXCL lock file, shared by cooperating processes
+
+    A lock left behind by a dead process on this host, or older than
+    `stale_after` seconds from another host, is taken over.
+    """
+
+    def __init__(self, path: str, stale_after: float = 3600):
+        import socket
+
+        self.lock_path = path + ".lock"
+        self.stale_after = stale_after
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid()}
+        self.acquired = False
+
+    def _is_stale(self) -> bool:
+        try:
+            with open(self.lock_path, 'r', encoding='utf-8') as f:
+                owner = json.load(f)
+            age = time.time() - os.path.getmtime(self.lock_path)
+        except FileNotFoundError:
+            return True
+        except (OSError, ValueError):
+            # Half-written lock file; only stale once it has aged
+            return time.time() - os.path.getmtime(self.lock_path) > self.stale_after
+        if owner.get("host") == self.owner["host"]:
+            return not _pid_alive(owner.get("pid", -1))
+        return age > self.stale_after
+
+    def acquire(self) -> bool:
+        for _ in range(2):
+            try:
+                fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if not self._is_stale():
+                    return False
+                try:
+                    os.remove(self.lock_path)
+                except FileNotFoundError:
+                    pass
+                continue
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self.owner, f)
+            self.acquired = True
+            return True
+        return False
+
+    def release(self):
+        if self.acquired:
+            self.acquired = False
+            try:
+                os.remove(self.lock_path)
+            except FileNotFoundError:
+                pass
+
+    def __enter__(self):
+        return self.acquire()
+
+    def __exit__(self, *exc):
+        self.release()
+        return False
+
+
+@contextmanager
+def locked_file(path: str, timeout: float = 30):
+    """Block until an exclusive FileClaim on path is held"""
+    claim = FileClaim(path, stale_after=timeout)
+    deadline = time.monotonic() + timeout
+    while not claim.acquire():
+        if time.monotonic() > deadline:
+            raise TimeoutError(f"Timed out waiting for lock on {path}")
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        claim.release()
+
+
+def write_shard_report(directory: str, shard, report: Dict):
+    """Store one shard's run statistics next to the playlist it downloaded
+
+    Reports live under .shards/<N>/<i>.json, so runs split N ways never mix
+    with other splits, and a shard's report replaces its previous run's.
+    """
+    shard_dir = os.path.join(directory, ".shards", str(shard[1]))
+    os.makedirs(shard_dir, exist_ok=True)
+    path = os.path.join(shard_dir, f"{shard[0]}.json")
+    temp_file = f"{path}.{os.getpid()}.tmp"
+    with open(temp_file, 'w', encoding='utf-8') as f:
+        json.dump(report, f)
+    os.replace(temp_file, path)
+
+
+def aggregate_shard_reports(directory: str, shard_count: int, since: float = 0) -> Optional[Dict]:
+    """Combine the reports of a run split `shard_count` ways into aggregate throughput
+
+    Only reports that finished after `since` (the start of the current run)
+    count, so leftovers of earlier runs with the same split are ignored.
+    """
+    shard_dir = os.path.join(directory, ".shards", str(shard_count))
+    if not os.path.isdir(shard_dir):
+        return None
+    reports = []
+    for name in sorted(os.listdir(shard_dir)):
+        if name.endswith(".json"):
+            try:
+                with open(os.path.join(shard_dir, name), 'r', encoding='utf-8') as f:
+                    report = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if report.get("shard_count") == shard_count and report.get("finished", 0) >= since:
+                reports.append(report)
+    if not reports:
+        return None
+    started = min(r["started"] for r in reports)
+    finished = max(r["finished"] for r in reports)
+    total_bytes = sum(r["bytes"] for r in reports)
+    return {
+        "shards": len(reports),
+        "shard_count": shard_count,
+        "videos": sum(r["videos"] for r in reports),
+        "successful": sum(r["successful"] for r in reports),
+        "bytes": total_bytes,
+        "seconds": finished - started,
+        "bytes_per_second": total_bytes / (finished - started) if finished > started else 0.0,
+    }
+
+
+API_BASE = os.environ.get("APARAT_API_BASE", "https://www.aparat.com/api/fa/v1")
+PLAN_VERSION = 1
+# Assumed lifetime of a CDN link that carries no expiry parameter of its own
+DEFAULT_LINK_TTL = 6 * 3600
+# Channel listings; both answer with JSON:API pages chained through links.next
+CHANNEL_PLAYLISTS_PATH = "/video/playlist/list/username/{username}"
+CHANNEL_VIDEOS_PATH = "/video/video/list/username/{username}"
+CHANNEL_PREFIX = "channel:"
+
+
+def channel_id(username: str) -> str:
+    """Playlist ID under which a whole channel is planned and recorded in history"""
+    return f"{CHANNEL_PREFIX}{username}"
+
+
+def link_expiry(url: str, resolved_at: float) -> float:
+    """Best-effort expiry timestamp of a download link"""
+    from urllib.parse import parse_qs, urlparse
+
+    query = parse_qs(urlparse(url).query)
+    for name in ("expires", "Expires", "expire", "e"):
+        value = query.get(name, [""])[0]
+        if value.isdigit():
+            return float(value)
+    return resolved_at + DEFAULT_LINK_TTL
+
+
+class SingleFlight:
+    """Shares identical calls between threads: one call in flight per key, results memoized for `ttl` seconds
+
+    Callers asking for a key that is being fetched wait for that fetch
+    instead of repeating it. Errors reach the callers of that fetch but are
+    not memoized. Memoized results are shared, so callers must not modify
+    them. `stats` counts calls made, memo hits and coalesced waits.
+    """
+
+    def __init__(self, ttl: float = 60, max_entries: int = 4096):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.stats = {"call": 0, "hit": 0, "coalesced": 0}
+        self._lock = threading.Lock()
+        self._flights: Dict = {}  # key -> [done event, result, error]
+        self._memo: Dict = {}  # key -> (expires_at, result)
+
+    def do(self, key, fn: Callable, fresh: bool = False) -> Tuple[object, str]:
+        """Result of fn() for `key` and how it was obtained: "call", "hit" or "coalesced"
+
+        With `fresh` the memo is skipped; a call already in flight is still shared.
+        """
+        with self._lock:
+            memo = None if fresh else self._memo.get(key)
+            if memo and memo[0] > time.monotonic():
+                self.stats["hit"] += 1
+                return memo[1], "hit"
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = [threading.Event(), None, None]
+            self.stats["call" if leader else "coalesced"] += 1
+
+        if not leader:
+            flight[0].wait()
+            if flight[2] is not None:
+                raise flight[2]
+            return flight[1], "coalesced"
+
+        try:
+            flight[1] = fn()
+        except BaseException as e:
+            flight[2] = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+                if flight[2] is None and self.ttl > 0:
+                    if len(self._memo) >= self.max_entries:
+                        self._prune()
+                    self._memo[key] = (time.monotonic() + self.ttl, flight[1])
+            flight[0].set()
+        return flight[1], "call"
+
+    def _prune(self):
+        """Drop expired entries, then the oldest ones, to make room; called with the lock held"""
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._memo.items() if expires_at <= now]:
+            del self._memo[key]
+        while len(self._memo) >= self.max_entries:
+            del self._memo[next(iter(self._memo))]
+
+    def forget(self, key=None):
+        """Drop one memoized result, or all of them"""
+        with self._lock:
+            if key is None:
+                self._memo.clear()
+            else:
+                self._memo.pop(key, None)
+
+
+# Shared by every AparatClient of the process, so jobs, previews and
+# playlists with videos in common send each metadata request once
+METADATA_FLIGHTS = SingleFlight()
+FLIGHT_METRICS = {"call": "metadata_requests", "hit": "metadata_memo_hits", "coalesced": "metadata_coalesced"}
+
+
+class AparatClient:
+    """Lean Aparat API client for metadata calls; does no filesystem setup
+
+    Playlist and video lookups go through `flights` (the process-wide
+    METADATA_FLIGHTS by default), so identical concurrent or recent calls
+    share one request.
+    """
+
+    def __init__(self, api_base: str = API_BASE, metrics: Optional[Metrics] = None,
+                 tracer: Optional[Tracer] = None, pool_size: int = 32, flights: Optional[SingleFlight] = None):
+        self.api_base = api_base.rstrip("/")
+        self.flights = flights or METADATA_FLIGHTS
+        self.metrics = metrics or Metrics()
+        self.tracer = tracer or Tracer(enabled=False)
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        """Shared requests.Session, created on first use so connections stay warm"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    import requests
+                    from requests.adapters import HTTPAdapter
+
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+                    session.mount("https://", adapter)
+                    session.mount("http://", adapter)
+                    self._session = session
+        return self._session
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+
+    def _shared(self, key, fn: Callable, fresh: bool = False):
+        result, outcome = self.flights.do((self.api_base,) + key, fn, fresh)
+        self.metrics.inc(FLIGHT_METRICS[outcome])
+        return result
+
+    def get_playlist_info(self, playlist_id, fresh: bool = False) -> Dict:
+        """Fetch playlist title and videos; raises on network or API errors
+
+        A recent result is reused unless `fresh` is set.
+        """
+        return self._shared(("playlist", str(playlist_id)), lambda: self._fetch_playlist_info(playlist_id), fresh)
+
+    def _fetch_playlist_info(self, playlist_id) -> Dict:
+        api_url = f"{self.api_base}/video/playlist/one/playlist_id/{playlist_id}"
+        with self.tracer.span("playlist fetch", playlist_id=playlist_id), self.metrics.timer("playlist_fetch_seconds"):
+            response = self.session.get(api_url)
+            data = response.json()
+        return self._playlist_info(playlist_id, data)
+
+    def get_playlist_info_if_changed(self, playlist_id, validators: Optional[Dict] = None) -> Tuple[Optional[Dict], Dict]:
+        """Conditionally fetch a playlist, returning (info, validators) or (None, validators) when unchanged
+
+        `validators` holds the "etag" and "last_modified" of an earlier
+        response, sent back as If-None-Match / If-Modified-Since.
+        """
+        validators = validators or {}
+        headers = {}
+        if validators.get("etag"):
+            headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            headers["If-Modified-Since"] = validators["last_modified"]
+        api_url = f"{self.api_base}/video/playlist/one/playlist_id/{playlist_id}"
+        with self.tracer.span("playlist poll", playlist_id=playlist_id), self.metrics.timer("playlist_fetch_seconds"):
+            response = self.session.get(api_url, headers=headers)
+            if response.status_code == 304:
+                return None, validators
+            data = response.json()
+        fresh = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        return self._playlist_info(playlist_id, data), fresh
+
+    @staticmethod
+    def _playlist_info(playlist_id, data: Dict) -> Dict:
+        videos = data["included"]
+        playlist_title = data["data"]["attributes"]["title"]
+
+        video_count = len([v for v in videos if v["type"] == "Video"])
+
+        return {
+            "playlist_id": playlist_id,
+            "title": playlist_title,
+            "video_count": video_count,
+            "videos": videos,
+            "raw_data": data
+        }
+
+    def get_video_download_urls(self, video_uid, fresh: bool = False) -> List[Dict]:
+        """Get the download links of every quality profile of a video
+
+        A recent result is reused unless `fresh` is set, e.g. to replace an expired link.
+        """
+        return self._shared(("video", str(video_uid)), lambda: self._fetch_video_download_urls(video_uid), fresh)
+
+    def _fetch_video_download_urls(self, video_uid) -> List[Dict]:
+        video_url = f"{self.api_base}/video/video/show/videohash/{video_uid}"
+        with self.tracer.span("resolve", uid=video_uid), self.metrics.timer("video_resolve_seconds"):
+            video_response = self.session.get(video_url)
+            video_data = video_response.json()
+        return video_data["data"]["attributes"]["file_link_all"]
+
+    def _pages(self, api_url: str) -> List[Dict]:
+        """Items of every page of a listing, following links.next"""
+        items, seen = [], set()
+        while api_url and api_url not in seen:
+            seen.add(api_url)
+            data = self.session.get(api_url).json()
+            items.extend(data.get("data") or [])
+            api_url = (data.get("links") or {}).get("next")
+        return items
+
+    def get_channel_playlists(self, username: str) -> List[Dict]:
+        """Playlists of a channel as {"playlist_id", "title"} dicts, in channel order"""
+        api_url = self.api_base + CHANNEL_PLAYLISTS_PATH.format(username=username)
+        with self.tracer.span("channel playlists", username=username), self.metrics.timer("playlist_fetch_seconds"):
+            items = self._pages(api_url)
+        return [
+            {"playlist_id": str(item["id"]), "title": (item.get("attributes") or {}).get("title", "")}
+            for item in items if item.get("type", "Playlist") == "Playlist"
+        ]
+
+    def get_channel_videos(self, username: str) -> List[Dict]:
+        """Videos uploaded by a channel, shaped like the video entries of a playlist"""
+        api_url = self.api_base + CHANNEL_VIDEOS_PATH.format(username=username)
+        with self.tracer.span("channel videos", username=username), self.metrics.timer("playlist_fetch_seconds"):
+            items = self._pages(api_url)
+        return [item for item in items if item.get("type") == "Video"]
+
+    def get_channel_info(self, username: str, include_videos: bool = False, concurrency: int = 8) -> Dict:
+        """Fetch every playlist of a channel, and optionally its loose videos, as one playlist
+
+        Playlist details are fetched `concurrency` at a time. A video held by
+        several playlists is listed once, under the first of them; its
+        "folder" key names that playlist. Loose videos have no folder. A
+        playlist that fails to load is logged and left out.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        logger = logging.getLogger("AparatDownloader")
+        playlists = self.get_channel_playlists(username)
+
+        def fetch(playlist):
+            try:
+                return self.get_playlist_info(playlist["playlist_id"])
+            except Exception as e:
+                logger.warning(f"Skipping playlist {playlist['playlist_id']} of channel {username}: {e}",
+                               extra={"playlist_id": playlist["playlist_id"]})
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(playlists))), thread_name_prefix="channel") as pool:
+            infos = [info for info in pool.map(fetch, playlists) if info]
+
+        videos, seen, duplicates = [], set(), 0
+        for info in infos:
+            for video in info["videos"]:
+                if video["type"] != "Video":
+                    continue
+                if video["attributes"]["uid"] in seen:
+                    duplicates += 1
+                    continue
+                seen.add(video["attributes"]["uid"])
+                videos.append(dict(video, folder=info["title"]))
+        if include_videos:
+            for video in self.get_channel_videos(username):
+                if video["attributes"]["uid"] not in seen:
+                    seen.add(video["attributes"]["uid"])
+                    videos.append(video)
+
+        return {
+            "playlist_id": channel_id(username),
+            "title": username,
+            "video_count": len(videos),
+            "videos": videos,
+            "playlists": [
+                {"playlist_id": info["playlist_id"], "title": info["title"], "video_count": info["video_count"]}
+                for info in infos
+            ],
+            "duplicates": duplicates,
+        }
+
+    def probe_size(self, url: str) -> Optional[int]:
+        """Content length of a download link from a HEAD request, or None if unknown"""
+        with self.tracer.span("head"), self.metrics.timer("head_seconds"):
+            response = self.session.head(url, allow_redirects=True)
+        if response.status_code != 200 or "content-length" not in response.headers:
+            return None
+        return int(response.headers["content-length"])
+
+
+def profile_height(profile: str) -> int:
+    """Vertical resolution of a profile name such as "720p" (0 if it has none)"""
+    digits = ""
+    for c in profile:
+        if not c.isdigit():
+            break
+        digits += c
+    return int(digits) if digits else 0
+
+
+class QualitySelector:
+    """Chooses one download link per video
+
+    Profiles outside `min_quality`..`max_quality` are never chosen. Without
+    a budget each video gets the first profile of `preference` it offers,
+    falling back to the highest remaining one. With a `budget` in bytes the
+    sizes of every candidate profile are probed concurrently and the whole
+    playlist starts at its lowest candidates; upgrades are then applied
+    cheapest-per-resolution-step first while they still fit, so the budget
+    buys as much resolution as possible. `preference`, when given in budget
+    mode, limits which profiles are considered.
+    """
+
+    def __init__(self, preference: Optional[List[str]] = None, min_quality: Optional[int] = None,
+                 max_quality: Optional[int] = None, budget: Optional[int] = None,
+                 client: Optional[AparatClient] = None, concurrency: int = 8):
+        self.preference = [str(q).rstrip("p") for q in preference or []]
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.budget = budget
+        self.client = client
+        self.concurrency = concurrency
+        # Indices of the videos the last select() left out to stay within the budget
+        self.dropped: List[int] = []
+        self.logger = logging.getLogger("AparatDownloader")
+
+    def in_bounds(self, link: Dict) -> bool:
+        height = profile_height(link["profile"])
+        if self.min_quality and height < self.min_quality:
+            return False
+        return not (self.max_quality and height > self.max_quality)
+
+    def candidates(self, links: List[Dict]) -> List[Dict]:
+        """Links within bounds, in order of preference"""
+        links = [link for link in links or [] if self.in_bounds(link)]
+        rank = {quality: index for index, quality in enumerate(self.preference)}
+        return sorted(links, key=lambda link: (
+            rank.get(str(profile_height(link["profile"])), len(rank)),
+            -profile_height(link["profile"]),
+        ))
+
+    def pick(self, links: List[Dict]) -> Optional[Dict]:
+        candidates = self.candidates(links)
+        return candidates[0] if candidates else None
+
+    def select(self, link_lists: List[Optional[List[Dict]]]) -> List[Tuple[Optional[Dict], Optional[int]]]:
+        """Choose a link for every video, returning (link, size) pairs in the same order
+
+        Sizes are only known (not None) when a budget made probing necessary.
+        """
+        if self.budget is None:
+            return [(self.pick(links), None) for links in link_lists]
+        return self._select_within_budget(link_lists)
+
+    def probe_sizes(self, urls: List[str]) -> Dict[str, Optional[int]]:
+        from concurrent.futures import ThreadPoolExecutor
+
+        def probe(url):
+            try:
+                return self.client.probe_size(url)
+            except Exception as e:
+                self.logger.warning(f"Could not probe size of {url}: {e}")
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency), thread_name_prefix="probe") as pool:
+            return dict(zip(urls, pool.map(probe, urls)))
+
+    def _select_within_budget(self, link_lists):
+        import heapq
+
+        # Candidates per video from lowest to highest resolution
+        ladders = []
+        for links in link_lists:
+            candidates = [link for link in links or [] if self.in_bounds(link)]
+            if self.preference:
+                candidates = [link for link in candidates if str(profile_height(link["profile"])) in self.preference]
+            ladders.append(sorted(candidates, key=lambda link: profile_height(link["profile"])))
+
+        sizes = self.probe_sizes([link["urls"][0] for ladder in ladders for link in ladder])
+        # A profile of unknown size cannot be budgeted; keep it only if it is the sole choice
+        ladders = [
+            [link for link in ladder if sizes[link["urls"][0]] is not None] or ladder[:1]
+            for ladder in ladders
+        ]
+
+        def size_of(link):
+            return sizes[link["urls"][0]] or 0
+
+        levels = [0] * len(ladders)
+        # Every video starts at its lowest quality; in playlist order, ones that no longer fit are left out
+        spent = 0
+        self.dropped = []
+        for index, ladder in enumerate(ladders):
+            if not ladder:
+                continue
+            if spent + size_of(ladder[0]) > self.budget:
+                self.dropped.append(index)
+                ladders[index] = []
+                continue
+            spent += size_of(ladder[0])
+        if self.dropped:
+            self.logger.warning(
+                f"Even the lowest allowed qualities do not fit the {format_size(self.budget)} budget; "
+                f"leaving out {len(self.dropped)} videos"
+            )
+
+        def upgrade(index):
+            ladder, level = ladders[index], levels[index]
+            cost = size_of(ladder[level + 1]) - size_of(ladder[level])
+            gain = profile_height(ladder[level + 1]["profile"]) - profile_height(ladder[level]["profile"])
+            return (cost / max(gain, 1), cost, index)
+
+        heap = [upgrade(index) for index, ladder in enumerate(ladders) if len(ladder) > 1]
+        heapq.heapify(heap)
+        while heap:
+            _, cost, index = heapq.heappop(heap)
+            if spent + cost > self.budget:
+                # The budget only shrinks from here, so this video stays where it is
+                continue
+            spent += cost
+            levels[index] += 1
+            if levels[index] + 1 < len(ladders[index]):
+                heapq.heappush(heap, upgrade(index))
+
+        self.logger.info(f"Quality selection uses {format_size(spent)} of the {format_size(self.budget)} budget")
+        return [
+            (ladder[level], sizes[ladder[level]["urls"][0]]) if ladder else (None, None)
+            for ladder, level in zip(ladders, levels)
+        ]
+
+
 class AparatDownloader:
     def __init__(
         self,
@@ -21,300 +2012,1891 @@ class AparatDownloader:
         progress_callback: Optional[Callable] = None,
         max_concurrent_downloads=3,
         auto_quality=False,
+        metrics: Optional[Metrics] = None,
+        metrics_file: Optional[str] = None,
+        tracer: Optional[Tracer] = None,
+        profiler: Optional[RunProfiler] = None,
+        client: Optional[AparatClient] = None,
+        resolve_concurrency=8,
+        shard=None,
+        claim_files=False,
+        processes=1,
+        write_buffer_size=1 << 20,
+        write_buffers=4,
+        fsync_policy="close",
+        space_margin=256 << 20,
+        on_low_space="skip",
+        quality_preference=None,
+        min_quality=None,
+        max_quality=None,
+        size_budget=None,
+        qualities=None,
+        schedule="playlist",
+        tasks_callback: Optional[Callable] = None,
+        status_callback: Optional[Callable] = None,
+        sink: Optional[str] = None,
+        channel: Optional[str] = None,
+        channel_videos=False,
     ):
-        self.playlist_id = playlist_id
+        # A channel is downloaded as one playlist holding all of its playlists
+        self.channel = channel
+        self.channel_videos = channel_videos
+        self.playlist_id = channel_id(channel) if channel and not playlist_id else playlist_id
         self.quality = quality
         self.for_download_manager = for_download_manager
         self.destination_path = destination_path
         self.progress_callback = progress_callback
         self.max_concurrent_downloads = max_concurrent_downloads
         self.auto_quality = auto_quality
+        self.resolve_concurrency = resolve_concurrency
+        self.shard = tuple(shard) if shard else None  # (index, count)
+        # Lock each file while writing it, for workers sharing a destination without (or across) shards
+        self.claim_files = claim_files or bool(self.shard)
+        self.processes = processes
+        self.write_buffer_size = write_buffer_size
+        self.write_buffers = write_buffers
+        self.fsync_policy = fsync_policy
+        self.space_margin = space_margin
+        self.on_low_space = on_low_space
+        self.quality_preference = quality_preference
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.size_budget = size_budget
+        # Quality variants downloaded side by side; "auto" means best available
+        self.qualities = [str(q) for q in qualities] if qualities else ['auto' if auto_quality else str(quality)]
+        self.schedule = schedule
+        # tasks_callback(tasks) announces the resolved task list;
+        # status_callback(uid, quality, state, downloaded, total) follows each one
+        self.tasks_callback = tasks_callback
+        self.status_callback = status_callback
+        self.progress = ProgressTracker()
+        self.control = TransferControl()
+        self.space_gate = None
+        self.playlist_title = None
+        self.metrics = metrics or Metrics()
+        self.metrics_file = metrics_file
+        register_downloader_metrics(self.metrics)
+        self.tracer = tracer or Tracer(enabled=False)
+        self.profiler = profiler
+        # A client passed in is shared with others and left open by close()
+        self._owns_client = client is None
+        self.client = client or AparatClient(metrics=self.metrics, tracer=self.tracer)
+        # Where video bytes go; see open_sink for the spec format
+        self.sink_spec = sink
+        self.sink = open_sink(
+            sink, destination_path,
+            write_buffer_size=write_buffer_size, write_buffers=write_buffers, fsync_policy=fsync_policy,
+            metrics=self.metrics, tracer=self.tracer,
+        )
         self.current_directory = os.getcwd()
-        self.logger = self.setup_logger()
+        # Log file, history and destination directory are set up lazily on first download
+        self.logger = logging.getLogger("AparatDownloader")
         self.history_file = os.path.join(destination_path, ".download_history.json")
-        self.download_history = self.load_download_history()
+        self._download_history = None
+
+    def close(self):
+        """Release the connections this downloader opened itself"""
+        self.sink.close()
+        if self._owns_client:
+            self.client.close()
+
+    def pause(self, uid: Optional[str] = None):
+        """Pause the whole run, or one video; partial data is flushed so resume continues at the same byte"""
+        self.control.pause(uid)
+
+    def resume(self, uid: Optional[str] = None):
+        self.control.resume(uid)
+
+    def cancel(self, uid: Optional[str] = None):
+        """Cancel the whole run, or one video; .part files are kept for a later run"""
+        self.control.cancel(uid)
+
+    @property
+    def download_history(self) -> Dict:
+        if self._download_history is None:
+            self._download_history = self.load_download_history()
+        return self._download_history
+
+    @download_history.setter
+    def download_history(self, value: Dict):
+        self._download_history = value
+
+    def prepare_destination(self):
+        """Create the destination directory and start file logging if nothing configured it yet"""
+        os.makedirs(self.destination_path, exist_ok=True)
+        if not logging_configured():
+            self.setup_logger()
+
+    def setup_logger(self, log_level=logging.INFO, log_to_file=True, json_lines=False):
+        log_file = os.path.join(self.destination_path, "downloader.log") if log_to_file else None
+        return configure_logging(log_level, log_file, json_lines)
+
+    def load_download_history(self) -> Dict:
+        """Load download history to avoid duplicates"""
+        try:
+            if os.path.exists(self.history_file):
+                with open(self.history_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Could not load download history: {e}")
+        return {}
+
+    def save_download_history(self):
+        """Save download history, merging entries written meanwhile by other processes"""
+        try:
+            with locked_file(self.history_file):
+                history = self.load_download_history()
+                history.update(self.download_history)
+                self.download_history = history
+                temp_file = f"{self.history_file}.{os.getpid()}.tmp"
+                with open(temp_file, 'w', encoding='utf-8') as f:
+                    json.dump(history, f, ensure_ascii=False, indent=2)
+                os.replace(temp_file, self.history_file)
+        except Exception as e:
+            self.logger.error(f"Could not save download history: {e}")
+
+    def get_file_hash(self, file_path: str) -> str:
+        """Generate hash for partial download tracking"""
+        return hashlib.md5(file_path.encode()).hexdigest()
+
+    def is_download_complete(self, file_path: str) -> bool:
+        """Check if download is complete
+
+        Sinks only publish a video once its transfer has finished, so the
+        video existing in the sink is enough.
+        """
+        return self.sink.exists(file_path)
+
+    def report_status(self, uid: Optional[str], quality: Optional[str], state: str, downloaded: int = 0, total: int = 0):
+        """Record a transfer state change and pass it to status_callback, if one is set"""
+        self.progress.update(uid, quality, state, downloaded, total)
+        if self.status_callback:
+            self.status_callback(uid, quality, state, downloaded, total)
+
+    def download_video_with_resume(self, video_url: str, output_path: str, video_title: str = "", video_uid: str = None,
+                                   video_quality: str = None, total_size: Optional[int] = None):
+        """Download video with resume capability
+
+        `total_size` is the size already probed for this link; without it
+        the size is taken from a HEAD request.
+        """
+        log_fields = {"uid": video_uid, "playlist_id": self.playlist_id, "title": video_title, "path": output_path}
+        try:
+            # Check if already downloaded
+            if self.is_download_complete(output_path):
+                self.logger.info(f"File already downloaded: {video_title}", extra=log_fields)
+                return True
+
+            # Get file size first, unless resolution already probed it
+            if not total_size:
+                with self.tracer.span("head", title=video_title), self.metrics.timer("head_seconds"):
+                    head_response = self.client.session.head(video_url, allow_redirects=True)
+                total_size = int(head_response.headers.get('content-length', 0))
+
+            # Check for partial download
+            resume_pos = self.sink.resume_offset(output_path, total_size)
+            if total_size and resume_pos >= total_size:
+                # Every byte arrived before the last run stopped (e.g. between
+                # close and rename); a range past the end would only get a 416
+                self.sink.commit(output_path)
+                self.logger.info(f"File already complete: {video_title}", extra=log_fields)
+                return True
+
+            # Set up headers for resume
+            headers = {}
+            if resume_pos > 0:
+                headers['Range'] = f'bytes={resume_pos}-'
+                self.metrics.inc("resumes")
+                self.logger.info(f"Resuming download from byte {resume_pos}: {video_title}", extra=log_fields)
+
+            # Download with resume
+            transfer_start = time.perf_counter()
+            with self.client.session.get(video_url, headers=headers, stream=True) as response:
+                if response.status_code in [200, 206]:  # 206 is partial content
+                    if response.status_code == 200 and resume_pos > 0:
+                        self.logger.info(f"Server ignored the range request, restarting: {video_title}", extra=log_fields)
+                        resume_pos = 0
+                    first_chunk = True
+
+                    # Bytes stream straight from the response into the sink
+                    writer = self.sink.open(output_path, total_size, resume_pos)
+                
+                    with self.tracer.span("transfer", title=video_title) as span_args, writer:
+                        downloaded = resume_pos
+                        self.report_status(video_uid, video_quality, "downloading", downloaded, total_size)
+                    
+                        for chunk in response.iter_content(chunk_size=65536):
+                            self.control.check(video_uid)
+                            if chunk:
+                                if first_chunk:
+                                    self.metrics.observe("ttfb_seconds", time.perf_counter() - transfer_start)
+                                    first_chunk = False
+                                writer.write(chunk)
+                                downloaded += len(chunk)
+                            
+                                # Progress callback
+                                if self.progress_callback and total_size > 0:
+                                    progress = (downloaded / total_size) * 100
+                                    self.progress_callback(video_title, progress, downloaded, total_size)
+                                self.report_status(video_uid, video_quality, "downloading", downloaded, total_size)
+
+                        span_args["bytes"] = downloaded - resume_pos
+
+                    if total_size and downloaded != total_size:
+                        raise IOError(f"transfer ended at byte {downloaded} of {total_size}")
+                    self.sink.commit(output_path)
+
+                    elapsed = time.perf_counter() - transfer_start
+                    self.metrics.observe("transfer_seconds", elapsed)
+                    if elapsed > 0:
+                        self.metrics.observe("transfer_throughput_bytes_per_second", (downloaded - resume_pos) / elapsed)
+                    self.metrics.inc("downloads_completed")
+
+                    full_output_path = os.path.join(self.current_directory, output_path)
+                    self.logger.info(
+                        f"Downloaded: {video_title} -> {full_output_path}",
+                        extra=dict(log_fields, bytes=downloaded - resume_pos, duration=elapsed),
+                    )
+                    return True
+                else:
+                    self.logger.error(f"Failed to download {video_title}: HTTP {response.status_code}", extra=log_fields)
+                    return False
+
+        except TransferInterrupted:
+            # The writer has flushed and checkpointed everything received so far
+            raise
+        except Exception as e:
+            self.logger.error(f"Error downloading {video_title}: {e}", extra=log_fields)
+            return False
+
+    def get_video_download_urls(self, video_uid, fresh: bool = False):
+        """Get video download URLs"""
+        return self.client.get_video_download_urls(video_uid, fresh)
+
+    def get_best_quality(self, video_download_links: List[Dict]) -> Dict:
+        """Auto-select best available quality"""
+        return QualitySelector().pick(video_download_links)
+
+    @property
+    def primary_quality(self) -> str:
+        return 'auto' if self.auto_quality else str(self.quality)
+
+    def quality_selector(self, with_budget: bool = True, quality: Optional[str] = None) -> QualitySelector:
+        """Selector for a quality variant (the primary one by default), bounds, preference list and size budget
+
+        A fixed quality is the first preference when there is no budget, and
+        the upper bound (unless one is given) when there is. A budget applies
+        to each variant separately.
+        """
+        quality = quality or self.primary_quality
+        budget = self.size_budget if with_budget else None
+        preference = self.quality_preference
+        max_quality = self.max_quality
+        if quality != 'auto':
+            if budget is None:
+                preference = preference or [quality]
+            else:
+                max_quality = max_quality or int(quality)
+        return QualitySelector(preference, self.min_quality, max_quality, budget,
+                               client=self.client, concurrency=self.resolve_concurrency)
+
+    def link_quality(self, link: Optional[Dict], video_title: str = "", quality: Optional[str] = None) -> str:
+        """Quality label of a chosen link, warning when it is not the requested one"""
+        quality = quality or self.primary_quality
+        if link is None:
+            self.logger.warning(f"No quality within the allowed range for '{video_title}'")
+            return "unknown"
+        actual_quality = link["profile"].replace("p", "")
+        if not (quality == 'auto' or self.quality_preference or self.size_budget) and actual_quality != quality:
+            self.logger.warning(f"Quality {quality}p not found for '{video_title}', using {actual_quality}p")
+        return actual_quality
+
+    def select_link(self, video_download_links: List[Dict], video_title: str = "", quality: Optional[str] = None):
+        """Pick the download link for a quality variant (the primary one by default), returning (link, quality)"""
+        selected_link = self.quality_selector(with_budget=False, quality=quality).pick(video_download_links)
+        return selected_link, self.link_quality(selected_link, video_title, quality)
+
+    def get_playlist_info(self) -> Dict:
+        """Get playlist information before downloading"""
+        try:
+            if self.channel:
+                return self.client.get_channel_info(self.channel, self.channel_videos, self.resolve_concurrency)
+            return self.client.get_playlist_info(self.playlist_id)
+        except Exception as e:
+            self.logger.error(f"Error getting playlist info: {e}", extra={"playlist_id": self.playlist_id})
+            return None
+
+    @property
+    def playlist_hash(self) -> str:
+        return self.variant_hash(self.primary_quality)
+
+    def variant_hash(self, quality: str) -> str:
+        """History key of the playlist downloaded at one quality variant"""
+        key = f"{self.playlist_id}_{quality}"
+        if self.shard:
+            key += f"_shard{self.shard[0]}of{self.shard[1]}"
+        return hashlib.md5(key.encode()).hexdigest()
+
+    def pending_qualities(self) -> List[str]:
+        """Quality variants not yet recorded as downloaded"""
+        return [quality for quality in self.qualities if self.variant_hash(quality) not in self.download_history]
+
+    def in_shard(self, uid: str) -> bool:
+        return not self.shard or shard_of(uid, self.shard[1]) == self.shard[0]
+
+    def is_playlist_downloaded(self) -> bool:
+        return not self.pending_qualities()
+
+    def fetch_links(self, video: Dict) -> Optional[List[Dict]]:
+        """Download links of a playlist entry, or None if they could not be fetched"""
+        try:
+            return self.get_video_download_urls(video["attributes"]["uid"])
+        except Exception as e:
+            self.logger.error(
+                f"Error processing video '{video['attributes']['title']}': {e}",
+                extra={"uid": video["attributes"]["uid"], "playlist_id": self.playlist_id},
+            )
+            return None
+
+    def playlist_links(self, playlist_info: Dict) -> Tuple[List[Dict], List[Optional[List[Dict]]]]:
+        """Videos of the playlist (in this shard) and their links, resolved resolve_concurrency at a time"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        videos = [
+            video for video in playlist_info["videos"]
+            if video["type"] == "Video" and self.in_shard(video["attributes"]["uid"])
+        ]
+        with ThreadPoolExecutor(max_workers=max(1, self.resolve_concurrency), thread_name_prefix="resolve") as pool:
+            link_lists = list(pool.map(self.fetch_links, videos))
+        return videos, link_lists
+
+    def build_task(self, video: Dict, link: Dict, playlist_title: str, size: Optional[int] = None,
+                   quality: Optional[str] = None) -> Dict:
+        quality = quality or self.primary_quality
+        video_title = video["attributes"]["title"]
+        actual_quality = self.link_quality(link, video_title, quality)
+        download_url = link["urls"][0]
+        resolved_at = time.time()
+        safe_title = "".join(c for c in video_title if c.isalnum() or c in (' ', '-', '_')).strip()
+        directory = f"{self.destination_path}/{playlist_title}"
+        if video.get("folder"):
+            # Channel runs keep each playlist in its own folder
+            directory += f"/{video['folder']}"
+        return {
+            'url': download_url,
+            'path': f"{directory}/{safe_title}-{actual_quality}p.mp4",
+            'title': video_title,
+            'uid': video["attributes"]["uid"],
+            'profile': link["profile"],
+            'quality': quality,
+            'size': size,
+            'resolved_at': resolved_at,
+            'expires_at': link_expiry(download_url, resolved_at),
+        }
+
+    def resolve_video(self, video: Dict, playlist_title: str, probe_size: bool = False) -> Optional[Dict]:
+        """Resolve one playlist entry into a download task, or None if it has no usable link"""
+        links = self.fetch_links(video)
+        if links is None:
+            return None
+        with self.tracer.span("quality select", uid=video["attributes"]["uid"]):
+            selected_link = self.quality_selector(with_budget=False).pick(links)
+        if not selected_link:
+            self.link_quality(None, video["attributes"]["title"])
+            return None
+        size = self.client.probe_size(selected_link["urls"][0]) if probe_size else None
+        return self.build_task(video, selected_link, playlist_title, size)
+
+    def resolve_tasks(self, playlist_info: Dict, probe_size: bool = False,
+                      qualities: Optional[List[str]] = None) -> List[Dict]:
+        """Resolve each video of the playlist into a download task per quality variant
+
+        Videos are resolved concurrently (resolve_concurrency at a time), once
+        for all variants, and returned in playlist order, variant by variant.
+        Variants that end up on the same file (a missing quality falling back
+        to another requested one) are downloaded once. In links-only mode the
+        selected links are appended to the links file instead and no tasks are
+        returned.
+        """
+        playlist_title = playlist_info["title"]
+        os.makedirs(f"{self.destination_path}/{playlist_title}", exist_ok=True)
+
+        videos, link_lists = self.playlist_links(playlist_info)
+
+        download_tasks = []
+        paths = set()
+        for quality in qualities or self.qualities:
+            # Selection sees the whole playlist at once so a size budget can be spread over it
+            with self.tracer.span("quality select", videos=len(videos), quality=quality):
+                selector = self.quality_selector(quality=quality)
+                selections = selector.select(link_lists)
+
+            for index, (video, links, (link, size)) in enumerate(zip(videos, link_lists, selections)):
+                if index in selector.dropped:
+                    self.log_budget_skip(video, quality)
+                elif link:
+                    task = self.build_task(video, link, playlist_title, size, quality)
+                    if task['path'] not in paths:
+                        paths.add(task['path'])
+                        os.makedirs(os.path.dirname(task['path']), exist_ok=True)
+                        download_tasks.append(task)
+                elif links is not None:
+                    self.link_quality(None, video["attributes"]["title"], quality)
+
+        unsized = [task for task in download_tasks if task['size'] is None]
+        if probe_size and unsized:
+            sizes = self.quality_selector(with_budget=False).probe_sizes([task['url'] for task in unsized])
+            for task in unsized:
+                task['size'] = sizes[task['url']]
+
+        if self.for_download_manager:
+            # Save to text file
+            with open(f"{self.destination_path}/{playlist_title}.txt", "a", encoding='utf-8') as links_txt:
+                for task in download_tasks:
+                    links_txt.write(f"{task['url']}\n")
+            return []
+        return download_tasks
+
+    def refresh_task(self, task: Dict):
+        """Re-resolve an expired link of a task, keeping its profile when still offered"""
+        links = self.get_video_download_urls(task['uid'], fresh=True)
+        link = next((l for l in links if l["profile"] == task.get('profile')), None)
+        if link is None:
+            link, _ = self.select_link(links, task['title'], task.get('quality'))
+        if link is None:
+            raise RuntimeError(f"No download link left for '{task['title']}'")
+        task['url'] = link["urls"][0]
+        task['profile'] = link["profile"]
+        task['resolved_at'] = time.time()
+        task['expires_at'] = link_expiry(task['url'], task['resolved_at'])
+        self.logger.info(f"Re-resolved download link: {task['title']}", extra={"uid": task['uid']})
+
+    def download_task(self, task: Dict) -> bool:
+        """Download one resolved task on the calling thread
+
+        Links past their expiry are re-resolved first, and a failed transfer
+        is retried once with a freshly resolved link. A cancelled task returns
+        False; a paused one raises TransferPaused for the caller to retry
+        once resumed.
+        """
+        try:
+            result = self._download_task(task)
+        except TransferCancelled:
+            self.metrics.inc("downloads_cancelled")
+            self.logger.info(f"Cancelled: {task['title']}", extra={"uid": task.get('uid'), "path": task['path']})
+            self.report_status(task.get('uid'), task.get('quality'), "cancelled")
+            return False
+        except TransferPaused:
+            self.report_status(task.get('uid'), task.get('quality'), "paused")
+            raise
+        if result is None:
+            # Another cooperating worker is writing this file; it is neither ours nor failed
+            self.metrics.inc("downloads_skipped_claimed")
+            self.logger.info(f"Skipping, claimed by another worker: {task['title']}", extra={"uid": task.get('uid')})
+            self.report_status(task.get('uid'), task.get('quality'), "skipped")
+            return False
+        if not result:
+            # Counted once per download, however many attempts it took
+            self.metrics.inc("downloads_failed")
+        self.report_status(task.get('uid'), task.get('quality'), "completed" if result else "failed")
+        return result
+
+    def _download_task(self, task: Dict) -> Optional[bool]:
+        self.control.check(task.get('uid'))
+        download = self.download_video_with_resume
+        if self.profiler:
+            download = self.profiler.wrap(download)
+        with FileClaim(task['path']) if self.claim_files else nullcontext(True) as claimed:
+            if not claimed:
+                return None
+            # A probed size saves the transfer its HEAD request; a refreshed link is probed again
+            size = task.get('size')
+            if task.get('expires_at') and task['expires_at'] <= time.time():
+                if not self._refresh(task):
+                    return False
+                size = None
+            if download(task['url'], task['path'], task['title'], task['uid'], task.get('quality'), size):
+                return True
+            if not task.get('uid') or not self.sink.resumable:
+                # A stream sink already holds the first attempt's bytes; starting over would corrupt it
+                return False
+            self.metrics.inc("retries")
+            if not self._refresh(task):
+                return False
+            return download(task['url'], task['path'], task['title'], task['uid'], task.get('quality'))
+
+    def _refresh(self, task: Dict) -> bool:
+        """refresh_task that fails only this task, not the run, when the video cannot be re-resolved"""
+        try:
+            self.refresh_task(task)
+            return True
+        except Exception as e:
+            self.logger.error(
+                f"Could not re-resolve download link for {task['title']}: {e}",
+                extra={"uid": task.get('uid'), "playlist_id": self.playlist_id, "title": task['title'], "path": task['path']},
+            )
+            return False
+
+    def _counter(self, name: str) -> int:
+        return self.metrics.to_dict().get(name, {}).get("value", 0)
+
+    def _bytes_written(self) -> int:
+        return self._counter("bytes_written")
+
+    def report_shard(self, playlist_title: str, results: List[bool], started: float, start_bytes: int):
+        write_shard_report(os.path.join(self.destination_path, playlist_title), self.shard, {
+            "shard": self.shard[0],
+            "shard_count": self.shard[1],
+            "pid": os.getpid(),
+            "videos": len(results),
+            "successful": sum(1 for r in results if r),
+            "bytes": self._bytes_written() - start_bytes,
+            "started": started,
+            "finished": time.time(),
+        })
+
+    def estimate(self, playlist_info: Dict, sample_bytes: int = 1 << 20) -> Dict:
+        """Size of every video at each requested quality, with totals and an ETA, without downloading
+
+        Links are resolved and sizes probed concurrently over the shared
+        client. The ETA comes from reading `sample_bytes` from up to
+        max_concurrent_downloads videos at once; 0 skips the sample.
+        """
+        videos, link_lists = self.playlist_links(playlist_info)
+        selections = {
+            quality: self.quality_selector(quality=quality).select(link_lists) for quality in self.qualities
+        }
+        unsized = sorted({
+            link["urls"][0] for selected in selections.values()
+            for link, size in selected if link and size is None
+        })
+        probed = self.quality_selector(with_budget=False).probe_sizes(unsized) if unsized else {}
+
+        qualities = {}
+        sizes = {}  # url -> size, so a file shared by two variants counts once in the total
+        for quality, selected in selections.items():
+            entries = []
+            for video, (link, size) in zip(videos, selected):
+                url = link["urls"][0] if link else None
+                if url and size is None:
+                    size = probed.get(url)
+                if url:
+                    sizes[url] = size
+                entries.append({
+                    "uid": video["attributes"]["uid"],
+                    "title": video["attributes"]["title"],
+                    "profile": link["profile"] if link else None,
+                    "size": size,
+                })
+            qualities[quality] = {
+                "videos": entries,
+                "total_size": sum(entry["size"] or 0 for entry in entries),
+                "unknown": sum(1 for entry in entries if entry["profile"] and entry["size"] is None),
+                "missing": sum(1 for entry in entries if entry["profile"] is None),
+            }
+
+        total_size = sum(size or 0 for size in sizes.values())
+        sample_urls = sorted(sizes, key=lambda url: sizes[url] or 0, reverse=True)[:max(1, self.max_concurrent_downloads)]
+        throughput = self.sample_throughput(sample_urls, sample_bytes) if sample_bytes and sample_urls else None
+        return {
+            "playlist_id": self.playlist_id,
+            "title": playlist_info["title"],
+            "video_count": len(videos),
+            "qualities": qualities,
+            "total_size": total_size,
+            "throughput": throughput,
+            "eta_seconds": total_size / throughput if throughput else None,
+        }
+
+    def sample_throughput(self, urls: List[str], sample_bytes: int) -> Optional[float]:
+        """Aggregate bytes per second reading the start of each url in parallel, or None if nothing was read"""
+        from concurrent.futures import ThreadPoolExecutor
+
+        def read(url):
+            try:
+                with self.client.session.get(url, headers={'Range': f'bytes=0-{sample_bytes - 1}'}, stream=True) as response:
+                    if response.status_code not in (200, 206):
+                        return 0
+                    received = 0
+                    for chunk in response.iter_content(chunk_size=65536):
+                        received += len(chunk)
+                        if received >= sample_bytes:
+                            break
+                    return min(received, sample_bytes)
+            except Exception as e:
+                self.logger.warning(f"Could not sample throughput from {url}: {e}")
+                return 0
+
+        started = time.perf_counter()
+        with self.tracer.span("throughput sample", streams=len(urls)):
+            with ThreadPoolExecutor(max_workers=len(urls), thread_name_prefix="sample") as pool:
+                received = sum(pool.map(read, urls))
+        elapsed = time.perf_counter() - started
+        return received / elapsed if received and elapsed > 0 else None
+
+    def create_plan(self) -> Optional[Dict]:
+        """Resolve the playlist into a portable plan without downloading anything"""
+        playlist_info = self.get_playlist_info()
+        if not playlist_info:
+            return None
+        budget_skipped_before = self._counter("downloads_skipped_budget")
+        tasks = self.resolve_tasks(playlist_info, probe_size=True)
+        for task in tasks:
+            # Paths are stored relative to the destination so the plan can run elsewhere
+            task['path'] = os.path.relpath(task['path'], self.destination_path)
+        return {
+            "version": PLAN_VERSION,
+            "created": time.time(),
+            "playlist_id": self.playlist_id,
+            "title": playlist_info["title"],
+            "quality": self.quality,
+            "auto_quality": self.auto_quality,
+            "qualities": self.qualities,
+            "total_size": sum(task['size'] or 0 for task in tasks),
+            "budget_skipped": self._counter("downloads_skipped_budget") - budget_skipped_before,
+            "tasks": tasks,
+        }
 
-        if not os.path.exists(destination_path):
-            os.makedirs(destination_path, exist_ok=True)
+    @staticmethod
+    def write_plan(plan: Dict, path: str):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(plan, f, ensure_ascii=False, indent=2)
 
-    def setup_logger(self, log_level=logging.INFO, log_to_file=True):
-        logger = logging.getLogger("AparatDownloader")
-        logger.setLevel(log_level)
-        
-        # Clear existing handlers
-        for handler in logger.handlers[:]:
-            logger.removeHandler(handler)
+    @staticmethod
+    def load_plan(path: str) -> Dict:
+        with open(path, 'r', encoding='utf-8') as f:
+            plan = json.load(f)
+        if plan.get("version") != PLAN_VERSION:
+            raise ValueError(f"Unsupported plan version: {plan.get('version')}")
+        return plan
 
-        formatter = logging.Formatter(
-            "%(asctime)s - %(name)s - %(levelname)s - %(message)s"
-        )
+    async def execute_plan_async(self, plan: Dict) -> bool:
+        """Download every task of a plan into destination_path"""
+        self.prepare_destination()
+        self.playlist_id = plan["playlist_id"]
+        self.quality = plan["quality"]
+        self.auto_quality = plan.get("auto_quality", False)
+        self.qualities = plan.get("qualities") or [self.primary_quality]
+        self.playlist_title = plan["title"]
 
-        # Console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setFormatter(formatter)
-        logger.addHandler(console_handler)
+        tasks = []
+        for task in plan["tasks"]:
+            if not self.in_shard(task['uid']):
+                continue
+            task = dict(task, path=os.path.join(self.destination_path, task['path']))
+            os.makedirs(os.path.dirname(task['path']), exist_ok=True)
+            tasks.append(task)
 
-        # File handler
-        if log_to_file:
-            log_file = os.path.join(self.destination_path, "downloader.log")
-            file_handler = logging.FileHandler(log_file, encoding='utf-8')
-            file_handler.setFormatter(formatter)
-            logger.addHandler(file_handler)
+        self.logger.info(f"Executing plan for '{plan['title']}' ({len(tasks)} videos)",
+                         extra={"playlist_id": self.playlist_id})
+        self.check_free_space(tasks)
+        started, start_bytes = time.time(), self._bytes_written()
+        results = await self.execute_tasks_async(tasks)
+        successful = sum(1 for r in results if r)
+        self.logger.info(f"Downloaded {successful}/{len(tasks)} videos successfully")
+        if self.shard:
+            self.report_shard(plan["title"], results, started, start_bytes)
+        # A plan that left videos out for the budget does not complete the playlist
+        if successful == len(tasks) and not plan.get("budget_skipped"):
+            for quality in self.qualities:
+                self.record_history(plan["title"], len({task['uid'] for task in tasks}), quality)
 
-        return logger
+        if self.metrics_file:
+            self.metrics.dump_json(self.metrics_file)
+        return successful == len(tasks)
 
-    def load_download_history(self) -> Dict:
-        """Load download history to avoid duplicates"""
-        try:
-            if os.path.exists(self.history_file):
-                with open(self.history_file, 'r', encoding='utf-8') as f:
-                    return json.load(f)
-        except Exception as e:
-            self.logger.warning(f"Could not load download history: {e}")
-        return {}
+    def disk_space_gate(self) -> DiskSpaceGate:
+        if self.space_gate is None:
+            os.makedirs(self.destination_path, exist_ok=True)
+            self.space_gate = DiskSpaceGate(
+                self.destination_path, margin=self.space_margin, on_shortfall=self.on_low_space, metrics=self.metrics,
+            )
+        return self.space_gate
 
-    def save_download_history(self):
-        """Save download history"""
-        try:
-            with open(self.history_file, 'w', encoding='utf-8') as f:
-                json.dump(self.download_history, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            self.logger.error(f"Could not save download history: {e}")
+    def check_free_space(self, download_tasks: List[Dict]) -> int:
+        """Warn up front when the tasks will not all fit; returns the shortfall in bytes"""
+        if not self.sink.local:
+            return 0
+        gate = self.disk_space_gate()
+        shortfall = gate.shortfall(download_tasks)
+        if shortfall:
+            needed = sum(gate.needed(task) for task in download_tasks)
+            action = "waiting for space" if self.on_low_space == "wait" else "videos that do not fit will be skipped"
+            self.logger.warning(
+                f"Playlist needs {format_size(needed)} but only {format_size(needed - shortfall)} "
+                f"is available in {self.destination_path}; short by {format_size(shortfall)}, {action}",
+                extra={"playlist_id": self.playlist_id, "bytes": shortfall},
+            )
+        return shortfall
 
-    def get_file_hash(self, file_path: str) -> str:
-        """Generate hash for partial download tracking"""
-        return hashlib.md5(file_path.encode()).hexdigest()
+    def log_budget_skip(self, video: Dict, quality: str):
+        title, uid = video["attributes"]["title"], video["attributes"]["uid"]
+        self.logger.warning(f"Skipping, does not fit the size budget: {title}", extra={"uid": uid})
+        self.metrics.inc("downloads_skipped_budget")
+        self.progress.add_tasks([{'uid': uid, 'quality': quality, 'title': title}])
+        self.report_status(uid, quality, "skipped")
 
-    def is_download_complete(self, file_path: str, expected_size: int) -> bool:
-        """Check if download is complete"""
-        if not os.path.exists(file_path):
-            return False
-        return os.path.getsize(file_path) == expected_size
+    def log_space_skip(self, task: Dict):
+        self.logger.warning(
+            f"Skipping, not enough free space: {task['title']} ({format_size(task['size'])})",
+            extra={"uid": task.get('uid'), "path": task['path']},
+        )
+        self.report_status(task.get('uid'), task.get('quality'), "skipped")
 
-    def download_video_with_resume(self, video_url: str, output_path: str, video_title: str = ""):
-        """Download video with resume capability"""
-        try:
-            # Get file size first
-            head_response = requests.head(video_url)
-            total_size = int(head_response.headers.get('content-length', 0))
-            
-            # Check if already downloaded
-            if self.is_download_complete(output_path, total_size):
-                self.logger.info(f"File already downloaded: {video_title}")
-                return True
+    async def execute_tasks_async(self, download_tasks: List[Dict]) -> List[bool]:
+        """Download resolved tasks on the default executor with the concurrency limit
 
-            # Check for partial download
-            resume_pos = 0
-            if os.path.exists(output_path):
-                resume_pos = os.path.getsize(output_path)
-                if resume_pos >= total_size:
-                    self.logger.info(f"File already complete: {video_title}")
-                    return True
+        Tasks queue for the semaphore in the order of the schedule policy;
+        results are returned in the order of download_tasks.
+        """
+        import asyncio
 
-            # Set up headers for resume
-            headers = {}
-            if resume_pos > 0:
-                headers['Range'] = f'bytes={resume_pos}-'
-                self.logger.info(f"Resuming download from byte {resume_pos}: {video_title}")
+        self.progress.add_tasks(download_tasks)
+        if self.processes > 1 and len(download_tasks) > 1:
+            return await self.execute_tasks_in_processes(download_tasks)
 
-            # Download with resume
-            response = requests.get(video_url, headers=headers, stream=True)
-            
-            if response.status_code in [200, 206]:  # 206 is partial content
-                mode = 'ab' if resume_pos > 0 else 'wb'
-                
-                with open(output_path, mode) as file:
-                    downloaded = resume_pos
-                    
-                    for chunk in response.iter_content(chunk_size=8192):
-                        if chunk:
-                            file.write(chunk)
-                            downloaded += len(chunk)
-                            
-                            # Progress callback
-                            if self.progress_callback and total_size > 0:
-                                progress = (downloaded / total_size) * 100
-                                self.progress_callback(video_title, progress, downloaded, total_size)
+        semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
+        self.metrics.inc("queue_depth", len(download_tasks))
+        gate = self.disk_space_gate()
 
-                full_output_path = os.path.join(self.current_directory, output_path)
-                self.logger.info(f"Downloaded: {video_title} -> {full_output_path}")
-                return True
-            else:
-                self.logger.error(f"Failed to download {video_title}: HTTP {response.status_code}")
-                return False
+        def run_download(task, submitted):
+            # Time spent waiting for a free executor thread
+            self.tracer.complete("executor wait", submitted, time.perf_counter(), title=task['title'])
+            return self.download_task(task)
 
-        except Exception as e:
-            self.logger.error(f"Error downloading {video_title}: {e}")
+        async def wait_while_paused(uid):
+            while self.control.is_paused(uid) and not self.control.is_cancelled(uid):
+                await asyncio.sleep(0.2)
+
+        def cancel_queued(task):
+            # Cancelled before its transfer started
+            self.metrics.inc("downloads_cancelled")
+            self.report_status(task.get('uid'), task.get('quality'), "cancelled")
             return False
 
-    @staticmethod
-    def get_video_download_urls(video_uid):
-        """Get video download URLs"""
-        video_url = (
-            f"https://www.aparat.com/api/fa/v1/video/video/show/videohash/{video_uid}"
-        )
+        async def download_with_semaphore(task):
+            uid = task.get('uid')
+            queued = True
+            while True:
+                # Paused tasks wait here, without holding a concurrency slot
+                await wait_while_paused(uid)
+                with self.tracer.span("queued", title=task['title']):
+                    await semaphore.acquire()
+                try:
+                    if queued:
+                        self.metrics.dec("queue_depth")
+                        queued = False
+                    if self.control.is_cancelled(uid):
+                        return cancel_queued(task)
+                    if self.control.is_paused(uid):
+                        continue
+                    if self.sink.local and not await gate.admit(task, lambda: self.control.is_cancelled(uid)):
+                        if self.control.is_cancelled(uid):
+                            return cancel_queued(task)
+                        self.log_space_skip(task)
+                        return False
+                    self.metrics.inc("active_downloads")
+                    try:
+                        return await asyncio.get_event_loop().run_in_executor(
+                            None, 
+                            run_download,
+                            task,
+                            time.perf_counter()
+                        )
+                    except TransferPaused:
+                        self.logger.info(f"Paused: {task['title']}", extra={"uid": uid})
+                        continue
+                    finally:
+                        self.metrics.dec("active_downloads")
+                        gate.release(task)
+                finally:
+                    semaphore.release()
+        
+        # Coroutines reach the semaphore, and so start, in the order they are gathered
+        order = schedule_order(download_tasks, self.schedule)
+        ordered_results = await asyncio.gather(*[download_with_semaphore(download_tasks[i]) for i in order])
+        results = [False] * len(download_tasks)
+        for index, result in zip(order, ordered_results):
+            results[index] = result
+        return results
 
-        video_response = requests.get(video_url)
-        video_data = video_response.json()
-        return video_data["data"]["attributes"]["file_link_all"]
+    async def execute_tasks_in_processes(self, download_tasks: List[Dict]) -> List[bool]:
+        """Spread tasks over worker processes, each with its own event loop and connection pool
 
-    def get_best_quality(self, video_download_links: List[Dict]) -> Dict:
-        """Auto-select best available quality"""
-        if not video_download_links:
-            return None
-            
-        # Sort by quality (highest first)
-        quality_order = ['1080', '720', '480', '360', '240', '144']
-        
-        for quality in quality_order:
-            for link in video_download_links:
-                if link["profile"] == f"{quality}p":
-                    return link
-        
-        # Fallback to last available
-        return video_download_links[-1]
+        Every process runs max_concurrent_downloads transfers. Progress, log
+        records and counters stream back over one multiprocessing queue and
+        are replayed here, so callbacks and metrics behave as in-process.
+        Run-wide and per-video pause and cancel are mirrored into every worker.
+        """
+        import asyncio
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
 
-    def get_playlist_info(self) -> Dict:
-        """Get playlist information before downloading"""
-        api_url = f"https://www.aparat.com/api/fa/v1/video/playlist/one/playlist_id/{self.playlist_id}"
-        
+        # Workers cannot see each other's reservations, so skipping is decided
+        # here against the whole budget; each worker still gates its own share
+        indices = schedule_order(download_tasks, self.schedule)
+        if self.on_low_space == "skip" and self.sink.local:
+            gate = self.disk_space_gate()
+            budget = gate.available()
+            scheduled, indices = indices, []
+            for index in scheduled:
+                task = download_tasks[index]
+                needed = gate.needed(task)
+                if needed > budget:
+                    gate.skip(task)
+                    self.log_space_skip(task)
+                    continue
+                budget -= needed
+                indices.append(index)
+            if not indices:
+                return [False] * len(download_tasks)
+
+        processes = min(self.processes, len(indices))
+        # Dealing the scheduled order round-robin keeps neighbouring (often
+        # similarly sized) videos apart and, largest-first, balances the shares
+        shares = [[download_tasks[index] for index in indices[i::processes]] for i in range(processes)]
+        options = {
+            "playlist_id": self.playlist_id,
+            "quality": self.quality,
+            "auto_quality": self.auto_quality,
+            "destination_path": self.destination_path,
+            "max_concurrent_downloads": self.max_concurrent_downloads,
+            "write_buffer_size": self.write_buffer_size,
+            "write_buffers": self.write_buffers,
+            "fsync_policy": self.fsync_policy,
+            "space_margin": self.space_margin,
+            "on_low_space": self.on_low_space,
+            "schedule": self.schedule,
+            "sink": self.sink_spec,
+            "api_base": self.client.api_base,
+            "log_level": self.logger.getEffectiveLevel(),
+            "report_progress": self.progress_callback is not None,
+            "claim_files": self.claim_files,
+        }
+
+        context = multiprocessing.get_context("spawn")
+        events = context.Queue()
+        # Whole-run pause/cancel and the paused/cancelled uids (as JSON),
+        # mirrored into every worker's TransferControl
+        flags = context.Array('b', 2)
+        uids = context.Array('c', CONTROL_UIDS_BYTES)
+        running = threading.Event()
+        running.set()
+        drain = threading.Thread(target=self._drain_worker_events, args=(events,), name="worker-events", daemon=True)
+        drain.start()
+        mirror = threading.Thread(target=self._publish_control, args=(flags, uids, running), name="control", daemon=True)
+        mirror.start()
+        loop = asyncio.get_running_loop()
         try:
-            response = requests.get(api_url)
-            data = response.json()
-            
-            videos = data["included"]
-            playlist_title = data["data"]["attributes"]["title"]
-            
-            video_count = len([v for v in videos if v["type"] == "Video"])
-            
-            return {
-                "title": playlist_title,
-                "video_count": video_count,
-                "videos": videos,
-                "raw_data": data
-            }
-        except Exception as e:
-            self.logger.error(f"Error getting playlist info: {e}")
-            return None
+            with ProcessPoolExecutor(max_workers=processes, mp_context=context,
+                                     initializer=_init_engine_worker, initargs=(events, flags, uids)) as pool:
+                share_results = await asyncio.gather(*[
+                    loop.run_in_executor(pool, _run_engine_worker, options, share) for share in shares
+                ])
+        finally:
+            running.clear()
+            events.put(None)
+            await loop.run_in_executor(None, drain.join)
 
-    async def download_playlist_async(self):
-        """Async version of download_playlist for better performance"""
-        playlist_info = self.get_playlist_info()
+        # Undo the round-robin split so results line up with download_tasks
+        results = [False] * len(download_tasks)
+        for offset, share_result in enumerate(share_results):
+            for index, result in zip(indices[offset::processes], share_result):
+                results[index] = result
+        return results
+
+    def _publish_control(self, flags, uids, running):
+        published, warned = b"", False
+        while running.is_set():
+            flags[0], flags[1] = self.control.paused, self.control.cancelled
+            payload = json.dumps(self.control.uid_state()).encode()
+            if payload != published:
+                if len(payload) < CONTROL_UIDS_BYTES:
+                    uids.value = payload
+                    published = payload
+                elif not warned:
+                    warned = True
+                    self.logger.warning("Too many paused or cancelled videos to forward to worker processes")
+            time.sleep(0.2)
+
+    def _drain_worker_events(self, events):
+        while True:
+            event = events.get()
+            if event is None:
+                return
+            kind = event[0]
+            if kind == "progress" and self.progress_callback:
+                self.progress_callback(*event[1:])
+            elif kind == "status":
+                self.report_status(*event[1:])
+            elif kind == "log":
+                self.logger.handle(event[1])
+            elif kind == "counters":
+                for name, value in event[1].items():
+                    self.metrics.inc(name, value)
+
+    def record_history(self, playlist_title: str, video_count: int, quality: Optional[str] = None):
+        """Mark the playlist as downloaded at a quality variant (the primary one by default)"""
+        quality = quality or self.primary_quality
+        self.download_history[self.variant_hash(quality)] = {
+            "playlist_id": self.playlist_id,
+            "title": playlist_title,
+            "quality": self.quality if quality == 'auto' else quality,
+            "download_date": time.time(),
+            "video_count": video_count
+        }
+        with self.tracer.span("history save"):
+            self.save_download_history()
+
+    async def download_playlist_async(self, playlist_info: Optional[Dict] = None, recheck: bool = False):
+        """Async version of download_playlist for better performance
+
+        Blocking steps run on the default executor so the event loop stays
+        free for other jobs. An already fetched `playlist_info` is reused.
+        With `recheck` the videos are downloaded even if the history records
+        the playlist as complete, e.g. ones that appeared since.
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        self.prepare_destination()
+        if playlist_info is None:
+            playlist_info = await loop.run_in_executor(None, self.get_playlist_info)
         if not playlist_info:
             return False
 
-        playlist_title = playlist_info["title"]
-        videos = playlist_info["videos"]
+        playlist_title = self.playlist_title = playlist_info["title"]
         
-        # Check if playlist was already downloaded
-        playlist_hash = hashlib.md5(f"{self.playlist_id}_{self.quality}".encode()).hexdigest()
-        if playlist_hash in self.download_history:
+        # Check if playlist was already downloaded, at every requested quality
+        qualities = list(self.qualities) if recheck else self.pending_qualities()
+        if not qualities:
             self.logger.info(f"Playlist '{playlist_title}' was already downloaded")
             return True
 
-        self.logger.info(f"Starting download of playlist: {playlist_title} ({playlist_info['video_count']} videos)")
-
-        if not os.path.exists(f"{self.destination_path}/{playlist_title}"):
-            os.makedirs(f"{self.destination_path}/{playlist_title}", exist_ok=True)
-
-        # Prepare download tasks
-        download_tasks = []
-        
-        for video in videos:
-            if video["type"] == "Video":
-                video_uid = video["attributes"]["uid"]
-                video_title = video["attributes"]["title"]
-                
-                try:
-                    video_download_links = self.get_video_download_urls(video_uid)
-                    
-                    # Select quality
-                    selected_link = None
-                    if self.auto_quality:
-                        selected_link = self.get_best_quality(video_download_links)
-                        actual_quality = selected_link["profile"].replace("p", "") if selected_link else self.quality
-                    else:
-                        # Find requested quality
-                        for link in video_download_links:
-                            if link["profile"] == f"{self.quality}p":
-                                selected_link = link
-                                actual_quality = self.quality
-                                break
-                        
-                        # Fallback to best available
-                        if not selected_link:
-                            selected_link = self.get_best_quality(video_download_links)
-                            actual_quality = selected_link["profile"].replace("p", "") if selected_link else "unknown"
-                            self.logger.warning(f"Quality {self.quality}p not found for '{video_title}', using {actual_quality}p")
-
-                    if selected_link:
-                        if self.for_download_manager:
-                            # Save to text file
-                            with open(f"{self.destination_path}/{playlist_title}.txt", "a", encoding='utf-8') as links_txt:
-                                links_txt.write(f"{selected_link['urls'][0]}\n")
-                        else:
-                            # Prepare for download
-                            download_url = selected_link["urls"][0]
-                            safe_title = "".join(c for c in video_title if c.isalnum() or c in (' ', '-', '_')).strip()
-                            output_path = f"{self.destination_path}/{playlist_title}/{safe_title}-{actual_quality}p.mp4"
-                            
-                            download_tasks.append({
-                                'url': download_url,
-                                'path': output_path,
-                                'title': video_title
-                            })
+        self.logger.info(
+            f"Starting download of playlist: {playlist_title} ({playlist_info['video_count']} videos)",
+            extra={"playlist_id": self.playlist_id},
+        )
 
-                except Exception as e:
-                    self.logger.error(f"Error processing video '{video_title}': {e}")
+        # Prepare download tasks; sizes feed the disk space check
+        budget_skipped_before = self._counter("downloads_skipped_budget")
+        download_tasks = await loop.run_in_executor(
+            None, lambda: self.resolve_tasks(playlist_info, probe_size=not self.for_download_manager, qualities=qualities)
+        )
+        budget_skipped = self._counter("downloads_skipped_budget") - budget_skipped_before
+        if budget_skipped:
+            self.logger.warning(f"{budget_skipped} videos were left out to stay within the size budget")
 
         # Execute downloads with concurrency limit
+        skipped = claimed = 0
         if download_tasks and not self.for_download_manager:
-            semaphore = asyncio.Semaphore(self.max_concurrent_downloads)
-            
-            async def download_with_semaphore(task):
-                async with semaphore:
-                    return await asyncio.get_event_loop().run_in_executor(
-                        None, 
-                        self.download_video_with_resume,
-                        task['url'],
-                        task['path'],
-                        task['title']
-                    )
-            
-            # Run downloads
-            results = await asyncio.gather(*[download_with_semaphore(task) for task in download_tasks])
+            if self.tasks_callback:
+                self.tasks_callback(download_tasks)
+            self.check_free_space(download_tasks)
+            started, start_bytes = time.time(), self._bytes_written()
+            skipped_before = self._counter("downloads_skipped_no_space")
+            claimed_before = self._counter("downloads_skipped_claimed")
+            results = await self.execute_tasks_async(download_tasks)
+            skipped = self._counter("downloads_skipped_no_space") - skipped_before
+            claimed = self._counter("downloads_skipped_claimed") - claimed_before
             
             successful = sum(1 for r in results if r)
             self.logger.info(f"Downloaded {successful}/{len(download_tasks)} videos successfully")
+            if self.control.cancelled:
+                self.logger.info(f"Download of playlist '{playlist_title}' was cancelled; run again to resume")
+                if self.metrics_file:
+                    self.metrics.dump_json(self.metrics_file)
+                return False
+            if skipped:
+                self.logger.warning(f"{skipped} videos were skipped for lack of disk space; run again once space is freed")
+            if claimed:
+                self.logger.info(f"{claimed} videos were left to other workers that had claimed them")
+            if self.shard:
+                self.report_shard(playlist_title, results, started, start_bytes)
+        elif self.shard and not self.for_download_manager:
+            # A shard the hash left empty still reports, so the run's aggregate sees every shard
+            self.report_shard(playlist_title, [], time.time(), self._bytes_written())
 
-        # Save to history
-        self.download_history[playlist_hash] = {
-            "playlist_id": self.playlist_id,
-            "title": playlist_title,
-            "quality": self.quality,
-            "download_date": time.time(),
-            "video_count": len(download_tasks) if not self.for_download_manager else len([v for v in videos if v["type"] == "Video"])
-        }
-        self.save_download_history()
+        # Save to history, unless videos were left out for lack of space or budget, or
+        # left to other workers, which record the playlist once they have finished it
+        if not skipped and not budget_skipped and not claimed:
+            for quality in qualities:
+                self.record_history(
+                    playlist_title,
+                    playlist_info["video_count"] if self.for_download_manager
+                    else len({task['uid'] for task in download_tasks}),
+                    quality,
+                )
 
         if self.for_download_manager:
             self.logger.info(f"Links file created: {playlist_title}.txt")
         else:
-            self.logger.info(f"Playlist download completed: {playlist_title}")
+            self.logger.info(f"Playlist download completed: {playlist_title}", extra={"playlist_id": self.playlist_id})
+
+        if self.metrics_file:
+            self.metrics.dump_json(self.metrics_file)
 
         return True
 
     def download_playlist(self):
         """Synchronous wrapper for async download"""
+        import asyncio
+
         try:
-            if asyncio.get_event_loop().is_running():
-                # If already in an event loop, create a new thread
-                import concurrent.futures
-                with concurrent.futures.ThreadPoolExecutor() as executor:
-                    future = executor.submit(asyncio.run, self.download_playlist_async())
-                    return future.result()
-            else:
+            try:
+                asyncio.get_running_loop()
+            except RuntimeError:
                 return asyncio.run(self.download_playlist_async())
+            # If already in an event loop, create a new thread
+            import concurrent.futures
+            with concurrent.futures.ThreadPoolExecutor() as executor:
+                future = executor.submit(asyncio.run, self.download_playlist_async())
+                return future.result()
         except Exception as e:
             self.logger.error(f"Error in download_playlist: {e}")
             return False
+
+    async def run(self, buffer: int = 256):
+        """Download the playlist, yielding DownloadEvent objects on the caller's event loop
+
+            async for event in downloader.run():
+                if isinstance(event, TransferCompleted):
+                    ...
+
+        Events from transfer threads are handed over through an EventStream
+        of `buffer` lifecycle events (see EventStream for the backpressure
+        rules). The last event is a RunSummary.
+
+        Closing the generator early cancels the download; partial files are
+        kept for resume. A `break` alone only closes it once the generator is
+        finalized, so use contextlib.aclosing() to stop the run right away:
+
+            async with contextlib.aclosing(downloader.run()) as events:
+                async for event in events:
+                    if isinstance(event, TransferFailed):
+                        break
+
+        Each run starts with pause and cancel flags cleared, so a downloader
+        can be run again after an early stop.
+        """
+        import asyncio
+
+        self.control.reset()
+        loop = asyncio.get_running_loop()
+        stream = EventStream(loop, buffer)
+        tasks_callback, status_callback = self.tasks_callback, self.status_callback
+        titles: Dict[Tuple, str] = {}
+        transferring = set()
+
+        def on_tasks(tasks):
+            for task in tasks:
+                titles[(task['uid'], task['quality'])] = task['title']
+                stream.emit(VideoResolved(task['uid'], task['quality'], task['title'], task.get('profile'),
+                                          task.get('size'), task['path']))
+            if tasks_callback:
+                tasks_callback(tasks)
+
+        def on_status(uid, quality, state, downloaded, total):
+            key = (uid, quality)
+            title = titles.get(key, uid)
+            if state == "downloading":
+                if key not in transferring:
+                    transferring.add(key)
+                    stream.emit(TransferStarted(uid, quality, title, downloaded, total))
+                else:
+                    transfer = self.progress.transfer(uid, quality)
+                    stream.emit(TransferProgress(uid, quality, downloaded, total, transfer["rate"], transfer["eta"]))
+            else:
+                transferring.discard(key)
+                if state == "completed":
+                    stream.emit(TransferCompleted(uid, quality, title, self.progress.transfer(uid, quality)["total"]))
+                elif state in ("failed", "cancelled", "skipped"):
+                    stream.emit(TransferFailed(uid, quality, title, state))
+            if status_callback:
+                status_callback(uid, quality, state, downloaded, total)
+
+        async def download():
+            try:
+                playlist_info = await loop.run_in_executor(None, self.get_playlist_info)
+                if not playlist_info:
+                    result = False
+                else:
+                    stream.emit(PlaylistResolved(str(self.playlist_id), playlist_info["title"], playlist_info["video_count"]))
+                    result = await self.download_playlist_async(playlist_info)
+                snapshot = self.progress.snapshot(active_only=True)
+                states = snapshot["states"]
+                stream.emit(RunSummary(
+                    bool(result), states.get("completed", 0), states.get("failed", 0), states.get("cancelled", 0),
+                    states.get("skipped", 0), snapshot["downloaded"], snapshot["elapsed"],
+                ))
+            finally:
+                stream.close()
+
+        self.tasks_callback, self.status_callback = on_tasks, on_status
+        runner = loop.create_task(download())
+        try:
+            while True:
+                event = await stream.get()
+                if event is None:
+                    break
+                yield event
+            # Surface an unexpected error of the run to the consumer
+            await runner
+        finally:
+            if not runner.done():
+                self.cancel()
+            stream.close()
+            await asyncio.gather(runner, return_exceptions=True)
+            self.tasks_callback, self.status_callback = tasks_callback, status_callback
+
+
+_engine_events = None
+_engine_flags = None
+_engine_uids = None
+# Room for the JSON list of paused and cancelled uids shared with worker processes
+CONTROL_UIDS_BYTES = 1 << 16
+
+
+class _EngineLogHandler(logging.handlers.QueueHandler):
+    def enqueue(self, record):
+        self.queue.put(("log", record))
+
+
+def _init_engine_worker(events, flags=None, uids=None):
+    """ProcessPoolExecutor initializer: route logging of this worker to the parent"""
+    global _engine_events, _engine_flags, _engine_uids
+    _engine_events = events
+    _engine_flags = flags
+    _engine_uids = uids
+    logger = logging.getLogger("AparatDownloader")
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+    logger.addHandler(_EngineLogHandler(events))
+    logger.propagate = False
+
+
+def _run_engine_worker(options: Dict, tasks: List[Dict]) -> List[bool]:
+    """Download a share of tasks on this process's own event loop"""
+    import asyncio
+
+    options = dict(options)
+    logging.getLogger("AparatDownloader").setLevel(options.pop("log_level"))
+    report_progress = options.pop("report_progress")
+    metrics = Metrics()
+    client = AparatClient(api_base=options.pop("api_base"), metrics=metrics)
+    last_percent = {}
+
+    def progress_callback(title, progress, downloaded, total):
+        # Keep IPC light: forward at most once per whole percent per video
+        percent = int(progress)
+        if last_percent.get(title) != percent or downloaded == total:
+            last_percent[title] = percent
+            _engine_events.put(("progress", title, progress, downloaded, total))
+
+    def status_callback(uid, quality, state, downloaded, total):
+        percent = int(downloaded * 100 / total) if total else 0
+        if state != "downloading" or last_percent.get((uid, quality)) != percent:
+            last_percent[(uid, quality)] = percent
+            _engine_events.put(("status", uid, quality, state, downloaded, total))
+
+    downloader = AparatDownloader(
+        progress_callback=progress_callback if report_progress else None,
+        status_callback=status_callback,
+        metrics=metrics,
+        client=client,
+        **options,
+    )
+    running = threading.Event()
+    running.set()
+
+    def follow_control():
+        followed = b""
+        while running.is_set() and _engine_flags is not None:
+            paused, cancelled = _engine_flags[0], _engine_flags[1]
+            downloader.control.paused = bool(paused)
+            if cancelled:
+                downloader.control.cancel()
+            if _engine_uids is not None:
+                payload = _engine_uids.value
+                if payload and payload != followed:
+                    followed = payload
+                    downloader.control.set_uid_state(json.loads(payload))
+            time.sleep(0.2)
+
+    threading.Thread(target=follow_control, name="control", daemon=True).start()
+    try:
+        return asyncio.run(downloader.execute_tasks_async(tasks))
+    finally:
+        running.clear()
+        counters = {
+            name: family["value"] for name, family in metrics.to_dict().items()
+            if family["type"] == "counter" and family["value"]
+        }
+        _engine_events.put(("counters", counters))
+        client.close()
+
+
+class DownloadEngine:
+    """One long-lived event loop thread hosting previews and downloads for an interactive front end
+
+    Everything submitted shares one AparatClient (and its warm connection
+    pool), one metrics registry and a short-lived cache of fetched
+    playlists, so a preview followed by a download fetches the playlist
+    once. Up to `max_jobs` playlists download at a time; the rest queue.
+    Methods return concurrent.futures.Future objects and may be called
+    from any thread.
+    """
+
+    def __init__(self, max_jobs: int = 1, cache_seconds: float = 300, workers: int = 16):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.metrics = Metrics()
+        register_downloader_metrics(self.metrics)
+        self.client = AparatClient(metrics=self.metrics, pool_size=workers * 2)
+        self.cache_seconds = cache_seconds
+        self.downloaders: Dict[int, AparatDownloader] = {}
+        self._playlists: Dict[str, tuple] = {}  # playlist_id -> (fetched_at, info)
+        self._next_job = 0
+        self._lock = threading.Lock()
+        self.loop = asyncio.new_event_loop()
+        self.loop.set_default_executor(ThreadPoolExecutor(max_workers=workers, thread_name_prefix="engine"))
+        self._job_slots = None
+        self._max_jobs = max_jobs
+        self._thread = threading.Thread(target=self._run_loop, name="engine", daemon=True)
+        self._thread.start()
+
+    def _run_loop(self):
+        import asyncio
+
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def submit(self, coroutine):
+        """Run a coroutine on the engine loop"""
+        import asyncio
+
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    async def playlist_info(self, playlist_id) -> Dict:
+        """Fetch playlist information, reusing a recent fetch; raises on errors"""
+        playlist_id = str(playlist_id)
+        cached = self._playlists.get(playlist_id)
+        if cached and time.time() - cached[0] < self.cache_seconds:
+            return cached[1]
+        info = await self.loop.run_in_executor(None, self.client.get_playlist_info, playlist_id)
+        self._playlists[playlist_id] = (time.time(), info)
+        return info
+
+    def preview(self, playlist_id):
+        return self.submit(self.playlist_info(playlist_id))
+
+    def estimate(self, playlist_id, sample_bytes: int = 1 << 20, **options):
+        """Sizes, totals and ETA of a playlist for the given downloader options (see AparatDownloader.estimate)"""
+        return self.submit(self._estimate(playlist_id, sample_bytes, options))
+
+    async def _estimate(self, playlist_id, sample_bytes: int, options: Dict) -> Dict:
+        info = await self.playlist_info(playlist_id)
+        downloader = AparatDownloader(playlist_id=playlist_id, client=self.client, metrics=self.metrics, **options)
+        return await self.loop.run_in_executor(None, downloader.estimate, info, sample_bytes)
+
+    def download(self, playlist_info: Optional[Dict] = None, recheck: bool = False, **options):
+        """Queue a playlist download; returns (job_id, downloader, future of its result)
+
+        An already fetched `playlist_info` (possibly narrowed to some of its
+        videos) is downloaded as given; see download_playlist_async for `recheck`.
+        """
+        with self._lock:
+            job_id = self._next_job
+            self._next_job += 1
+        downloader = AparatDownloader(client=self.client, metrics=self.metrics, **options)
+        self.downloaders[job_id] = downloader
+        return job_id, downloader, self.submit(self._run_download(job_id, downloader, playlist_info, recheck))
+
+    async def _run_download(self, job_id: int, downloader: AparatDownloader, info: Optional[Dict] = None,
+                            recheck: bool = False) -> bool:
+        import asyncio
+
+        if self._job_slots is None:
+            # Created on the engine loop, which is the only place it is used
+            self._job_slots = asyncio.Semaphore(self._max_jobs)
+        try:
+            async with self._job_slots:
+                if downloader.control.cancelled:
+                    return False
+                try:
+                    # Channels are crawled by the downloader itself
+                    if info is None and not downloader.channel:
+                        info = await self.playlist_info(downloader.playlist_id)
+                except Exception as e:
+                    downloader.logger.error(f"Error getting playlist info: {e}", extra={"playlist_id": downloader.playlist_id})
+                    return False
+                return await downloader.download_playlist_async(info, recheck)
+        finally:
+            self.downloaders.pop(job_id, None)
+
+    def cancel(self, job_id: Optional[int] = None):
+        """Cancel one job, or every queued and running job"""
+        for current_id, downloader in list(self.downloaders.items()):
+            if job_id is None or current_id == job_id:
+                downloader.cancel()
+
+    def shutdown(self, timeout: float = 10):
+        """Cancel all jobs, give transfers a moment to flush, and stop the loop"""
+        self.cancel()
+        deadline = time.time() + timeout
+        while self.downloaders and time.time() < deadline:
+            time.sleep(0.1)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        self.client.close()
+
+
+class PlaylistWatcher:
+    """Polls many playlists and queues the videos that newly appear in them on a DownloadEngine
+
+    Each playlist has its own interval: it starts at `min_interval`, grows
+    by `backoff` after every poll that finds nothing new (or fails), up to
+    `max_interval`, and drops back to `min_interval` once new videos show
+    up. Waits are jittered by +/-`jitter` so playlists do not poll in
+    lockstep, and at most `concurrency` polls run at a time. Polls are
+    conditional (ETag / Last-Modified) once a playlist is known.
+
+    Known videos, validators and intervals are kept in `state_file`, so a
+    restart carries on where it stopped. A playlist without state is queued
+    whole on its first poll; the download history skips it if it is already
+    mirrored. Videos whose transfer fails are not marked known and are
+    queued again by a later poll. `options` are passed to AparatDownloader.
+    """
+
+    def __init__(self, engine: "DownloadEngine", playlist_ids: List[str], state_file: Optional[str] = None,
+                 min_interval: float = 120, max_interval: float = 3600, backoff: float = 1.5,
+                 jitter: float = 0.2, concurrency: int = 8, **options):
+        self.engine = engine
+        self.playlist_ids = [str(playlist_id) for playlist_id in playlist_ids]
+        self.state_file = state_file or os.path.join(options.get("destination_path", "Downloads"), ".watch_state.json")
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.backoff = backoff
+        self.jitter = jitter
+        self.concurrency = concurrency
+        self.options = options
+        self.metrics = engine.metrics
+        self.metrics.counter("watch_polls", "Playlist polls made by watch mode")
+        self.metrics.counter("watch_not_modified", "Polls answered 304 Not Modified")
+        self.metrics.counter("watch_new_videos", "Newly appeared videos queued by watch mode")
+        self.logger = logging.getLogger("AparatDownloader")
+        self.state = self.load_state()
+        self._queued: Dict[str, set] = {}  # playlist_id -> uids queued but not finished
+        self._stopped = None
+        self._slots = None
+
+    def load_state(self) -> Dict:
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    return json.load(f)
+        except Exception as e:
+            self.logger.warning(f"Could not load watch state: {e}")
+        return {}
+
+    def save_state(self):
+        try:
+            os.makedirs(os.path.dirname(self.state_file) or ".", exist_ok=True)
+            temp_file = f"{self.state_file}.{os.getpid()}.tmp"
+            with open(temp_file, 'w', encoding='utf-8') as f:
+                json.dump(self.state, f, ensure_ascii=False)
+            os.replace(temp_file, self.state_file)
+        except Exception as e:
+            self.logger.error(f"Could not save watch state: {e}")
+
+    def start(self):
+        """Start polling on the engine loop; returns a future that completes after stop()"""
+        return self.engine.submit(self.run())
+
+    def stop(self):
+        """Stop polling; queued downloads keep running on the engine"""
+        if self._stopped is not None:
+            self.engine.loop.call_soon_threadsafe(self._stopped.set)
+
+    async def run(self):
+        import asyncio
+
+        self._stopped = asyncio.Event()
+        self._slots = asyncio.Semaphore(self.concurrency)
+        watches = [asyncio.ensure_future(self._watch(playlist_id)) for playlist_id in self.playlist_ids]
+        self.logger.info(f"Watching {len(watches)} playlists")
+        try:
+            await self._stopped.wait()
+        finally:
+            for watch in watches:
+                watch.cancel()
+            await asyncio.gather(*watches, return_exceptions=True)
+            self.save_state()
+
+    async def _watch(self, playlist_id: str):
+        import asyncio
+        import random
+
+        state = self.state.setdefault(playlist_id, {"interval": self.min_interval})
+        # New playlists are polled right away; known ones are spread over their interval
+        delay = random.uniform(0, state["interval"]) if "uids" in state else 0
+        while True:
+            await asyncio.sleep(delay)
+            found = await self.poll(playlist_id)
+            state["interval"] = self.min_interval if found else min(state["interval"] * self.backoff, self.max_interval)
+            delay = state["interval"] * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    async def poll(self, playlist_id: str) -> bool:
+        """Poll one playlist and queue its new videos; returns whether there were any"""
+        import asyncio
+
+        state = self.state[playlist_id]
+        known = "uids" in state
+        async with self._slots:
+            try:
+                info, validators = await self.engine.loop.run_in_executor(
+                    None, self.engine.client.get_playlist_info_if_changed, playlist_id, state if known else None
+                )
+            except Exception as e:
+                self.logger.warning(f"Polling playlist {playlist_id} failed: {e}", extra={"playlist_id": playlist_id})
+                return False
+        self.metrics.inc("watch_polls")
+        if info is None:
+            self.metrics.inc("watch_not_modified")
+            return False
+        state.update(validators)
+
+        skip = set(state.get("uids", ())) | self._queued.get(playlist_id, set())
+        videos = [video for video in info["videos"] if video["type"] == "Video" and video["attributes"]["uid"] not in skip]
+        if not videos:
+            return False
+        uids = {video["attributes"]["uid"] for video in videos}
+        self._queued.setdefault(playlist_id, set()).update(uids)
+        self.metrics.inc("watch_new_videos", len(uids))
+        self.logger.info(f"{len(uids)} new videos in '{info['title']}'", extra={"playlist_id": playlist_id})
+
+        batch = dict(info, videos=videos, video_count=len(videos))
+        _, downloader, future = self.engine.download(
+            playlist_id=playlist_id, playlist_info=batch, recheck=known, **self.options
+        )
+        asyncio.wrap_future(future).add_done_callback(
+            lambda done: self._finished(playlist_id, uids, downloader, done)
+        )
+        return True
+
+    def _finished(self, playlist_id: str, uids: set, downloader: "AparatDownloader", done):
+        self._queued[playlist_id] -= uids
+        state = self.state[playlist_id]
+        if done.cancelled() or done.exception() or not done.result():
+            failed = uids
+        else:
+            failed = {
+                transfer["uid"] for transfer in downloader.progress.snapshot()["transfers"]
+                if transfer["state"] != "completed"
+            }
+        if failed:
+            # The next poll must see the whole playlist again to retry them
+            state.pop("etag", None)
+            state.pop("last_modified", None)
+        # From now on the playlist is known, so retries bypass the download history
+        state["uids"] = sorted(set(state.get("uids", ())) | (uids - failed))
+        self.save_state()
+
+
+class JobQueue:
+    """SQLite-backed priority queue of playlist and video jobs that survives restarts
+
+    Playlist jobs are expanded into one video job per resolved task; video
+    jobs inherit the playlist's priority so urgent playlists overtake bulk
+    backfills at the transfer level too. Higher priority runs first.
+    Job states: pending -> running -> completed / failed / cancelled, plus
+    `expanded` for playlist jobs whose videos are still in flight.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            key TEXT UNIQUE,
+            parent_id INTEGER REFERENCES jobs(id),
+            priority INTEGER NOT NULL DEFAULT 0,
+            state TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            payload TEXT NOT NULL,
+            result TEXT,
+            error TEXT,
+            worker TEXT,
+            created REAL NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS jobs_claim ON jobs (state, priority DESC, id);
+        CREATE INDEX IF NOT EXISTS jobs_parent ON jobs (parent_id, state);
+    """
+
+    def __init__(self, path: str, max_attempts: int = 3):
+        import sqlite3
+
+        self.path = path
+        self.max_attempts = max_attempts
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        # Autocommit; multi-statement operations open explicit IMMEDIATE transactions
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self.SCHEMA)
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    @staticmethod
+    def _to_dict(row) -> Optional[Dict]:
+        if row is None:
+            return None
+        job = dict(row)
+        job["payload"] = json.loads(job["payload"])
+        job["result"] = json.loads(job["result"]) if job["result"] else None
+        return job
+
+    def enqueue(self, kind: str, payload: Dict, priority: int = 0, parent_id: int = None, key: str = None) -> int:
+        """Add a job and return its id; a job with an existing key is not added twice"""
+        now = time.time()
+        with self._transaction() as db:
+            if key is not None:
+                row = db.execute("SELECT id FROM jobs WHERE key = ?", (key,)).fetchone()
+                if row:
+                    return row["id"]
+            cursor = db.execute(
+                "INSERT INTO jobs (kind, key, parent_id, priority, payload, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (kind, key, parent_id, priority, json.dumps(payload, ensure_ascii=False), now, now),
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker: str) -> Optional[Dict]:
+        """Atomically take the highest-priority pending job, or None"""
+        with self._transaction() as db:
+            row = db.execute(
+                "SELECT id FROM jobs WHERE state = 'pending' ORDER BY priority DESC, id LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            db.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, worker = ?, updated = ? WHERE id = ?",
+                (worker, time.time(), row["id"]),
+            )
+            return self._to_dict(db.execute("SELECT * FROM jobs WHERE id = ?", (row["id"],)).fetchone())
+
+    def _finish(self, job_id: int, state: str, result=None, error=None):
+        with self._transaction() as db:
+            db.execute(
+                "UPDATE jobs SET state = ?, result = ?, error = ?, updated = ? WHERE id = ? AND state = 'running'",
+                (state, json.dumps(result, ensure_ascii=False) if result is not None else None,
+                 error, time.time(), job_id),
+            )
+
+    def complete(self, job_id: int, result=None):
+        self._finish(job_id, "completed", result)
+
+    def mark_expanded(self, job_id: int, result=None):
+        self._finish(job_id, "expanded", result)
+
+    def fail(self, job_id: int, error: str) -> str:
+        """Record a failed attempt; the job goes back to pending until max_attempts is reached"""
+        with self._transaction() as db:
+            row = db.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            state = "failed" if row and row["attempts"] >= self.max_attempts else "pending"
+            db.execute(
+                "UPDATE jobs SET state = ?, error = ?, updated = ? WHERE id = ? AND state = 'running'",
+                (state, error, time.time(), job_id),
+            )
+        return state
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a job and its unfinished children"""
+        with self._transaction() as db:
+            cursor = db.execute(
+                "UPDATE jobs SET state = 'cancelled', updated = ? "
+                "WHERE (id = ? OR parent_id = ?) AND state IN ('pending', 'running', 'expanded')",
+                (time.time(), job_id, job_id),
+            )
+            return cursor.rowcount > 0
+
+    def finish_parent(self, parent_id: int) -> Optional[str]:
+        """Close an expanded playlist job once none of its videos are pending or running
+
+        Returns the final state for exactly one caller, None otherwise.
+        """
+        with self._transaction() as db:
+            counts = {
+                row["state"]: row["n"]
+                for row in db.execute(
+                    "SELECT state, COUNT(*) AS n FROM jobs WHERE parent_id = ? GROUP BY state", (parent_id,)
+                )
+            }
+            if counts.get("pending") or counts.get("running"):
+                return None
+            state = "failed" if counts.get("failed") else "completed"
+            cursor = db.execute(
+                "UPDATE jobs SET state = ?, updated = ? WHERE id = ? AND state = 'expanded'",
+                (state, time.time(), parent_id),
+            )
+            return state if cursor.rowcount else None
+
+    def recover(self, worker: str = None) -> int:
+        """Return jobs left running by a crashed worker (or any worker) to pending"""
+        with self._transaction() as db:
+            if worker is None:
+                cursor = db.execute("UPDATE jobs SET state = 'pending', updated = ? WHERE state = 'running'",
+                                    (time.time(),))
+            else:
+                cursor = db.execute(
+                    "UPDATE jobs SET state = 'pending', updated = ? WHERE state = 'running' AND worker = ?",
+                    (time.time(), worker),
+                )
+            return cursor.rowcount
+
+    def get(self, job_id: int) -> Optional[Dict]:
+        with self._lock:
+            return self._to_dict(self._db.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def list(self, kind: str = None, parent_id: int = None) -> List[Dict]:
+        query, params = "SELECT * FROM jobs WHERE 1 = 1", []
+        if kind is not None:
+            query += " AND kind = ?"
+            params.append(kind)
+        if parent_id is not None:
+            query += " AND parent_id = ?"
+            params.append(parent_id)
+        with self._lock:
+            return [self._to_dict(row) for row in self._db.execute(query + " ORDER BY id", params)]
+
+    def counts(self, parent_id: int) -> Dict[str, int]:
+        with self._lock:
+            return {
+                row["state"]: row["n"]
+                for row in self._db.execute(
+                    "SELECT state, COUNT(*) AS n FROM jobs WHERE parent_id = ? GROUP BY state", (parent_id,)
+                )
+            }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class QueueRunner:
+    """Drains a JobQueue: expands playlist jobs into video jobs and downloads them
+
+    `options` of a playlist job are the AparatDownloader keyword arguments
+    (playlist_id, quality, auto_quality, destination_path, ...).
+    `event_callback(playlist_job_id, event)` is invoked from worker threads.
+    """
+
+    def __init__(self, job_queue: JobQueue, workers: int = 3, client: Optional[AparatClient] = None,
+                 metrics: Optional[Metrics] = None, event_callback: Optional[Callable] = None,
+                 worker_id: str = None, poll_interval: float = 1.0):
+        self.queue = job_queue
+        self.workers = workers
+        self.metrics = metrics or Metrics()
+        register_downloader_metrics(self.metrics)
+        self.client = client or AparatClient(metrics=self.metrics)
+        self.event_callback = event_callback
+        self.worker_id = worker_id or f"{os.getpid()}"
+        self.poll_interval = poll_interval
+        self.logger = logging.getLogger("AparatDownloader")
+        self._downloaders = {}
+        self._users = {}  # playlist job id -> jobs currently using its downloader
+        self._downloaders_lock = threading.Lock()
+        self._wakeup = None
+
+    def notify(self):
+        """Wake idle workers after new jobs were enqueued from this process"""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _emit(self, playlist_job_id, event: Dict):
+        if self.event_callback:
+            self.event_callback(playlist_job_id, event)
+
+    def _downloader(self, playlist_job: Dict) -> AparatDownloader:
+        with self._downloaders_lock:
+            downloader = self._downloaders.get(playlist_job["id"])
+            if downloader is None:
+                downloader = self._create_downloader(playlist_job)
+                self._downloaders[playlist_job["id"]] = downloader
+        return downloader
+
+    def _acquire(self, playlist_job: Dict) -> AparatDownloader:
+        downloader = self._downloader(playlist_job)
+        with self._downloaders_lock:
+            self._users[playlist_job["id"]] = self._users.get(playlist_job["id"], 0) + 1
+        return downloader
+
+    def _release(self, playlist_job_id):
+        with self._downloaders_lock:
+            self._users[playlist_job_id] -= 1
+            if not self._users[playlist_job_id]:
+                del self._users[playlist_job_id]
+        self._drop_if_done(playlist_job_id)
+
+    def _drop_if_done(self, playlist_job_id):
+        """Close a job's downloader once nothing uses it and the job is finished or cancelled"""
+        with self._downloaders_lock:
+            if playlist_job_id in self._users:
+                return
+            job = self.queue.get(playlist_job_id)
+            if job is not None and job["state"] in ("pending", "running", "expanded"):
+                return
+            downloader = self._downloaders.pop(playlist_job_id, None)
+        if downloader is not None:
+            downloader.close()
+
+    def _create_downloader(self, playlist_job: Dict) -> AparatDownloader:
+        job_id = playlist_job["id"]
+
+        def status_callback(uid, quality, state, downloaded, total):
+            # Keyed by uid and quality; titles can repeat within and across playlists
+            if state == "downloading" and total:
+                self._emit(job_id, {"type": "progress", "uid": uid, "quality": quality,
+                                    "title": downloader.progress.title(uid, quality),
+                                    "progress": downloaded * 100 / total, "downloaded": downloaded, "total": total})
+
+        downloader = AparatDownloader(
+            status_callback=status_callback,
+            metrics=self.metrics,
+            client=self.client,
+            **playlist_job["payload"],
+        )
+        downloader.prepare_destination()
+        return downloader
+
+    def _process_playlist(self, job: Dict):
+        downloader = self._acquire(job)
+        try:
+            self._expand_playlist(job, downloader)
+        finally:
+            self._release(job["id"])
+
+    def _expand_playlist(self, job: Dict, downloader: AparatDownloader):
+        playlist_info = downloader.get_playlist_info()
+        if not playlist_info:
+            raise RuntimeError("could not get playlist information")
+        qualities = downloader.pending_qualities()
+        if not qualities:
+            self.queue.complete(job["id"], {"title": playlist_info["title"], "skipped": True})
+            return
+
+        budget_skipped_before = downloader._counter("downloads_skipped_budget")
+        tasks = downloader.resolve_tasks(playlist_info, qualities=qualities)
+        if not tasks and not downloader.for_download_manager:
+            # Nothing would be downloaded, so the playlist must not be recorded as complete
+            raise RuntimeError("no videos to download (none offered in the requested qualities or within the budget)")
+        for task in tasks:
+            self.queue.enqueue(
+                "video", task, priority=job["priority"], parent_id=job["id"],
+                key=f"{job['id']}:{task['uid']}:{task['quality']}",
+            )
+        result = {
+            "title": playlist_info["title"], "video_count": playlist_info["video_count"], "qualities": qualities,
+            "budget_skipped": downloader._counter("downloads_skipped_budget") - budget_skipped_before,
+        }
+        self.queue.mark_expanded(job["id"], result)
+        self._emit(job["id"], {"type": "expanded", "title": playlist_info["title"], "videos": len(tasks)})
+        self._finish_playlist(job["id"])
+
+    def _process_video(self, job: Dict):
+        parent = self.queue.get(job["parent_id"])
+        if parent is None or parent["state"] == "cancelled":
+            self._drop_if_done(job["parent_id"])
+            return
+        downloader = self._acquire(parent)
+        try:
+            # Registers the title that progress events carry
+            downloader.progress.add_tasks([job["payload"]])
+            if downloader.download_task(job["payload"]):
+                self.queue.complete(job["id"])
+            else:
+                self.queue.fail(job["id"], "download failed")
+            self._finish_playlist(parent["id"])
+        finally:
+            self._release(parent["id"])
+
+    def _finish_playlist(self, playlist_job_id):
+        state = self.queue.finish_parent(playlist_job_id)
+        if state is None:
+            return
+        parent = self.queue.get(playlist_job_id)
+        if state == "completed" and not (parent["result"] or {}).get("budget_skipped"):
+            downloader = self._downloader(parent)
+            completed = self.queue.counts(playlist_job_id).get("completed", 0)
+            qualities = parent["result"].get("qualities") or [downloader.primary_quality]
+            for quality in qualities:
+                downloader.record_history(parent["result"]["title"], completed // len(qualities), quality)
+        self._emit(playlist_job_id, {"type": "state", "state": state})
+
+    def cancel(self, job_id: int) -> bool:
+        """Cancel a playlist job and its videos, stopping transfers already running"""
+        cancelled = self.queue.cancel(job_id)
+        with self._downloaders_lock:
+            downloader = self._downloaders.get(job_id)
+        if downloader is not None:
+            # Kept registered while video jobs claimed before the cancel still use it
+            downloader.cancel()
+        self._drop_if_done(job_id)
+        return cancelled
+
+    def process(self, job: Dict):
+        """Run one claimed job on the calling thread"""
+        try:
+            if job["kind"] == "playlist":
+                self._process_playlist(job)
+            else:
+                self._process_video(job)
+        except Exception as e:
+            self.logger.error(f"Job {job['id']} failed: {e}")
+            state = self.queue.fail(job["id"], str(e))
+            if job["kind"] == "playlist" and state == "failed":
+                self._drop_if_done(job["id"])
+                self._emit(job["id"], {"type": "state", "state": "failed", "error": str(e)})
+
+    async def run(self, stop_when_idle: bool = False):
+        """Run worker coroutines until cancelled (or until the queue is drained)"""
+        import asyncio
+
+        self._wakeup = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        idle = [False] * self.workers
+
+        async def worker(index):
+            name = f"{self.worker_id}-{index}"
+            while True:
+                job = await loop.run_in_executor(None, self.queue.claim, name)
+                if job is None:
+                    idle[index] = True
+                    if stop_when_idle and all(idle):
+                        return
+                    self._wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                idle[index] = False
+                self.metrics.inc("active_downloads")
+                try:
+                    await loop.run_in_executor(None, self.process, job)
+                finally:
+                    self.metrics.dec("active_downloads")
+
+        await asyncio.gather(*[worker(index) for index in range(self.workers)])
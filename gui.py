@@ -4,11 +4,12 @@ import platform
 import re
 import subprocess
 import sys
-import asyncio
+import threading
+from html import escape
 from urllib.parse import urlparse
 
-from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer, QMimeData
-from PyQt5.QtGui import QFont, QDragEnterEvent, QDropEvent
+from PyQt5.QtCore import Qt, QObject, pyqtSignal, QTimer, QMimeData, QAbstractListModel, QModelIndex, QRect, QSize
+from PyQt5.QtGui import QFont, QFontMetrics, QColor, QDragEnterEvent, QDropEvent
 from PyQt5.QtWidgets import (
     QApplication,
     QMainWindow,
@@ -22,11 +23,10 @@ from PyQt5.QtWidgets import (
     QFileDialog,
     QFrame,
     QStyle,
+    QStyledItemDelegate,
+    QStyleOptionProgressBar,
     QListView,
     QMessageBox,
-    QProgressBar,
-    QListWidget,
-    QListWidgetItem,
     QTextEdit,
     QTabWidget,
     QCheckBox,
@@ -35,64 +35,99 @@ from PyQt5.QtWidgets import (
     QSplitter,
 )
 
-from core import AparatDownloader
+from core import DownloadEngine, format_duration, format_size
 
 
-class PreviewWorker(QThread):
+class PreviewWorker(QObject):
     finished = pyqtSignal(dict)
+    estimated = pyqtSignal(dict)
     error = pyqtSignal(str)
 
-    def __init__(self, playlist_id):
+    def __init__(self, engine, playlist_id, quality="720", auto_quality=False, max_concurrent=3):
         super().__init__()
+        self.engine = engine
         self.playlist_id = playlist_id
+        self.quality = quality
+        self.auto_quality = auto_quality
+        self.max_concurrent = max_concurrent
 
-    def run(self):
+    def start(self):
+        # The future completes on the engine thread; the signals are queued to the GUI thread
+        self.engine.preview(self.playlist_id).add_done_callback(self._done)
+
+    def _done(self, future):
         try:
-            downloader = AparatDownloader(playlist_id=self.playlist_id)
-            info = downloader.get_playlist_info()
+            info = future.result()
             if info:
                 self.finished.emit(info)
             else:
                 self.error.emit("خطا در دریافت اطلاعات پلی‌لیست")
+                return
         except Exception as e:
             self.error.emit(f"خطا: {str(e)}")
+            return
+        # Sizes and ETA take longer, so they follow the basic information
+        self.engine.estimate(
+            self.playlist_id,
+            quality=self.quality,
+            auto_quality=self.auto_quality,
+            max_concurrent_downloads=self.max_concurrent,
+        ).add_done_callback(self._estimated)
+
+    def _estimated(self, future):
+        try:
+            self.estimated.emit(future.result())
+        except Exception as e:
+            self.error.emit(f"خطا در محاسبه حجم: {str(e)}")
 
 
-class DownloadWorker(QThread):
+class DownloadWorker(QObject):
     finished = pyqtSignal(bool, str)
-    progress_update = pyqtSignal(str, float, int, int)  # title, progress, downloaded, total
 
-    def __init__(self, playlist_id, quality, for_download_manager, destination_path, auto_quality=False, max_concurrent=3):
+    def __init__(self, engine, progress_widget, playlist_id, quality, for_download_manager, destination_path,
+                 auto_quality=False, max_concurrent=3):
         super().__init__()
+        self.engine = engine
+        self.progress_widget = progress_widget
         self.playlist_id = playlist_id
         self.quality = quality
         self.for_download_manager = for_download_manager
         self.destination_path = destination_path
         self.auto_quality = auto_quality
         self.max_concurrent = max_concurrent
+        self.job_id = None
+        self.downloader = None
+
+    def start(self):
+        """Queue the playlist on the shared engine"""
+        self.job_id, self.downloader, future = self.engine.download(
+            playlist_id=self.playlist_id,
+            quality=self.quality,
+            for_download_manager=self.for_download_manager,
+            destination_path=self.destination_path,
+            tasks_callback=self.progress_widget.add_tasks,
+            status_callback=self.progress_widget.update_status,
+            auto_quality=self.auto_quality,
+            max_concurrent_downloads=self.max_concurrent,
+        )
+        self.progress_widget.track(self.downloader.progress)
+        future.add_done_callback(self._done)
+
+    def pause(self):
+        self.downloader.pause()
 
-    def progress_callback(self, title, progress, downloaded, total):
-        self.progress_update.emit(title, progress, downloaded, total)
+    def resume(self):
+        self.downloader.resume()
 
-    def run(self):
+    def cancel(self):
+        self.downloader.cancel()
+
+    def _done(self, future):
         try:
-            downloader = AparatDownloader(
-                playlist_id=self.playlist_id,
-                quality=self.quality,
-                for_download_manager=self.for_download_manager,
-                destination_path=self.destination_path,
-                progress_callback=self.progress_callback,
-                auto_quality=self.auto_quality,
-                max_concurrent_downloads=self.max_concurrent,
-            )
-            
-            # Use async version
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            result = loop.run_until_complete(downloader.download_playlist_async())
-            loop.close()
-            
-            if result:
+            result = future.result()
+            if self.downloader.control.cancelled:
+                self.finished.emit(False, "دانلود لغو شد. با اجرای دوباره، دانلود از همان نقطه ادامه می‌یابد.")
+            elif result:
                 self.finished.emit(True, "عملیات با موفقیت به پایان رسید.")
             else:
                 self.finished.emit(False, "خطا در دانلود پلی‌لیست")
@@ -101,11 +136,191 @@ class DownloadWorker(QThread):
             self.finished.emit(False, error_msg)
 
 
+STATE_LABELS = {
+    "queued": "در انتظار...",
+    "downloading": "در حال دانلود",
+    "paused": "متوقف شده",
+    "completed": "تکمیل شد",
+    "failed": "ناموفق",
+    "cancelled": "لغو شد",
+    "skipped": "رد شد (فضای ناکافی)",
+}
+STATE_COLORS = {"completed": "#4CAF50", "failed": "#e53935", "skipped": "#e53935", "cancelled": "#9e9e9e"}
+
+
+class ProgressModel(QAbstractListModel):
+    """One row per (uid, quality) transfer
+
+    `add_tasks` and `update` may be called from any thread; they only
+    record changes, which `apply_pending` folds into the model in one
+    batch on the GUI thread.
+    """
+
+    EntryRole = Qt.UserRole + 1
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.entries = []
+        self.rows = {}  # (uid, quality) -> row
+        self.trackers = []
+        self._lock = threading.Lock()
+        self._new_tasks = []
+        self._pending = {}
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.entries)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        entry = self.entries[index.row()]
+        if role == Qt.DisplayRole:
+            return entry["title"]
+        if role == self.EntryRole:
+            return entry
+        return None
+
+    def add_tasks(self, tasks):
+        with self._lock:
+            self._new_tasks.extend(tasks)
+
+    def update(self, uid, quality, state, downloaded=0, total=0):
+        with self._lock:
+            # Only the latest state per transfer survives until the next batch
+            self._pending[(uid, quality)] = (state, downloaded, total)
+
+    def apply_pending(self):
+        with self._lock:
+            new_tasks, self._new_tasks = self._new_tasks, []
+            pending, self._pending = self._pending, {}
+
+        new_entries = []
+        for task in new_tasks:
+            key = (task.get("uid"), task.get("quality"))
+            if key in self.rows:
+                continue
+            self.rows[key] = len(self.entries) + len(new_entries)
+            title = task["title"]
+            if task.get("quality") and task["quality"] != "auto":
+                title = f"{title} ({task['quality']}p)"
+            new_entries.append({
+                "title": title, "state": "queued", "downloaded": 0, "total": task.get("size") or 0,
+                "rate": 0.0, "eta": None,
+            })
+        if new_entries:
+            self.beginInsertRows(QModelIndex(), len(self.entries), len(self.entries) + len(new_entries) - 1)
+            self.entries.extend(new_entries)
+            self.endInsertRows()
+
+        changed = []
+        for key, (state, downloaded, total) in pending.items():
+            row = self.rows.get(key)
+            if row is None:
+                continue
+            entry = self.entries[row]
+            entry["state"] = state
+            if state == "downloading" or downloaded:
+                entry["downloaded"] = downloaded
+            if total:
+                entry["total"] = total
+            if state == "completed" and entry["total"]:
+                entry["downloaded"] = entry["total"]
+            if state != "downloading":
+                entry["rate"], entry["eta"] = 0.0, None
+            changed.append(row)
+
+        # Speed and ETA come from each run's tracker; only active rows change
+        for tracker in self.trackers:
+            for transfer in tracker.snapshot(active_only=True)["transfers"]:
+                row = self.rows.get((transfer["uid"], transfer["quality"]))
+                if row is not None and transfer["state"] == "downloading":
+                    self.entries[row]["rate"], self.entries[row]["eta"] = transfer["rate"], transfer["eta"]
+                    changed.append(row)
+        if changed:
+            self.dataChanged.emit(self.index(min(changed)), self.index(max(changed)))
+
+    def totals(self):
+        """Combined totals of every tracked run"""
+        totals = {"finished": 0, "count": 0, "downloaded": 0, "total": 0, "rate": 0.0}
+        for tracker in self.trackers:
+            snapshot = tracker.snapshot(active_only=True)
+            totals["count"] += sum(snapshot["states"].values())
+            totals["finished"] += sum(snapshot["states"].get(state, 0) for state in ("completed", "failed", "cancelled", "skipped"))
+            totals["downloaded"] += snapshot["downloaded"]
+            totals["total"] += snapshot["total"]
+            totals["rate"] += snapshot["rate"]
+        remaining = totals["total"] - totals["downloaded"]
+        totals["eta"] = remaining / totals["rate"] if totals["rate"] > 0 and totals["total"] else None
+        return totals
+
+    def clear(self):
+        with self._lock:
+            self._new_tasks, self._pending = [], {}
+        self.beginResetModel()
+        self.entries = []
+        self.rows = {}
+        self.trackers = []
+        self.endResetModel()
+
+
+class ProgressDelegate(QStyledItemDelegate):
+    """Paints a title, a progress bar and a status line without per-row widgets"""
+
+    ROW_HEIGHT = 62
+
+    def sizeHint(self, option, index):
+        return QSize(option.rect.width(), self.ROW_HEIGHT)
+
+    def paint(self, painter, option, index):
+        entry = index.data(ProgressModel.EntryRole)
+        rect = option.rect.adjusted(8, 4, -8, -4)
+        painter.save()
+
+        painter.setPen(QColor("#f0f0f0"))
+        painter.drawLine(option.rect.bottomLeft(), option.rect.bottomRight())
+
+        font = QFont(option.font)
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(QColor("#212121"))
+        title_rect = QRect(rect.left(), rect.top(), rect.width(), 18)
+        title = QFontMetrics(font).elidedText(entry["title"], Qt.ElideRight, title_rect.width())
+        painter.drawText(title_rect, Qt.AlignVCenter | Qt.AlignRight, title)
+
+        percent = int(entry["downloaded"] * 100 / entry["total"]) if entry["total"] else 0
+        bar = QStyleOptionProgressBar()
+        bar.rect = QRect(rect.left(), rect.top() + 20, rect.width(), 16)
+        bar.minimum, bar.maximum, bar.progress = 0, 100, percent
+        bar.text = f"{percent}%"
+        bar.textVisible = True
+        QApplication.style().drawControl(QStyle.CE_ProgressBar, bar, painter)
+
+        font = QFont(option.font)
+        font.setPointSize(max(font.pointSize() - 2, 7))
+        painter.setFont(font)
+        painter.setPen(QColor(STATE_COLORS.get(entry["state"], "#666")))
+        status = STATE_LABELS.get(entry["state"], entry["state"])
+        if entry["total"] and entry["state"] in ("downloading", "paused"):
+            status = f"{status} - {format_size(entry['downloaded'])} / {format_size(entry['total'])}"
+        if entry["rate"]:
+            status += f" - {format_size(entry['rate'])}/s"
+            if entry["eta"] is not None:
+                status += f" - {format_duration(entry['eta'])} مانده"
+        painter.drawText(QRect(rect.left(), rect.top() + 38, rect.width(), 16), Qt.AlignVCenter | Qt.AlignRight, status)
+        painter.restore()
+
+
 class ProgressWidget(QWidget):
+    REFRESH_INTERVAL_MS = 200
+
     def __init__(self):
         super().__init__()
+        self.model = ProgressModel(self)
         self.init_ui()
-        self.downloads = {}  # Track individual downloads
+        # Worker threads only record changes; the view repaints once per tick
+        self.refresh_timer = QTimer(self)
+        self.refresh_timer.timeout.connect(self.refresh)
+        self.refresh_timer.start(self.REFRESH_INTERVAL_MS)
 
     def init_ui(self):
         layout = QVBoxLayout(self)
@@ -116,91 +331,54 @@ class ProgressWidget(QWidget):
         title.setStyleSheet("font-weight: bold; font-size: 14px; padding: 5px;")
         layout.addWidget(title)
 
-        # Download list
-        self.download_list = QListWidget()
+        self.summary_label = QLabel()
+        self.summary_label.setStyleSheet("color: #666; padding: 0 5px;")
+        layout.addWidget(self.summary_label)
+
+        # Download list; uniform row heights let the view lay out only visible rows
+        self.download_list = QListView()
+        self.download_list.setModel(self.model)
+        self.download_list.setItemDelegate(ProgressDelegate(self.download_list))
+        self.download_list.setUniformItemSizes(True)
+        self.download_list.setSelectionMode(QListView.NoSelection)
         self.download_list.setStyleSheet("""
-        QListWidget {
+        QListView {
             border: 1px solid #e0e0e0;
             border-radius: 5px;
             background-color: white;
         }
-        QListWidgetItem {
-            padding: 5px;
-            border-bottom: 1px solid #f0f0f0;
-        }
         """)
         layout.addWidget(self.download_list)
 
-    def add_download(self, title):
-        """Add a new download to the queue"""
-        item = QListWidgetItem()
-        widget = QWidget()
-        layout = QVBoxLayout(widget)
-        layout.setContentsMargins(5, 5, 5, 5)
-
-        # Title
-        title_label = QLabel(title)
-        title_label.setStyleSheet("font-weight: bold;")
-        layout.addWidget(title_label)
-
-        # Progress bar
-        progress_bar = QProgressBar()
-        progress_bar.setRange(0, 100)
-        progress_bar.setValue(0)
-        progress_bar.setStyleSheet("""
-        QProgressBar {
-            border: 1px solid #bdbdbd;
-            border-radius: 3px;
-            text-align: center;
-            height: 20px;
-        }
-        QProgressBar::chunk {
-            background-color: #4CAF50;
-            border-radius: 2px;
-        }
-        """)
-        layout.addWidget(progress_bar)
-
-        # Status label
-        status_label = QLabel("در انتظار...")
-        status_label.setStyleSheet("color: #666; font-size: 10px;")
-        layout.addWidget(status_label)
-
-        item.setSizeHint(widget.sizeHint())
-        self.download_list.addItem(item)
-        self.download_list.setItemWidget(item, widget)
-
-        self.downloads[title] = {
-            'item': item,
-            'widget': widget,
-            'progress_bar': progress_bar,
-            'status_label': status_label
-        }
-
-    def update_progress(self, title, progress, downloaded, total):
-        """Update download progress"""
-        if title in self.downloads:
-            download_info = self.downloads[title]
-            download_info['progress_bar'].setValue(int(progress))
-            
-            # Format file sizes
-            downloaded_mb = downloaded / (1024 * 1024)
-            total_mb = total / (1024 * 1024)
-            status_text = f"{downloaded_mb:.1f} MB / {total_mb:.1f} MB ({progress:.1f}%)"
-            download_info['status_label'].setText(status_text)
-
-    def mark_completed(self, title):
-        """Mark download as completed"""
-        if title in self.downloads:
-            download_info = self.downloads[title]
-            download_info['progress_bar'].setValue(100)
-            download_info['status_label'].setText("تکمیل شد")
-            download_info['status_label'].setStyleSheet("color: #4CAF50; font-size: 10px; font-weight: bold;")
+    def refresh(self):
+        self.model.apply_pending()
+        totals = self.model.totals()
+        if not totals["count"]:
+            self.summary_label.clear()
+            return
+        summary = (f"{totals['finished']}/{totals['count']} ویدئو - "
+                   f"{format_size(totals['downloaded'])} / {format_size(totals['total'])}")
+        if totals["rate"]:
+            summary += f" - {format_size(totals['rate'])}/s"
+        if totals["eta"] is not None:
+            summary += f" - {format_duration(totals['eta'])} مانده"
+        self.summary_label.setText(summary)
+
+    def track(self, tracker):
+        """Show speed, ETA and totals from a run's ProgressTracker"""
+        self.model.trackers.append(tracker)
+
+    def add_tasks(self, tasks):
+        """Add resolved download tasks to the list; safe to call from any thread"""
+        self.model.add_tasks(tasks)
+
+    def update_status(self, uid, quality, state, downloaded, total):
+        """Record a transfer state change; safe to call from any thread"""
+        self.model.update(uid, quality, state, downloaded, total)
 
     def clear_downloads(self):
         """Clear all downloads"""
-        self.download_list.clear()
-        self.downloads.clear()
+        self.model.clear()
 
 
 class PreviewWidget(QWidget):
@@ -255,11 +433,41 @@ class PreviewWidget(QWidget):
         
         html_content += """
             </ul>
+            <p style="color: #666;">در حال محاسبه حجم و زمان تقریبی...</p>
         </div>
         """
         
         self.info_display.setHtml(html_content)
 
+    def show_estimate(self, estimate):
+        """Display sizes per quality and per video, and the estimated download time"""
+        html_content = f"""
+        <div style="direction: rtl; text-align: right;">
+            <h3 style="color: #2196F3;">{escape(estimate['title'])}</h3>
+            <p><strong>تعداد ویدئوها:</strong> {estimate['video_count']}</p>
+        """
+        if estimate['eta_seconds'] is not None:
+            html_content += (
+                f"<p><strong>زمان تقریبی دانلود:</strong> {format_duration(estimate['eta_seconds'])}"
+                f" (سرعت اندازه‌گیری شده: {format_size(estimate['throughput'])}/s)</p>"
+            )
+        for quality, variant in estimate['qualities'].items():
+            label = "بهترین کیفیت موجود" if quality == "auto" else f"{quality}p"
+            html_content += f"<hr><h4>{label}: {format_size(variant['total_size'])}</h4>"
+            if variant['unknown']:
+                html_content += f"<p>حجم {variant['unknown']} ویدئو نامشخص است</p>"
+            if variant['missing']:
+                html_content += f"<p>{variant['missing']} ویدئو در این کیفیت موجود نیست</p>"
+            html_content += "<ol>"
+            for video in variant['videos']:
+                size = format_size(video['size']) if video['size'] is not None else "نامشخص"
+                profile = video['profile'] or "-"
+                html_content += f"<li>{escape(video['title'])} <span style='color: #666;'>({profile}، {size})</span></li>"
+            html_content += "</ol>"
+        html_content += "</div>"
+
+        self.info_display.setHtml(html_content)
+
     def clear_info(self):
         """Clear preview information"""
         self.info_display.clear()
@@ -278,7 +486,8 @@ class ModernApp(QMainWindow):
         self.auto_quality_checkbox = None
         self.concurrent_spinbox = None
         self.frame_style = None
-        self.worker = None
+        self.engine = DownloadEngine()
+        self.workers = []
         self.preview_worker = None
         self.progress_widget = None
         self.preview_widget = None
@@ -592,6 +801,20 @@ class ModernApp(QMainWindow):
         self.run_button.clicked.connect(self.run_action)
 
         layout.addWidget(self.run_button)
+
+        # Pause / cancel buttons for the running job
+        control_layout = QHBoxLayout()
+        self.pause_button = QPushButton("توقف موقت")
+        self.pause_button.setCursor(Qt.PointingHandCursor)
+        self.pause_button.setEnabled(False)
+        self.pause_button.clicked.connect(self.toggle_pause)
+        self.cancel_button = QPushButton("لغو دانلود")
+        self.cancel_button.setCursor(Qt.PointingHandCursor)
+        self.cancel_button.setEnabled(False)
+        self.cancel_button.clicked.connect(self.cancel_download)
+        control_layout.addWidget(self.pause_button)
+        control_layout.addWidget(self.cancel_button)
+        layout.addLayout(control_layout)
         layout.addStretch()
 
         return panel
@@ -652,8 +875,16 @@ class ModernApp(QMainWindow):
         self.preview_button.setEnabled(False)
         self.preview_button.setText("در حال بارگذاری...")
         
-        self.preview_worker = PreviewWorker(playlist_id)
+        quality = self.quality_input.text().strip()
+        self.preview_worker = PreviewWorker(
+            self.engine,
+            playlist_id,
+            quality=quality if quality.isdigit() else "720",
+            auto_quality=self.auto_quality_checkbox.isChecked(),
+            max_concurrent=self.concurrent_spinbox.value(),
+        )
         self.preview_worker.finished.connect(self.on_preview_finished)
+        self.preview_worker.estimated.connect(self.on_preview_estimated)
         self.preview_worker.error.connect(self.on_preview_error)
         self.preview_worker.start()
 
@@ -665,6 +896,11 @@ class ModernApp(QMainWindow):
         self.preview_button.setEnabled(True)
         self.preview_button.setText("پیش‌نمایش")
 
+    def on_preview_estimated(self, estimate):
+        """Replace the preview with sizes and ETA, unless a newer preview was started"""
+        if self.sender() is self.preview_worker:
+            self.preview_widget.show_estimate(estimate)
+
     def on_preview_error(self, error):
         """Handle preview error"""
         self.preview_widget.clear_info()
@@ -703,30 +939,47 @@ class ModernApp(QMainWindow):
         error_msg.exec_()
 
     def set_ui_enabled(self, enabled):
-        """Enable/disable UI elements during operation"""
-        self.link_input.setEnabled(enabled)
-        self.quality_input.setEnabled(enabled and not self.auto_quality_checkbox.isChecked())
-        self.folder_input.setEnabled(enabled)
-        self.browse_button.setEnabled(enabled)
-        self.combo_box.setEnabled(enabled)
-        self.auto_quality_checkbox.setEnabled(enabled)
-        self.concurrent_spinbox.setEnabled(enabled)
-        self.preview_button.setEnabled(enabled)
-        self.run_button.setEnabled(enabled)
+        """Switch between the idle state and the state while downloads are queued"""
+        # Inputs stay editable while busy so more playlists can be queued on the engine
+        self.pause_button.setEnabled(not enabled)
+        self.cancel_button.setEnabled(not enabled)
+        self.pause_button.setText("توقف موقت")
 
         if not enabled:
-            self.run_button.setText("در حال پردازش...")
+            self.run_button.setText("افزودن به صف")
         else:
             self.run_button.setText("شروع دانلود")
 
-    def on_download_progress(self, title, progress, downloaded, total):
-        """Handle download progress updates"""
-        self.progress_widget.update_progress(title, progress, downloaded, total)
+    def toggle_pause(self):
+        """Pause or resume every queued and running download"""
+        if not self.workers:
+            return
+        if self.workers[0].downloader.control.paused:
+            for worker in self.workers:
+                worker.resume()
+            self.pause_button.setText("توقف موقت")
+        else:
+            for worker in self.workers:
+                worker.pause()
+            self.pause_button.setText("ادامه")
+
+    def cancel_download(self):
+        """Cancel every queued and running download, keeping partial files for resume"""
+        if self.workers:
+            for worker in self.workers:
+                worker.cancel()
+            self.pause_button.setEnabled(False)
+            self.cancel_button.setEnabled(False)
+            self.run_button.setText("در حال توقف...")
 
     def on_download_finished(self, success, message):
         """Handle download completion"""
-        # Re-enable UI
-        self.set_ui_enabled(True)
+        worker = self.sender()
+        if worker in self.workers:
+            self.workers.remove(worker)
+            worker.deleteLater()
+        if not self.workers:
+            self.set_ui_enabled(True)
 
         # Switch to progress tab
         self.tab_widget.setCurrentIndex(1)
@@ -756,11 +1009,6 @@ class ModernApp(QMainWindow):
             msg_box.addButton("تایید", QMessageBox.AcceptRole)
             msg_box.exec_()
 
-        # Clean up worker
-        if self.worker:
-            self.worker.deleteLater()
-            self.worker = None
-
     def run_action(self):
         """Execute download action"""
         selected_option = self.combo_box.currentText()
@@ -792,17 +1040,18 @@ class ModernApp(QMainWindow):
             self.show_error_message(errors)
             return
 
-        # Clear previous progress and prepare for new download
-        self.progress_widget.clear_downloads()
-        
-        # Disable UI during operation
-        self.set_ui_enabled(False)
+        # Clear previous progress unless this playlist joins the queue
+        if not self.workers:
+            self.progress_widget.clear_downloads()
+            self.set_ui_enabled(False)
 
         # Start download in background thread
         playlist_id = link if link.isdigit() else link.split("/")[-1]
         for_download_manager = selected_option == "استخراج لینک ها"
 
-        self.worker = DownloadWorker(
+        worker = DownloadWorker(
+            self.engine,
+            self.progress_widget,
             playlist_id=playlist_id,
             quality=quality if not auto_quality else "720",  # Default for auto
             for_download_manager=for_download_manager,
@@ -811,14 +1060,20 @@ class ModernApp(QMainWindow):
             max_concurrent=max_concurrent
         )
 
-        self.worker.finished.connect(self.on_download_finished)
-        self.worker.progress_update.connect(self.on_download_progress)
-        self.worker.start()
+        worker.finished.connect(self.on_download_finished)
+        self.workers.append(worker)
+        worker.start()
 
         # Switch to progress tab
         self.tab_widget.setCurrentIndex(1)
 
 
+    def closeEvent(self, event):
+        """Cancel outstanding downloads and stop the engine loop"""
+        self.engine.shutdown()
+        super().closeEvent(event)
+
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     app.setStyle("Fusion")
@@ -0,0 +1,207 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
+
+from aiohttp import web
+
+from core import AparatClient, JobQueue, Metrics, QueueRunner, register_downloader_metrics
+
+
+ACTIVE_STATES = ("pending", "running", "expanded")
+
+
+class DownloadService:
+    """Long-lived download engine shared by every job submitted over HTTP
+
+    Jobs are stored in a SQLite JobQueue, so queued and half-finished
+    playlists resume after a restart. All jobs share one AparatClient (and
+    its connection pool), one metrics registry and one set of `workers`
+    that always pick the highest-priority pending video.
+    """
+
+    def __init__(self, destination_path="Downloads", workers=8, queue_path=None):
+        self.destination_path = destination_path
+        self.workers = workers
+        self.metrics = Metrics()
+        register_downloader_metrics(self.metrics)
+        self.client = AparatClient(metrics=self.metrics, pool_size=workers * 2)
+        self.queue = JobQueue(queue_path or os.path.join(destination_path, ".jobs.sqlite"))
+        self.runner = QueueRunner(
+            self.queue,
+            workers=workers,
+            client=self.client,
+            metrics=self.metrics,
+            event_callback=self._on_event,
+        )
+        self.progress: Dict[int, Dict] = {}
+        self._subscribers: Dict[int, set] = {}
+        self._loop = None
+        self._runner_task = None
+
+    async def start(self, app=None):
+        self._loop = asyncio.get_running_loop()
+        # Workers block in transfers, so size the default executor to match
+        self._loop.set_default_executor(ThreadPoolExecutor(max_workers=self.workers * 2, thread_name_prefix="worker"))
+        recovered = self.queue.recover()
+        if recovered:
+            self.runner.logger.info(f"Resuming {recovered} interrupted jobs")
+        self._runner_task = self._loop.create_task(self.runner.run())
+
+    async def stop(self, app=None):
+        if self._runner_task:
+            self._runner_task.cancel()
+        self.client.close()
+
+    def submit(self, options: Dict, priority: int = 0) -> Dict:
+        qualities = [q.strip() for q in str(options.get("quality", "720")).split(",") if q.strip()]
+        quality = qualities[0]
+        payload = {
+            "playlist_id": options["playlist_id"],
+            "quality": "720" if quality == "auto" else quality,
+            "auto_quality": quality == "auto",
+            "qualities": qualities,
+            "for_download_manager": bool(options.get("links_only", False)),
+            "destination_path": options.get("destination", self.destination_path),
+        }
+        job_id = self.queue.enqueue("playlist", payload, priority=priority)
+        self.runner.notify()
+        return self.job_status(job_id)
+
+    def cancel(self, job_id) -> bool:
+        cancelled = self.runner.cancel(job_id)
+        if cancelled:
+            self._publish(job_id, {"type": "state", "state": "cancelled"})
+        return cancelled
+
+    def job_status(self, job_id):
+        job = self.queue.get(job_id)
+        if job is None or job["kind"] != "playlist":
+            return None
+        job["videos"] = self.queue.counts(job_id)
+        job["progress"] = self.progress.get(job_id, {})
+        return job
+
+    def list_jobs(self):
+        return [self.job_status(job["id"]) for job in self.queue.list(kind="playlist")]
+
+    @staticmethod
+    def _progress_key(event) -> str:
+        # Titles repeat within and across playlists; uid and quality do not within a job
+        return f"{event['uid']}/{event['quality']}"
+
+    def _on_event(self, job_id, event):
+        # Called from worker threads; throttle progress to whole percents
+        if event["type"] == "progress":
+            previous = self.progress.get(job_id, {}).get(self._progress_key(event))
+            if previous and int(previous["progress"]) == int(event["progress"]):
+                return
+        self._loop.call_soon_threadsafe(self._publish, job_id, event)
+
+    def _publish(self, job_id, event):
+        if event["type"] == "progress":
+            self.progress.setdefault(job_id, {})[self._progress_key(event)] = {
+                key: event[key] for key in ("uid", "quality", "title", "progress", "downloaded", "total")
+            }
+        for subscriber in list(self._subscribers.get(job_id, ())):
+            if subscriber.full():
+                # Slow SSE clients lose intermediate progress, never the final state
+                subscriber.get_nowait()
+            subscriber.put_nowait(event)
+
+    def subscribe(self, job_id) -> asyncio.Queue:
+        subscriber = asyncio.Queue(maxsize=256)
+        self._subscribers.setdefault(job_id, set()).add(subscriber)
+        return subscriber
+
+    def unsubscribe(self, job_id, subscriber):
+        self._subscribers.get(job_id, set()).discard(subscriber)
+
+
+def create_app(service: DownloadService) -> web.Application:
+    """Build the HTTP/JSON job API around a DownloadService"""
+    routes = web.RouteTableDef()
+
+    def json_error(error_class, message):
+        return error_class(text=json.dumps({"error": message}), content_type="application/json")
+
+    def get_job(request) -> Dict:
+        job_id = request.match_info["job_id"]
+        job = service.job_status(int(job_id)) if job_id.isdigit() else None
+        if job is None:
+            raise json_error(web.HTTPNotFound, "unknown job")
+        return job
+
+    @routes.post("/jobs")
+    async def enqueue(request):
+        try:
+            options = await request.json()
+        except ValueError:
+            raise json_error(web.HTTPBadRequest, "invalid JSON")
+        playlist_id = str(options.get("playlist_id", "")).rstrip("/").split("/")[-1]
+        if not playlist_id.isdigit():
+            raise json_error(web.HTTPBadRequest, "playlist_id must be numeric")
+        options["playlist_id"] = playlist_id
+        qualities = [q.strip() for q in str(options.get("quality", "720")).split(",") if q.strip()]
+        if not qualities or not all(q == "auto" or q.isdigit() for q in qualities):
+            raise json_error(web.HTTPBadRequest, "quality must be a number, 'auto' or a comma separated list")
+        try:
+            priority = int(options.get("priority", 0))
+        except (TypeError, ValueError):
+            raise json_error(web.HTTPBadRequest, "priority must be an integer")
+        return web.json_response(service.submit(options, priority), status=201)
+
+    @routes.get("/jobs")
+    async def list_jobs(request):
+        return web.json_response(service.list_jobs())
+
+    @routes.get("/jobs/{job_id}")
+    async def job_status(request):
+        return web.json_response(get_job(request))
+
+    @routes.delete("/jobs/{job_id}")
+    async def cancel_job(request):
+        job = get_job(request)
+        return web.json_response({"id": job["id"], "cancelled": service.cancel(job["id"])})
+
+    @routes.get("/jobs/{job_id}/events")
+    async def job_events(request):
+        job = get_job(request)
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+        subscriber = service.subscribe(job["id"])
+        state = job["state"]
+        try:
+            await response.write(f"data: {json.dumps({'type': 'state', 'state': state})}\n\n".encode())
+            while state in ACTIVE_STATES or not subscriber.empty():
+                event = await subscriber.get()
+                if event["type"] == "state":
+                    state = event["state"]
+                await response.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+        finally:
+            service.unsubscribe(job["id"], subscriber)
+        return response
+
+    @routes.get("/metrics")
+    async def metrics(request):
+        return web.Response(text=service.metrics.to_openmetrics(),
+                            content_type="application/openmetrics-text", charset="utf-8")
+
+    app = web.Application()
+    app.add_routes(routes)
+    app.on_startup.append(service.start)
+    app.on_cleanup.append(service.stop)
+    return app
+
+
+async def serve(host="127.0.0.1", port=8765, destination_path="Downloads", workers=8, queue_path=None):
+    """Run the job API until cancelled"""
+    service = DownloadService(destination_path, workers=workers, queue_path=queue_path)
+    runner = web.AppRunner(create_app(service))
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()